@@ -0,0 +1,340 @@
+"""
+Benchmarks of the collection and ingest hot paths, against local stand-ins.
+
+    python3 benchmarks/run_benchmarks.py --output results.json
+    python3 benchmarks/run_benchmarks.py --compare results.json
+
+Firmware code runs under CPython on the simulator's fake hardware, so the
+absolute numbers say little about a Pico; compare runs on the same machine
+instead. The database benchmarks only run when a DSN is given (--dsn or the
+BENCH_DSN environment variable) and use, then drop, their own tables.
+"""
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(ROOT, "simulator"))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+
+import fake_hardware
+fake_hardware.install()
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import itertools
+import json
+import platform
+import subprocess
+import threading
+import timeit
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import http_stuff
+from bme280 import BME280, BME280_MODE_NORMAL
+from board_temp_sensor import BoardTempSensor
+from sample_ring import SampleRing
+import mc_sensing
+import write_to_database
+
+REPEAT = 5              # runs per benchmark, the best one counts
+MIN_RUN_TIME = 0.2      # seconds a single run should take at least
+BENCH_TABLE = "benchmark_readings"
+# metrics where a larger value is better, for --compare
+HIGHER_IS_BETTER = ("ops_per_second", "rows_per_second")
+
+
+def _time_per_call(func):
+    """Best time per call of func over REPEAT runs, in seconds."""
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    while elapsed < MIN_RUN_TIME:
+        number *= 2
+        elapsed = timer.timeit(number)
+    return min(timer.repeat(REPEAT, number)) / number
+
+
+def _throughput(func):
+    seconds = _time_per_call(func)
+    return {"seconds_per_op": seconds, "ops_per_second": 1 / seconds}
+
+
+def _allocations(func, calls=200):
+    """Transient (peak) and retained heap bytes per call of func, via tracemalloc."""
+    func()  # warm up caches and lazily built state
+    tracemalloc.start()
+    try:
+        peak = 0
+        start, _ = tracemalloc.get_traced_memory()
+        for _ in range(calls):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            func()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+        end, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"peak_bytes_per_request": peak, "retained_bytes_per_request": (end - start) / calls}
+
+
+def _station():
+    bus = fake_hardware.FakeBME280Bus(seed=1)
+    bme = BME280(i2c=bus, address=bus.address, power_mode=BME280_MODE_NORMAL)
+    board = BoardTempSensor()
+    board.sensor_temp = fake_hardware.FakeADC(4, seed=1)
+    ring = SampleRing(capacity=360, interval_ms=10000)
+    for _ in range(ring.capacity):
+        ring.sample(bme, board)
+    return bme, board, ring
+
+
+def bench_bme280_compensation():
+    bme, _, _ = _station()
+    result = http_stuff.array("i", [0, 0, 0])
+    raw = http_stuff.array("i", [0, 0, 0])
+    return {"read_compensated_data": _throughput(lambda: bme.read_compensated_data(result, raw))}
+
+
+def bench_handle_request():
+    bme, board, ring = _station()
+    loop = asyncio.new_event_loop()
+    results = {}
+    routes = {
+        "sensors": b"/sensors",
+        "sensors_bin": b"/sensors/bin",
+        "history": b"/sensors/history",
+        "history_bin": b"/sensors/history/bin",
+        "metrics": b"/metrics",
+        "not_found": b"/nope",
+    }
+    try:
+        for name, path in routes.items():
+            request = bytearray(http_stuff.REQUEST_BUFFER_SIZE)
+            message = b"GET " + path + b" HTTP/1.1\r\nHost: station\r\n\r\n"
+            request[:len(message)] = message
+
+            def call(request=request, length=len(message)):
+                return loop.run_until_complete(
+                    http_stuff.handle_request(request, bme, board, ring=ring, length=length))
+
+            response = call()
+            result = {"bytes_per_request": sum(len(chunk) for chunk in response if chunk)}
+            result.update(_allocations(call))
+            result.update(_throughput(call))
+            results[name] = result
+
+        data = http_stuff.read_sensors(bme, board)
+        response = http_stuff.create_http_response(data)
+        result = {"bytes_per_request": sum(len(chunk) for chunk in response if chunk)}
+        result.update(_allocations(lambda: http_stuff.create_http_response(data)))
+        result.update(_throughput(lambda: http_stuff.create_http_response(data)))
+        results["create_http_response"] = result
+    finally:
+        loop.close()
+    return results
+
+
+class _CannedHandler(BaseHTTPRequestHandler):
+    body = b"{}"
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, which would otherwise meet delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _CannedSession:
+    """Returns the same parsed-ready response without any I/O."""
+
+    def __init__(self, body):
+        self._response = requests.Response()
+        self._response.status_code = 200
+        self._response._content = body
+        self._response.encoding = "utf-8"
+
+    def get(self, url, timeout=None):
+        return self._response
+
+
+def bench_query_environmental_sensors():
+    bme, board, _ = _station()
+    data = http_stuff.read_sensors(bme, board)
+    body = b"".join(chunk for chunk in http_stuff.create_http_response(data) if chunk)
+    body = body.split(b"\r\n\r\n", 1)[1]
+    # a consumer served from the proxy's cache
+    results = {"cached": _throughput(
+        lambda: mc_sensing.PROXY.get("http://cached/sensors", session=_CannedSession(body)).json())}
+    # the collector's polls always reach the (canned) station
+    results["parse"] = _throughput(
+        lambda: mc_sensing.query_environmental_sensors("http://station/sensors",
+                                                       session=_CannedSession(body)))
+
+    _CannedHandler.body = body
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _CannedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/sensors".format(server.server_address[1])
+    try:
+        with requests.Session() as session:
+            results["localhost_keep_alive"] = _throughput(
+                lambda: mc_sensing.query_environmental_sensors(url, session=session))
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+# readings are unique per station and time, so every record written gets a time of its own
+_record_times = itertools.count()
+
+
+def _record(i):
+    moment = datetime.datetime(2026, 1, 1) + datetime.timedelta(seconds=10 * next(_record_times))
+    return {"timestamp": moment.strftime("%Y-%m-%d %H:%M:%S"), "temperature": 21.5 + i % 7,
+            "humidity": 40.0, "pressure": 1013.2, "board_temperature": 25.0, "station_id": "bench"}
+
+
+def _rows_per_second(run, rows):
+    timer = timeit.Timer(run)
+    return {"rows_per_second": rows / min(timer.repeat(3, 1))}
+
+
+def bench_write_data_to_postgres(dsn):
+    from psycopg2.extensions import parse_dsn
+    params = parse_dsn(dsn)
+    args = dict(host=params.get("host", "localhost"), database=params.get("dbname", "postgres"),
+                user=params.get("user", "postgres"), password=params.get("password", ""),
+                table_name=BENCH_TABLE, port=int(params.get("port", 5432)))
+    connection_args = {key: value for key, value in args.items() if key != "table_name"}
+    results = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        write_to_database.create_table_if_not_exists(**args)
+        connection = write_to_database.connect_to_postgres(**connection_args)
+        try:
+            rows = 500
+
+            def per_row_shared_connection():
+                for i in range(rows):
+                    write_to_database.write_data_to_postgres(
+                        **args, data_records=_record(i), comment="bench", connection=connection)
+            results["per_row_shared_connection"] = _rows_per_second(per_row_shared_connection, rows)
+
+            def per_row_new_connection():
+                for i in range(50):
+                    write_to_database.write_data_to_postgres(**args, data_records=_record(i), comment="bench")
+            results["per_row_new_connection"] = _rows_per_second(per_row_new_connection, 50)
+
+            for name, rows in (("batched_insert", write_to_database.COPY_THRESHOLD - 1),
+                               ("batched_copy", 20000)):
+                def batched(rows=rows):
+                    with write_to_database.PostgresWriter(**args, max_batch_size=rows + 1) as writer:
+                        for i in range(rows):
+                            writer.write(_record(i), "bench")
+                        writer.flush()
+                results[name] = _rows_per_second(batched, rows)
+
+            # an at-least-once sender repeating a batch that is stored already
+            repeated = [_record(i) for i in range(20000)]
+            with write_to_database.PostgresWriter(**args, max_batch_size=len(repeated) + 1) as writer:
+                for record in repeated:
+                    writer.write(record, "bench")
+
+            def batched_resend():
+                with write_to_database.PostgresWriter(**args, max_batch_size=len(repeated) + 1) as writer:
+                    for record in repeated:
+                        writer.write(record, "bench")
+                    writer.flush()
+            results["batched_copy_resend"] = _rows_per_second(batched_resend, len(repeated))
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute("DROP TABLE IF EXISTS {0}, {0}_raw, {0}_calibration, {0}_hourly, "
+                               "{0}_daily, {0}_compression CASCADE;".format(BENCH_TABLE))
+            connection.commit()
+            connection.close()
+    return results
+
+
+def _metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "machine": platform.machine(),
+            "system": platform.system(), "date": datetime.datetime.now().isoformat(timespec="seconds")}
+
+
+def _flatten(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, prefix + key + ".")
+        else:
+            yield prefix + key, value
+
+
+def compare(previous, current, tolerance):
+    """Print metrics that changed by more than tolerance, return True if any got worse."""
+    old = dict(_flatten(previous["results"]))
+    worse = False
+    for name, value in _flatten(current["results"]):
+        if name not in old or not old[name]:
+            continue
+        change = value / old[name] - 1
+        if abs(change) <= tolerance:
+            continue
+        better = (change > 0) == name.endswith(HIGHER_IS_BETTER)
+        worse = worse or not better
+        print("{:<70} {:>14.6g} -> {:<14.6g} {:+.1%} {}".format(
+            name, old[name], value, change, "better" if better else "WORSE"), file=sys.stderr)
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the collection and ingest hot paths.")
+    parser.add_argument("--output", help="write the JSON results to this file (default: stdout)")
+    parser.add_argument("--dsn", default=os.environ.get("BENCH_DSN"),
+                        help="PostgreSQL DSN for the database benchmarks (default: $BENCH_DSN, skipped if unset)")
+    parser.add_argument("--compare", help="earlier results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative change reported by --compare (default: %(default)s)")
+    args = parser.parse_args()
+
+    # keep the firmware's per-request output out of the measurements
+    http_stuff.print = lambda *args, **kwargs: None
+    mc_sensing.print = lambda *args, **kwargs: None
+
+    results = {
+        "bme280_compensation": bench_bme280_compensation(),
+        "handle_request": bench_handle_request(),
+        "query_environmental_sensors": bench_query_environmental_sensors(),
+    }
+    if args.dsn:
+        results["write_data_to_postgres"] = bench_write_data_to_postgres(args.dsn)
+    report = {"meta": _metadata(), "results": results}
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as file:
+            if compare(json.load(file), report, args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+from typing import Dict, List
+import math
+import time
+import metrics
+
+# Change of each quantity that is worth a new record. A station is polled
+# about as often as its fastest changing quantity moves this much.
+SIGNIFICANT_CHANGE = {"temperature": 0.2, "humidity": 1.0, "pressure": 0.3}
+SMOOTHING = 0.3     # weight of the newest rate in the moving averages
+SPREAD = 2.0        # standard deviations of the rate added to its mean, so gusty weather is polled faster
+MAX_GROWTH = 2.0    # an interval grows at most by this factor from one poll to the next
+
+STATION_INTERVAL = metrics.Gauge(
+   "collector_station_interval_seconds", "Current polling interval of each station (adaptive schedule)")
+
+
+class _StationState:
+
+   def __init__(self, interval: float, due: float):
+      self.interval = interval
+      self.due = due
+      self.last = None        # the previous reading and when it was taken
+      self.last_at = None
+      self.rate_mean = {}     # moving average of |change| per second, per quantity
+      self.rate_square = {}   # moving average of its square, for the variance
+
+
+class AdaptiveScheduler:
+   """
+   Per station polling intervals that follow the weather instead of the clock.
+
+   After every poll the rate of change of temperature, humidity and pressure
+   since the previous poll is folded into a moving average and variance per
+   station. The next poll is scheduled when the fastest quantity is expected
+   to have changed by its SIGNIFICANT_CHANGE, taking the mean rate plus
+   SPREAD standard deviations, within min_interval and max_interval. Calm
+   stations thus drift towards max_interval (growing by at most MAX_GROWTH
+   per poll), while a front arriving brings them back to min_interval at once.
+   """
+
+   def __init__(self, urls: List[str], min_interval: float, max_interval: float,
+                significant_change: Dict[str, float] = SIGNIFICANT_CHANGE):
+      """
+      Args:
+         urls: The station URLs, all due right away
+         min_interval: Shortest time between two polls of a station, in seconds
+         max_interval: Longest time between two polls of a station, in seconds
+         significant_change: Quantity to the change that is worth a new record
+      """
+      if not 0 < min_interval <= max_interval:
+         raise ValueError("Need 0 < min_interval <= max_interval")
+      self.min_interval = min_interval
+      self.max_interval = max_interval
+      self.significant_change = significant_change
+      now = time.monotonic()
+      self._stations = {url: _StationState(min_interval, now) for url in urls}
+
+   def interval(self, url: str) -> float:
+      return self._stations[url].interval
+
+   def next_due(self) -> float:
+      """Monotonic time at which the next station is due."""
+      return min(state.due for state in self._stations.values())
+
+   def due(self, now: float | None = None) -> List[str]:
+      """The stations whose poll is due."""
+      now = time.monotonic() if now is None else now
+      return [url for url, state in self._stations.items() if state.due <= now]
+
+   def update(self, url: str, data: Dict[str, float] | None, now: float | None = None) -> float:
+      """
+      Reschedule a station after a poll.
+
+      Args:
+         url: The station URL
+         data: The averaged reading, None if the poll failed
+         now: Monotonic time of the poll (default: now)
+
+      Returns:
+         float: Seconds until the station's next poll
+      """
+      now = time.monotonic() if now is None else now
+      state = self._stations[url]
+      if not data:
+         # keep the interval, but try again soon
+         state.due = now + self.min_interval
+         return self.min_interval
+
+      if state.last is not None and now > state.last_at:
+         elapsed = now - state.last_at
+         needed = self.max_interval
+         for key, step in self.significant_change.items():
+            if data.get(key) is None or state.last.get(key) is None:
+               continue
+            rate = abs(data[key] - state.last[key]) / elapsed
+            if key not in state.rate_mean:
+               state.rate_mean[key] = rate
+               state.rate_square[key] = rate * rate
+            else:
+               state.rate_mean[key] += SMOOTHING * (rate - state.rate_mean[key])
+               state.rate_square[key] += SMOOTHING * (rate * rate - state.rate_square[key])
+            mean = state.rate_mean[key]
+            spread = math.sqrt(max(0., state.rate_square[key] - mean * mean))
+            fastest = mean + SPREAD * spread
+            if fastest > 0:
+               needed = min(needed, step / fastest)
+         state.interval = max(self.min_interval, min(self.max_interval, needed, state.interval * MAX_GROWTH))
+
+      state.last = {key: data.get(key) for key in self.significant_change}
+      state.last_at = now
+      state.due = now + state.interval
+      STATION_INTERVAL.set(state.interval, station=url)
+      return state.interval
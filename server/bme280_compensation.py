@@ -0,0 +1,153 @@
+from typing import Dict, Tuple
+import io
+import numpy as np
+import psycopg2.extensions
+
+CALIBRATION_KEYS = (
+   "dig_T1", "dig_T2", "dig_T3",
+   "dig_P1", "dig_P2", "dig_P3", "dig_P4", "dig_P5", "dig_P6", "dig_P7", "dig_P8", "dig_P9",
+   "dig_H1", "dig_H2", "dig_H3", "dig_H4", "dig_H5", "dig_H6",
+)
+
+
+def compensate(
+   raw_temperature,
+   raw_pressure,
+   raw_humidity,
+   calibration: Dict[str, int]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+   """
+   Apply the BME280 integer compensation to whole arrays of raw ADC words.
+
+   This is a vectorised copy of BME280.read_compensated_data in the firmware
+   (src/bme280.py) and reproduces its output bit for bit, including its
+   quirks: floor division and arithmetic shifts as in Python, and the
+   temperature term that shifts dig_T2 before multiplying. Every intermediate
+   value fits in int64, as in Bosch's 64-bit reference implementation.
+
+   Args:
+      raw_temperature: Raw temperature words (20 bit)
+      raw_pressure: Raw pressure words (20 bit)
+      raw_humidity: Raw humidity words (16 bit)
+      calibration: The station's dig_* calibration block
+
+   Returns:
+      tuple: int64 arrays of temperature (C * 100), pressure (Pa * 256) and
+      humidity (% * 1024), as the firmware would have computed them
+   """
+   dig = {key: np.int64(calibration[key]) for key in CALIBRATION_KEYS}
+   raw_temp = np.asarray(raw_temperature, dtype=np.int64)
+   raw_press = np.asarray(raw_pressure, dtype=np.int64)
+   raw_hum = np.asarray(raw_humidity, dtype=np.int64)
+
+   # temperature
+   var1 = ((raw_temp >> 3) - (dig["dig_T1"] << 1)) * (dig["dig_T2"] >> 11)
+   var2 = (((((raw_temp >> 4) - dig["dig_T1"]) *
+             ((raw_temp >> 4) - dig["dig_T1"])) >> 12) * dig["dig_T3"]) >> 14
+   t_fine = var1 + var2
+   temperature = (t_fine * 5 + 128) >> 8
+
+   # pressure
+   var1 = t_fine - 128000
+   var2 = var1 * var1 * dig["dig_P6"]
+   var2 = var2 + ((var1 * dig["dig_P5"]) << 17)
+   var2 = var2 + (dig["dig_P4"] << 35)
+   var1 = (((var1 * var1 * dig["dig_P3"]) >> 8) +
+           ((var1 * dig["dig_P2"]) << 12))
+   var1 = (((np.int64(1) << 47) + var1) * dig["dig_P1"]) >> 33
+   valid = var1 != 0
+   p = 1048576 - raw_press
+   p = np.floor_divide(((p << 31) - var2) * 3125, np.where(valid, var1, 1))
+   var1 = (dig["dig_P9"] * (p >> 13) * (p >> 13)) >> 25
+   var2 = (dig["dig_P8"] * p) >> 19
+   pressure = np.where(valid, ((p + var1 + var2) >> 8) + (dig["dig_P7"] << 4), 0)
+
+   # humidity
+   h = t_fine - 76800
+   h = (((((raw_hum << 14) - (dig["dig_H4"] << 20) -
+           (dig["dig_H5"] * h)) + 16384)
+         >> 15) * (((((((h * dig["dig_H6"]) >> 10) *
+                       (((h * dig["dig_H3"]) >> 11) + 32768)) >> 10) +
+                     2097152) * dig["dig_H2"] + 8192) >> 14))
+   h = h - (((((h >> 15) * (h >> 15)) >> 7) * dig["dig_H1"]) >> 4)
+   h = np.clip(h, 0, 419430400)
+   humidity = h >> 12
+
+   return temperature, pressure, humidity
+
+
+def to_human_readable(temperature, pressure, humidity) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+   """
+   Convert compensated values to C, hPa and %, rounded down to two decimals
+   like BME280.environmental_parameters does on the station.
+   """
+   temperature = np.asarray(temperature) / 100
+   p = np.asarray(pressure) // 256
+   pi = p // 100
+   pressure = pi + (p - pi * 100) / 100
+   h = np.asarray(humidity)
+   hi = h // 1024
+   humidity = hi + (h * 100 // 1024 - hi * 100) / 100
+   return temperature, pressure, humidity
+
+
+def recompensate_station(connection, table_name: str, station_id: str):
+   """
+   Recompute the full resolution series of a station from its archived raw
+   words in one pass, e.g. to analyse or export it after a precision fix.
+   The stored readings are left as they are.
+
+   Every row is compensated with the calibration in effect when it was
+   archived: the latest one recorded at or before its created_at. Both times
+   are on the database's clock, as the station's may not be set, and a
+   station's calibration is always recorded before the samples that follow
+   its boot. Rows archived before the first recorded calibration use that one.
+
+   Args:
+      connection: An open psycopg2 connection
+      table_name: The readings table, raw words live in "<table_name>_raw"
+      station_id: The station whose history to reprocess
+
+   Returns:
+      tuple: (seq, date_time, temperature C, pressure hPa, humidity %) arrays,
+      or None if the station has no calibration on record
+   """
+   with connection.cursor() as cursor:
+      # in microseconds, so a calibration and the rows archived right after it stay apart
+      cursor.execute(
+         f"SELECT (EXTRACT(EPOCH FROM valid_from) * 1000000)::BIGINT, "
+         f"{', '.join(key.lower() for key in CALIBRATION_KEYS)} "
+         f"FROM {table_name}_calibration WHERE station_id = %s ORDER BY valid_from;", (station_id,))
+      rows = cursor.fetchall()
+      if not rows:
+         return None
+      valid_from = np.array([row[0] for row in rows], dtype=np.int64)
+      calibrations = [dict(zip(CALIBRATION_KEYS, row[1:])) for row in rows]
+
+      # COPY streams the integers as text in one go, which numpy parses in bulk
+      buffer = io.StringIO()
+      cursor.copy_expert(
+         f"""COPY (SELECT seq, EXTRACT(EPOCH FROM date_time)::BIGINT,
+                    (EXTRACT(EPOCH FROM created_at) * 1000000)::BIGINT,
+                    raw_temperature, raw_pressure, raw_humidity
+                 FROM {table_name}_raw WHERE station_id = {psycopg2.extensions.adapt(station_id).getquoted().decode()}
+                 ORDER BY date_time, seq)
+            TO STDOUT WITH (FORMAT csv)""", buffer)
+
+   if not buffer.getvalue():
+      empty = np.empty(0, dtype=np.int64)
+      return empty, empty.astype("datetime64[s]"), empty, empty, empty
+
+   buffer.seek(0)
+   columns = np.loadtxt(buffer, delimiter=",", dtype=np.int64, ndmin=2).reshape(-1, 6).T
+   seq, epoch, archived, raw_temp, raw_press, raw_hum = columns
+   # index of the calibration in effect for every row
+   in_effect = np.maximum(np.searchsorted(valid_from, archived, side="right") - 1, 0)
+   compensated = [np.empty_like(raw_temp) for _ in range(3)]
+   for index in np.unique(in_effect):
+      selected = in_effect == index
+      for result, values in zip(compensated, compensate(
+            raw_temp[selected], raw_press[selected], raw_hum[selected], calibrations[index])):
+         result[selected] = values
+   temperature, pressure, humidity = to_human_readable(*compensated)
+   return seq, epoch.astype("datetime64[s]"), temperature, pressure, humidity
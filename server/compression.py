@@ -0,0 +1,179 @@
+from bisect import bisect_right
+from datetime import datetime
+from typing import Dict, List
+import metrics
+
+METHODS = ("deadband", "swinging-door")
+# Error bound per quantity (in its unit, °C, %RH and hPa), about the noise of an averaged reading
+DEFAULT_BOUNDS = {"temperature": 0.1, "humidity": 0.5, "pressure": 0.1, "board_temperature": 0.5}
+MAX_GAP = 3600.0    # seconds after which a reading is stored anyway, so a quiet station still shows up
+
+COMPRESSION_RECORDS = metrics.Counter(
+   "collector_compression_records_total", "Records entering the compression stage and records stored (in, out)")
+
+
+def _seconds(record) -> float:
+   moment = record["timestamp"]
+   if not isinstance(moment, datetime):
+      moment = datetime.fromisoformat(moment)
+   return moment.timestamp()
+
+
+class _Door:
+   """Swinging door state of one station, for all quantities at once."""
+
+   def __init__(self, anchor, anchor_at):
+      self.anchor = anchor        # the last stored record and its time in seconds
+      self.anchor_at = anchor_at
+      self.held = None            # the latest record not stored (yet)
+      self.held_at = None
+      self.lower = {}             # slope bounds through all held back records, per quantity
+      self.upper = {}
+
+
+class Compressor:
+   """
+   Drops the records that can be reconstructed from the stored ones within an error bound.
+
+   With "deadband", a record is stored when any quantity moved by more than
+   its bound since the last stored record; readers hold the last stored
+   value until the next one. With "swinging-door", a record is stored when
+   the straight line from the last stored record to the newest one no longer
+   passes within the bounds of every record in between; readers interpolate
+   linearly between stored records. Either way a record is also stored after
+   max_gap seconds without one, and for swinging-door the newest record is
+   held back until the next one decides whether it is needed, so the stored
+   series lags by up to max_gap (flush() stores what is held back).
+
+   All quantities of a station are compressed together, so stored rows stay
+   whole; a quantity that is missing from a record makes it be stored.
+   """
+
+   def __init__(self, method: str = "swinging-door", bounds: Dict[str, float] | None = None,
+                max_gap: float = MAX_GAP):
+      """
+      Args:
+         method: "deadband" or "swinging-door"
+         bounds: Quantity to the largest error allowed when reconstructing it,
+            quantities not listed are stored as they come (default: DEFAULT_BOUNDS)
+         max_gap: Seconds after which a record is stored regardless
+
+      Raises:
+         ValueError: If the method is unknown or a bound is not positive
+      """
+      if method not in METHODS:
+         raise ValueError(f"Unknown compression method '{method}', expected one of {', '.join(METHODS)}")
+      bounds = DEFAULT_BOUNDS if bounds is None else bounds
+      if any(bound <= 0 for bound in bounds.values()):
+         raise ValueError("Compression bounds must be positive")
+      self.method = method
+      self.bounds = dict(bounds)
+      self.max_gap = max_gap
+      self._stations: Dict[str, _Door] = {}
+
+   def feed(self, record: Dict[str, float]) -> List[Dict[str, float]]:
+      """
+      Pass a station's averaged record through the compression.
+
+      Args:
+         record: The record, with "timestamp" and "station_id" set
+
+      Returns:
+         list: The records to store now, oldest first (often none)
+      """
+      COMPRESSION_RECORDS.inc(stage="in")
+      stored = self._feed(record, _seconds(record))
+      COMPRESSION_RECORDS.inc(len(stored), stage="out")
+      return stored
+
+   def flush(self) -> List[Dict[str, float]]:
+      """Return the records held back by swinging-door, to be stored e.g. before shutting down."""
+      stored = []
+      for door in self._stations.values():
+         if door.held is not None:
+            stored.append(door.held)
+            self._restart(door, door.held, door.held_at)
+      COMPRESSION_RECORDS.inc(len(stored), stage="out")
+      return stored
+
+   def _feed(self, record, at) -> List[Dict[str, float]]:
+      station_id = record.get("station_id")
+      door = self._stations.get(station_id)
+      if door is None:
+         self._stations[station_id] = _Door(record, at)
+         return [record]
+
+      latest_at = door.held_at if door.held is not None else door.anchor_at
+      if at <= latest_at or at - door.anchor_at >= self.max_gap or \
+            any(record.get(key) is None or door.anchor.get(key) is None for key in self.bounds):
+         # not after the latest record (no slope to draw), too long since the last
+         # stored record or incomplete: store it, after the record held back if there is one
+         stored = [door.held, record] if door.held is not None else [record]
+         self._restart(door, record, at)
+         return stored
+
+      if self.method == "deadband":
+         if any(abs(record[key] - door.anchor[key]) > bound for key, bound in self.bounds.items()):
+            self._restart(door, record, at)
+            return [record]
+         return []
+
+      stored = []
+      if door.held is not None and not self._fits(door, record, at):
+         # the held back record is the last one the line can still end on
+         stored.append(door.held)
+         self._restart(door, door.held, door.held_at)
+      self._hold(door, record, at)
+      return stored
+
+   def _fits(self, door, record, at) -> bool:
+      # whether the line from the anchor to record passes within bounds of every held back record
+      elapsed = at - door.anchor_at
+      for key in self.bounds:
+         slope = (record[key] - door.anchor[key]) / elapsed
+         if not door.lower[key] <= slope <= door.upper[key]:
+            return False
+      return True
+
+   def _hold(self, door, record, at) -> None:
+      elapsed = at - door.anchor_at
+      for key, bound in self.bounds.items():
+         change = record[key] - door.anchor[key]
+         door.lower[key] = max(door.lower.get(key, -float("inf")), (change - bound) / elapsed)
+         door.upper[key] = min(door.upper.get(key, float("inf")), (change + bound) / elapsed)
+      door.held = record
+      door.held_at = at
+
+   @staticmethod
+   def _restart(door, anchor, anchor_at) -> None:
+      door.anchor = anchor
+      door.anchor_at = anchor_at
+      door.held = None
+      door.held_at = None
+      door.lower = {}
+      door.upper = {}
+
+
+def reconstruct(times: List[datetime], values: List[float | None], at: datetime,
+                method: str = "swinging-door") -> float | None:
+   """
+   The value of a compressed series at any moment between its stored rows.
+
+   Args:
+      times: Times of the stored rows, ascending
+      values: The stored values of one quantity
+      at: The moment to reconstruct
+      method: The method the rows were stored with ("none" is treated like
+         "deadband", holding the last value)
+
+   Returns:
+      The value within the method's bound of what was measured, None if at
+      lies outside the stored rows
+   """
+   index = bisect_right(times, at) - 1
+   if index < 0 or at > times[-1]:
+      return None
+   if method != "swinging-door" or times[index] == at or values[index] is None or values[index + 1] is None:
+      return values[index]
+   fraction = (at - times[index]) / (times[index + 1] - times[index])
+   return values[index] + fraction * (values[index + 1] - values[index])
@@ -0,0 +1,209 @@
+from secrets import *
+from write_to_database import connect_to_postgres
+from datetime import datetime
+from typing import List
+import argparse
+import csv
+import sys
+import time
+
+try:
+   # optional, only needed for --format parquet
+   import pyarrow
+   import pyarrow.parquet
+except ImportError:
+   pyarrow = None
+
+CHUNK_ROWS = 50000      # rows fetched per round trip, and rows per Parquet row group
+READING_COLUMNS = ("station_id", "date_time", "temperature", "humidity", "pressure",
+                   "board_temperature", "comment")
+SOURCES = ("readings", "hourly", "daily")
+
+# PostgreSQL type OIDs to the Arrow types they are exported as, anything else becomes a string
+_ARROW_TYPES = {
+   16: "bool_",
+   20: "int64",
+   21: "int16",
+   23: "int32",
+   700: "float32",
+   701: "float64",
+   1114: "timestamp",
+}
+
+
+def _export_query(table_name: str, source: str, stations: List[str], start, end):
+   if source == "readings":
+      columns, time_column, station = ", ".join(READING_COLUMNS), "date_time", "COALESCE(station_id, '')"
+   else:
+      columns, time_column, station = "*", "bucket", "station_id"
+      table_name = f"{table_name}_{source}"
+
+   conditions, params = [], []
+   if stations:
+      conditions.append(f"{station} = ANY(%s)")
+      params.append(list(stations))
+   if start is not None:
+      conditions.append(f"{time_column} >= %s")
+      params.append(start)
+   if end is not None:
+      conditions.append(f"{time_column} < %s")
+      params.append(end)
+   where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+   # no ORDER BY: sorting years of data would defeat streaming; rows come
+   # partition by partition, which is roughly chronological
+   return f"SELECT {columns} FROM {table_name}{where};", params
+
+
+class _CsvSink:
+
+   def __init__(self, path, columns):
+      self._file = sys.stdout if path == "-" else open(path, "w", newline="")
+      self._writer = csv.writer(self._file)
+      self._writer.writerow(columns)
+
+   def write(self, rows):
+      self._writer.writerows(rows)
+
+   def close(self):
+      if self._file is not sys.stdout:
+         self._file.close()
+      else:
+         self._file.flush()
+
+
+class _ParquetSink:
+
+   def __init__(self, path, columns, type_codes):
+      if pyarrow is None:
+         raise RuntimeError("Parquet export needs pyarrow, install it with 'pip install pyarrow'")
+      if path == "-":
+         raise ValueError("Parquet cannot be written to stdout")
+      types = []
+      for type_code in type_codes:
+         name = _ARROW_TYPES.get(type_code, "string")
+         types.append(pyarrow.timestamp("us") if name == "timestamp" else getattr(pyarrow, name)())
+      self._schema = pyarrow.schema(list(zip(columns, types)))
+      self._writer = pyarrow.parquet.ParquetWriter(path, self._schema, compression="zstd")
+
+   def write(self, rows):
+      # one row group per chunk, so only a single chunk is ever held in memory
+      columns = list(zip(*rows))
+      arrays = [pyarrow.array(values, type=field.type) if field.type != pyarrow.string()
+                else pyarrow.array([None if value is None else str(value) for value in values],
+                                   type=field.type)
+                for values, field in zip(columns, self._schema)]
+      self._writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self._schema))
+
+   def close(self):
+      self._writer.close()
+
+
+def export_history(
+   host: str,
+   database: str,
+   user: str,
+   password: str,
+   table_name: str,
+   output: str,
+   output_format: str = "csv",
+   source: str = "readings",
+   stations: List[str] | None = None,
+   start: datetime | None = None,
+   end: datetime | None = None,
+   port: int = 5432,
+   chunk_rows: int = CHUNK_ROWS
+) -> int:
+   """
+   Stream rows from the database to a CSV or Parquet file in constant memory.
+
+   Rows are read through a named (server-side) cursor chunk_rows at a time
+   and every chunk is written out before the next one is fetched, so the
+   size of the export does not matter to either side.
+
+   Args:
+      host: Database host address
+      database: Database name
+      user: Username for database connection
+      password: Password for database connection
+      table_name: The readings table (rollups live in "<table_name>_hourly"/"_daily")
+      output: Path of the file to write, "-" for stdout (CSV only)
+      output_format: "csv" or "parquet"
+      source: "readings", "hourly" or "daily"
+      stations: Station ids to export, all stations if empty
+      start: Export rows from this time on (optional)
+      end: Export rows before this time (optional)
+      port: Database port (default: 5432)
+      chunk_rows: Rows per round trip and per Parquet row group
+
+   Returns:
+      int: Number of rows exported
+   """
+   if source not in SOURCES:
+      raise ValueError(f"source must be one of {', '.join(SOURCES)}")
+   query, params = _export_query(table_name, source, stations, start, end)
+
+   connection = connect_to_postgres(host, database, user, password, port)
+   sink = None
+   exported = 0
+   try:
+      connection.set_session(readonly=True)
+      with connection.cursor(name="export_history") as cursor:
+         cursor.itersize = chunk_rows
+         cursor.execute(query, params)
+         while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if sink is None:
+               # the description is only known after the first fetch from a named cursor
+               columns = [column.name for column in cursor.description]
+               if output_format == "parquet":
+                  sink = _ParquetSink(output, columns,
+                                      [column.type_code for column in cursor.description])
+               else:
+                  sink = _CsvSink(output, columns)
+            if not rows:
+               break
+            sink.write(rows)
+            exported += len(rows)
+   finally:
+      if sink is not None:
+         sink.close()
+      connection.close()
+   return exported
+
+
+if __name__ == "__main__":
+
+   parser = argparse.ArgumentParser(description="Export the collected history to CSV or Parquet.")
+   parser.add_argument("output", help="file to write, '-' for stdout (CSV only)")
+   parser.add_argument("--format", choices=("csv", "parquet"),
+                       help="output format (default: from the file extension, else csv)")
+   parser.add_argument("--source", choices=SOURCES, default="readings",
+                       help="the readings or one of the rollups (default: %(default)s)")
+   parser.add_argument("--station", action="append", default=[],
+                       help="station id to export, can be repeated (default: all)")
+   parser.add_argument("--start", type=datetime.fromisoformat,
+                       help="ISO date/time of the first row to export")
+   parser.add_argument("--end", type=datetime.fromisoformat,
+                       help="ISO date/time to export up to (exclusive)")
+   parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS,
+                       help="rows per fetch and per Parquet row group (default: %(default)s)")
+   args = parser.parse_args()
+
+   output_format = args.format or ("parquet" if args.output.endswith(".parquet") else "csv")
+   started = time.monotonic()
+   count = export_history(
+      host=HOST,
+      database=DATABASE,
+      user=DBUSER,
+      password=DBUSERPASS,
+      table_name=TABLENAME,
+      output=args.output,
+      output_format=output_format,
+      source=args.source,
+      stations=args.station,
+      start=args.start,
+      end=args.end,
+      port=PORT,
+      chunk_rows=args.chunk_rows,
+   )
+   print(f"Exported {count} rows in {time.monotonic() - started:.1f} seconds.", file=sys.stderr)
@@ -0,0 +1,349 @@
+from secrets import *
+from mc_sensing import AVERAGED_KEYS
+from sample_format import BINARY_HEADER_SIZE, FIELDS, SampleBatch, decode_samples
+from write_to_database import PostgresWriter
+from spool import Spool
+from compression import METHODS, Compressor
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import asyncio
+import json
+import signal
+import time
+import metrics
+
+# Records are persisted here before they are written to the database (optional).
+SPOOL_PATH = globals().get("SPOOL_PATH")
+# Months of readings to keep, older monthly partitions are dropped (optional).
+RETENTION_MONTHS = globals().get("RETENTION_MONTHS")
+# Store only the records needed to reconstruct the readings within COMPRESSION_BOUNDS,
+# "deadband" or "swinging-door" (optional).
+COMPRESSION = globals().get("COMPRESSION")
+# Largest error per quantity when reconstructing compressed readings (optional).
+COMPRESSION_BOUNDS = globals().get("COMPRESSION_BOUNDS")
+# Port the ingest listener serves its Prometheus metrics on (optional).
+METRICS_PORT = globals().get("METRICS_PORT")
+INGEST_PORT = globals().get("INGEST_PORT", 8090)
+REQUEST_TIMEOUT = 10.0      # seconds a station may take to send one request
+MAX_BATCH_SAMPLES = 4096    # larger batches are refused
+MAX_HEADER_LINES = 32
+BACKLOG = 1024              # pending connections, a whole fleet may push at once
+WORKERS = 4                 # threads doing database work
+# samples dated before were taken by a clock that was never set (a Pico's starts
+# in 2021 at every boot), their times would repeat and collide with stored ones
+CLOCK_SET_AFTER = datetime(2024, 1, 1)
+
+INGEST_REQUESTS = metrics.Counter(
+   "ingest_requests_total", "Requests received from pushing stations, by endpoint and status")
+INGEST_SAMPLES = metrics.Counter(
+   "ingest_samples_total", "Pushed samples, by whether they were new or already acknowledged")
+INGEST_SECONDS = metrics.Histogram(
+   "ingest_request_seconds", "Time from a station's request to its acknowledgement")
+INGEST_CONNECTIONS = metrics.Gauge("ingest_open_connections", "Station connections currently open")
+
+
+class _BadRequest(Exception):
+   pass
+
+
+class _DatabaseUnavailable(Exception):
+   pass
+
+
+def _response(status: str, body: dict) -> bytes:
+   payload = json.dumps(body).encode()
+   return (f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+           f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n").encode() + payload
+
+
+def _trim(batch: SampleBatch, first_seq: int) -> SampleBatch:
+   """Drop the samples of a batch that come before first_seq."""
+   skip = min(batch.count, max(0, first_seq - (batch.next_seq - batch.count)))
+   if skip == 0:
+      return batch
+   return SampleBatch(batch.values[skip * FIELDS:], batch.count - skip, batch.reference.year,
+                      batch.oldest_seq, batch.next_seq, batch.latest_seq)
+
+
+class IngestServer:
+   """
+   Accepts sample batches pushed by the stations and feeds them to a writer.
+
+   Stations POST the binary batch of their ring buffer (the /sensors/history/bin
+   format) to /ingest and get back the sequence number they should continue
+   from. A batch is acknowledged once its average is queued with the writer
+   (and persisted, if the writer has a spool), so a station simply sends
+   everything from the acknowledged sequence number on with its next push;
+   batches repeated after a lost acknowledgement are recognised by their
+   sequence numbers and not written twice.
+
+   Every batch becomes one averaged record, like a polled station's cycle,
+   and its raw words are archived. Database work runs on a small thread pool,
+   so thousands of open station connections never wait on each other.
+   """
+
+   def __init__(self, writer: PostgresWriter, comment: str = "push", workers: int = WORKERS,
+                compressor: Compressor | None = None):
+      """
+      Args:
+         writer: The PostgresWriter the records are written with
+         comment: Additional information stored with each record
+         workers: Threads doing database work, fewer than the writer's max_connections
+         compressor: Optional Compressor deciding which averaged records are written
+      """
+      self.writer = writer
+      self.comment = comment
+      self.compressor = compressor
+      # stations whose compression settings are recorded
+      self._compression_recorded = set()
+      # station id to the sequence number it should continue from
+      self.acknowledged = {}
+      self.calibrated = set()
+      self._locks = {}
+      # the writer's pool needs a connection for each thread plus one for its own
+      # flusher thread, or getconn raises PoolError instead of waiting
+      self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+
+   def close(self):
+      self._executor.shutdown(wait=True)
+      if self.compressor is not None:
+         for record in self.compressor.flush():
+            self.writer.write(record, self.comment)
+
+   def store_batch(self, station_id: str, batch: SampleBatch) -> bool:
+      """
+      Archive the raw words of a batch and queue its average (runs on the thread pool).
+
+      Returns:
+         bool: False if the raw words could not be archived, the batch is then not queued
+      """
+      if not self.writer.write_raw_batch(station_id, batch):
+         return False
+      record = {key: batch.mean(key) for key in AVERAGED_KEYS}
+      # stamped with the batch's own last sample, not the time it arrived: batches of a
+      # backlog arrive within the same second, and a batch sent again (e.g. after a
+      # restart of this listener) must map to the same row to be recognised as a duplicate
+      record["timestamp"] = batch.timestamp(batch.column("timestamp")[-1]).strftime("%Y-%m-%d %H:%M:%S")
+      record["station_id"] = station_id
+      if station_id not in self._compression_recorded:
+         if self.compressor is None:
+            stored = self.writer.write_compression(station_id, "none")
+         else:
+            stored = self.writer.write_compression(
+               station_id, self.compressor.method, self.compressor.bounds, self.compressor.max_gap)
+         if stored:
+            self._compression_recorded.add(station_id)
+      if self.compressor is None:
+         self.writer.write(record, self.comment)
+         return True
+      # batches of one station are stored one at a time, under its lock
+      for stored in self.compressor.feed(record):
+         self.writer.write(stored, self.comment)
+      return True
+
+   async def ingest_batch(self, station_id: str, payload: bytes) -> int:
+      """
+      Store a pushed batch, skipping samples that were acknowledged before.
+
+      Returns:
+         int: The sequence number the station should continue from
+
+      Raises:
+         _BadRequest: If the batch is malformed or dated by a clock that was never set
+         _DatabaseUnavailable: If the batch could not be stored, it is not acknowledged
+      """
+      try:
+         batch = decode_samples(payload)
+      except ValueError as e:
+         raise _BadRequest(str(e))
+      if batch.count and batch.timestamp(batch.column("timestamp")[0]) < CLOCK_SET_AFTER:
+         raise _BadRequest("The station's clock is not set")
+
+      lock = self._locks.setdefault(station_id, asyncio.Lock())
+      async with lock:
+         acknowledged = self.acknowledged.get(station_id)
+         if acknowledged is not None and batch.latest_seq < acknowledged:
+            # sequence numbers went backwards, the station has rebooted
+            print(f"Station {station_id} restarted, resynchronising its history.")
+            acknowledged = None
+         if acknowledged is not None:
+            new = _trim(batch, acknowledged)
+            INGEST_SAMPLES.inc(batch.count - new.count, state="repeated")
+            batch = new
+
+         if batch.count:
+            stored = await asyncio.get_running_loop().run_in_executor(
+               self._executor, self.store_batch, station_id, batch)
+            if not stored:
+               # the station sends the batch again with its next push
+               raise _DatabaseUnavailable("Could not archive the batch")
+            INGEST_SAMPLES.inc(batch.count, state="new")
+         next_seq = max(batch.next_seq, acknowledged or 0)
+         self.acknowledged[station_id] = next_seq
+      metrics.log_event("ingest", station=station_id, samples=batch.count, ack=next_seq)
+      return next_seq
+
+   async def ingest_calibration(self, station_id: str, payload: bytes) -> bool:
+      try:
+         calibration = json.loads(payload)
+      except ValueError as e:
+         raise _BadRequest(str(e))
+      if not isinstance(calibration, dict):
+         raise _BadRequest("Calibration must be a JSON object")
+      stored = await asyncio.get_running_loop().run_in_executor(
+         self._executor, self.writer.write_calibration, station_id, calibration)
+      if stored:
+         self.calibrated.add(station_id)
+         # stations send their calibration after every boot, when their sequence numbers start over
+         self.acknowledged.pop(station_id, None)
+      return stored
+
+   async def _read_request(self, reader):
+      request_line = (await reader.readline()).decode("latin-1").split()
+      if len(request_line) != 3:
+         raise _BadRequest("Malformed request line")
+      method, target, _ = request_line
+      headers = {}
+      for _ in range(MAX_HEADER_LINES):
+         line = (await reader.readline()).decode("latin-1")
+         if line in ("\r\n", "\n", ""):
+            break
+         name, _, value = line.partition(":")
+         headers[name.strip().lower()] = value.strip()
+      else:
+         raise _BadRequest("Too many headers")
+
+      try:
+         length = int(headers.get("content-length", 0))
+      except ValueError:
+         raise _BadRequest("Invalid Content-Length")
+      if not 0 <= length <= BINARY_HEADER_SIZE + MAX_BATCH_SAMPLES * FIELDS * 4:
+         raise _BadRequest("Request body too large")
+      body = await reader.readexactly(length)
+      return method, target, body
+
+   async def handle(self, reader, writer):
+      """Serve one request of a station, then close the connection."""
+      INGEST_CONNECTIONS.set(INGEST_CONNECTIONS.value() + 1)
+      started = time.perf_counter()
+      endpoint = "unknown"
+      try:
+         try:
+            method, target, body = await asyncio.wait_for(self._read_request(reader), REQUEST_TIMEOUT)
+            url = urlsplit(target)
+            # a station that does not name itself is known by its address, as polled ones are
+            station_id = parse_qs(url.query).get("station", [None])[0] or \
+               writer.get_extra_info("peername")[0]
+
+            if method != "POST":
+               status, body = "405 Method Not Allowed", {"status": "error", "error": "POST only"}
+            elif url.path == "/ingest":
+               endpoint = "batch"
+               ack = await self.ingest_batch(station_id, body)
+               # a station that is not calibrated here (e.g. after a restart) sends its calibration again
+               status, body = "200 OK", {"ack": ack, "calibrated": station_id in self.calibrated,
+                                         "status": "ok"}
+            elif url.path == "/ingest/calibration":
+               endpoint = "calibration"
+               if await self.ingest_calibration(station_id, body):
+                  status, body = "200 OK", {"status": "ok"}
+               else:
+                  status, body = "503 Service Unavailable", {"status": "error", "error": "database"}
+            else:
+               status, body = "404 Not Found", {"status": "error", "error": "not found"}
+         except _BadRequest as e:
+            status, body = "400 Bad Request", {"status": "error", "error": str(e)}
+         except _DatabaseUnavailable as e:
+            status, body = "503 Service Unavailable", {"status": "error", "error": str(e)}
+         except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            raise
+         except Exception as e:
+            # a bug or an unexpected database error; the station keeps its samples and retries
+            print(f"Error handling a {endpoint} request: {e!r}")
+            status, body = "500 Internal Server Error", {"status": "error", "error": "internal"}
+
+         writer.write(_response(status, body))
+         await asyncio.wait_for(writer.drain(), REQUEST_TIMEOUT)
+         INGEST_REQUESTS.inc(endpoint=endpoint, status=status.split()[0])
+         INGEST_SECONDS.observe(time.perf_counter() - started)
+      except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError) as e:
+         INGEST_REQUESTS.inc(endpoint=endpoint, status="dropped")
+         print(f"Station connection dropped: {e!r}")
+      except Exception as e:
+         INGEST_REQUESTS.inc(endpoint=endpoint, status="error")
+         print(f"Unexpected error replying to a station: {e!r}")
+      finally:
+         INGEST_CONNECTIONS.set(INGEST_CONNECTIONS.value() - 1)
+         writer.close()
+
+
+async def run_ingest(server: IngestServer, host: str = "0.0.0.0", port: int = INGEST_PORT, started=None):
+   """
+   Listen for pushing stations until cancelled.
+
+   Args:
+      server: The IngestServer handling the requests
+      host: Address to listen on
+      port: Port to listen on
+      started: Optional callback receiving the asyncio server once it listens
+   """
+   listener = await asyncio.start_server(server.handle, host, port, backlog=BACKLOG)
+   print(f"Ingest listening on {host}:{port}")
+   if started is not None:
+      started(listener)
+   async with listener:
+      await listener.serve_forever()
+
+
+def serve(host: str = "0.0.0.0", port: int = INGEST_PORT, comment: str = "push",
+          metrics_port: int | None = METRICS_PORT, compression: str | None = COMPRESSION):
+   writer = PostgresWriter(
+      host=HOST,
+      database=DATABASE,
+      user=DBUSER,
+      password=DBUSERPASS,
+      table_name=TABLENAME,
+      port=PORT,
+      spool=Spool(SPOOL_PATH) if SPOOL_PATH else None,
+      retention_months=RETENTION_MONTHS,
+      max_connections=WORKERS + 1,
+   )
+   writer.create_table_if_not_exists()
+   metrics_server = metrics.serve(metrics_port) if metrics_port else None
+   compressor = Compressor(compression, COMPRESSION_BOUNDS) if compression else None
+   server = IngestServer(writer, comment, WORKERS, compressor=compressor)
+
+   loop = asyncio.new_event_loop()
+   task = loop.create_task(run_ingest(server, host, port))
+   loop.add_signal_handler(signal.SIGTERM, task.cancel)
+   try:
+      loop.run_until_complete(task)
+   except (KeyboardInterrupt, asyncio.CancelledError):
+      pass
+   finally:
+      loop.close()
+      server.close()
+      writer.close()
+      if metrics_server is not None:
+         metrics_server.shutdown()
+      print("Ingest listener stopped.")
+
+
+if __name__ == "__main__":
+
+   parser = argparse.ArgumentParser(description="Accept sample batches pushed by the stations.")
+   parser.add_argument("comment", nargs="?", default="push",
+                       help="additional information stored with each record")
+   parser.add_argument("--host", default="0.0.0.0", help="address to listen on (default: %(default)s)")
+   parser.add_argument("--port", type=int, default=INGEST_PORT,
+                       help="port to listen on (default: %(default)s)")
+   parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                       help="serve Prometheus metrics on this port (default: %(default)s)")
+   parser.add_argument("--compression", choices=METHODS, default=COMPRESSION,
+                       help="write only the records needed to reconstruct the readings within "
+                            "COMPRESSION_BOUNDS (default: %(default)s)")
+   args = parser.parse_args()
+
+   serve(args.host, args.port, args.comment, args.metrics_port, args.compression)
@@ -1,33 +1,143 @@
 from secrets import *
-from mc_sensing import perform_sensor_data_averaging
-from write_to_database import write_data_to_postgres
-import sys
+from mc_sensing import perform_fleet_sensor_data_averaging, query_station_calibration, station_id_from_url
+from write_to_database import PostgresWriter
+from spool import Spool
+import mc_sensing
+from adaptive_schedule import AdaptiveScheduler
+from compression import METHODS, Compressor
+import metrics
+import station_proxy
+import argparse
 import datetime
+import functools
+import signal
+import threading
+import time
+import requests
 
-if __name__ == "__main__":
+# A fleet is configured with URLS = [...] in secrets.py; a single URL still works.
+STATION_URLS = globals().get("URLS") or [URL]
+# Fetch the samples the stations buffer themselves instead of polling them repeatedly.
+USE_HISTORY = globals().get("USE_HISTORY", False)
+# Let the stations average (samples, interval_ms) readings themselves, e.g. (50, 50).
+OVERSAMPLE = globals().get("OVERSAMPLE")
+# Records are persisted here before they are written to the database (optional).
+SPOOL_PATH = globals().get("SPOOL_PATH")
+# Months of readings to keep, older monthly partitions are dropped (optional).
+RETENTION_MONTHS = globals().get("RETENTION_MONTHS")
+# Port the daemon serves its Prometheus metrics on (optional).
+METRICS_PORT = globals().get("METRICS_PORT")
+# Port the daemon serves the stations' live data on, through the caching proxy (optional).
+PROXY_PORT = globals().get("PROXY_PORT")
+# Seconds a station response is reused for all consumers, the collector included (optional).
+PROXY_TTL = globals().get("PROXY_TTL")
+# Poll each station every (min, max) seconds depending on how fast its readings change,
+# e.g. (120, 1800), instead of all of them every CYCLE_INTERVAL (daemon mode, optional).
+ADAPTIVE_INTERVAL = globals().get("ADAPTIVE_INTERVAL")
+# Store only the records needed to reconstruct the readings within COMPRESSION_BOUNDS,
+# "deadband" or "swinging-door" (daemon mode, optional).
+COMPRESSION = globals().get("COMPRESSION")
+# Largest error per quantity when reconstructing compressed readings,
+# e.g. {"temperature": 0.1, "humidity": 0.5, "pressure": 0.1} (optional).
+COMPRESSION_BOUNDS = globals().get("COMPRESSION_BOUNDS")
+CYCLE_INTERVAL = 600    # seconds between the starts of two collection cycles (daemon mode)
+
+CYCLE_SECONDS = metrics.Histogram(
+   "collector_cycle_seconds", "Duration of a collection cycle per stage (poll, flush, total)",
+   buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+CYCLE_STATIONS = metrics.Gauge(
+   "collector_cycle_stations", "Stations in the last cycle, by whether they delivered data")
+LAST_CYCLE = metrics.Gauge(
+   "collector_last_cycle_timestamp_seconds", "Unix time the last cycle finished")
+
+
+def create_writer():
+   return PostgresWriter(
+      host=HOST,
+      database=DATABASE,
+      user=DBUSER,
+      password=DBUSERPASS,
+      table_name=TABLENAME,
+      port=PORT,
+      spool=Spool(SPOOL_PATH) if SPOOL_PATH else None,
+      retention_months=RETENTION_MONTHS,
+   )
+
+
+def archive_raw_batch(writer, calibrated, url, batch):
+   """
+   Keep the raw BME280 words of a history batch, so the readings can be
+   compensated again later; the station's calibration is stored when it is
+   first seen and again after every restart, which may come with another sensor.
+   """
+   station_id = station_id_from_url(url)
+   if batch.column("seq")[0] < calibrated.get(station_id, 0):
+      # sequence numbers went backwards, the station has rebooted
+      del calibrated[station_id]
+   if station_id in calibrated:
+      calibrated[station_id] = batch.next_seq
+   else:
+      calibration = query_station_calibration(url)
+      if calibration is not None and writer.write_calibration(station_id, calibration):
+         calibrated[station_id] = batch.next_seq
+   writer.write_raw_batch(station_id, batch)
+
+
+def run_cycle(comment, writer, sessions=None, history_cursors=None, calibrated=None, urls=None,
+              scheduler=None, compressor=None):
+   """
+   Collect one averaged sample from every station and write it to the database.
+
+   Args:
+      comment: Additional information stored with each record
+      writer: The PostgresWriter the records are written with
+      sessions: Optional mapping of station URL to a requests.Session to reuse
+      history_cursors: Mapping of station URL to the next history sequence
+         number, kept between cycles (only used when USE_HISTORY is set)
+      calibrated: Mapping of station id to the next sequence number, for the
+         stations whose calibration is stored since their last restart, kept
+         between cycles (only used when USE_HISTORY is set)
+      urls: The stations to poll (default: all of STATION_URLS)
+      scheduler: Optional AdaptiveScheduler to reschedule the polled stations with
+      compressor: Optional Compressor deciding which records are written
+
+   Returns:
+      bool: True if the records were written, False otherwise
+   """
+   if USE_HISTORY and history_cursors is None:
+      history_cursors = {}
+   elif not USE_HISTORY:
+      history_cursors = None
+   on_batch = None
+   if USE_HISTORY:
+      on_batch = functools.partial(
+         archive_raw_batch, writer, calibrated if calibrated is not None else {})
 
-   comment = '-'
-   if len(sys.argv) > 1:
-      comment = sys.argv[1]
-   
+   urls = STATION_URLS if urls is None else urls
    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+   success = False
+   started = time.perf_counter()
+   fleet_data = {}
    try:
-      sample_data = perform_sensor_data_averaging(URL)
-
-      if sample_data is None:
-         raise RuntimeError("No valid data collected for averaging. Skipping database write.")
-      
-      # Write data to database
-      success = write_data_to_postgres(
-         host=HOST,
-         database=DATABASE,
-         user=DBUSER,
-         password=DBUSERPASS,
-         table_name=TABLENAME,
-         data_records=sample_data,
-         comment=comment,
-         port=PORT,
-      )
+      with CYCLE_SECONDS.time(stage="poll"):
+         fleet_data = perform_fleet_sensor_data_averaging(
+            urls, sessions=sessions, history_cursors=history_cursors,
+            oversample=OVERSAMPLE, on_batch=on_batch)
+
+      for url, sample_data in fleet_data.items():
+         if sample_data is None:
+            print(f"[{now}] No valid data collected for averaging from {url}. Skipping database write.")
+            continue
+         sample_data["station_id"] = station_id_from_url(url)
+         if compressor is None:
+            writer.write(sample_data, comment)
+            continue
+         for record in compressor.feed(sample_data):
+            writer.write(record, comment)
+
+      # Write the whole cycle to the database in one go
+      with CYCLE_SECONDS.time(stage="flush"):
+         success = writer.flush()
       if success:
          print(f"Data written successfully at {now}")
       else:
@@ -36,5 +146,170 @@ if __name__ == "__main__":
    except Exception as e:
       print(f"[{now}] An error occurred: {e}")
 
+   if scheduler is not None:
+      # stations that failed, or never got polled because of an error, are retried soon
+      polled = time.monotonic()
+      for url in urls:
+         scheduler.update(url, fleet_data.get(url), polled)
+
+   seconds = time.perf_counter() - started
+   delivered = sum(data is not None for data in fleet_data.values())
+   CYCLE_SECONDS.observe(seconds, stage="total")
+   CYCLE_STATIONS.set(delivered, state="ok")
+   CYCLE_STATIONS.set(len(urls) - delivered, state="failed")
+   LAST_CYCLE.set(time.time())
+   metrics.log_event("cycle", ok=success, seconds=round(seconds, 3),
+                     stations=len(urls), delivered=delivered)
    print("*************************")
+   return success
+
+
+def run_daemon(comment, interval=CYCLE_INTERVAL, metrics_port=METRICS_PORT, proxy_port=PROXY_PORT,
+               adaptive_interval=ADAPTIVE_INTERVAL, compression=COMPRESSION):
+   """
+   Run collection cycles forever on a fixed schedule within a single process.
+
+   HTTP sessions to the stations and the pooled database connections are
+   kept open between cycles. Cycle starts are computed from a fixed monotonic
+   origin so they do not drift, and a cycle that overruns its slot makes the
+   scheduler skip the missed slots instead of starting cycles on top of each
+   other.
+
+   With an adaptive interval each station has its own schedule instead (see
+   AdaptiveScheduler), and every cycle polls just the stations that are due.
+
+   With compression, only the records needed to reconstruct the readings
+   within COMPRESSION_BOUNDS are written (see Compressor); the records it
+   holds back are written on the way out.
+
+   Args:
+      comment: Additional information stored with each record
+      interval: Seconds between the starts of two cycles
+      metrics_port: Port to serve the metrics on at /metrics, None for none
+      proxy_port: Port to serve the stations on through the caching proxy, None for none
+      adaptive_interval: (min, max) seconds between two polls of a station, None for
+         the fixed interval
+      compression: "deadband" or "swinging-door", None to write every record
+   """
+   stop = threading.Event()
+
+   def request_stop(signum, frame):
+      print(f"Received signal {signum}, stopping after the current cycle.")
+      stop.set()
+
+   signal.signal(signal.SIGTERM, request_stop)
+   signal.signal(signal.SIGINT, request_stop)
+
+   sessions = {url: requests.Session() for url in STATION_URLS}
+   writer = create_writer()
+   history_cursors = {}
+   calibrated = {}
+   writer.create_table_if_not_exists()
+   compressor = Compressor(compression, COMPRESSION_BOUNDS) if compression else None
+   for url in STATION_URLS:
+      # lets readers tell compressed stretches of the readings from plain ones
+      if compressor is None:
+         writer.write_compression(station_id_from_url(url), "none")
+      else:
+         writer.write_compression(
+            station_id_from_url(url), compressor.method, compressor.bounds, compressor.max_gap)
+   metrics_server = metrics.serve(metrics_port) if metrics_port else None
+   proxy_server = None
+   if proxy_port:
+      # the collector's own polls go through the same proxy
+      proxy_server = station_proxy.serve(
+         mc_sensing.PROXY, {station_id_from_url(url): url for url in STATION_URLS}, proxy_port)
+
+   try:
+      if adaptive_interval:
+         run_adaptive(comment, writer, sessions, history_cursors, calibrated, compressor,
+                      adaptive_interval, stop)
+      else:
+         run_fixed(comment, writer, sessions, history_cursors, calibrated, compressor, interval, stop)
+   finally:
+      for session in sessions.values():
+         session.close()
+      if compressor is not None:
+         for record in compressor.flush():
+            writer.write(record, comment)
+      writer.close()
+      if metrics_server is not None:
+         metrics_server.shutdown()
+      if proxy_server is not None:
+         proxy_server.shutdown()
+      print("Collector daemon stopped.")
+
+
+def run_fixed(comment, writer, sessions, history_cursors, calibrated, compressor, interval, stop):
+   """Poll all stations every interval seconds, until stop is set."""
+   # align the first cycle to the wall clock, like the */10 cron schedule did
+   wall_offset = interval - (time.time() % interval)
+   next_start = time.monotonic() + wall_offset
+   print(f"Collector daemon started, first cycle in {wall_offset:.1f} seconds.")
+
+   while not stop.wait(max(0., next_start - time.monotonic())):
+      run_cycle(comment, writer, sessions, history_cursors, calibrated, compressor=compressor)
+
+      next_start += interval
+      now = time.monotonic()
+      if now > next_start:
+         missed = int((now - next_start) // interval) + 1
+         print(f"Cycle overran its slot, skipping {missed} scheduled start(s).")
+         next_start += missed * interval
+
+
+def run_adaptive(comment, writer, sessions, history_cursors, calibrated, compressor, adaptive_interval,
+                 stop):
+   """
+   Poll each station when the AdaptiveScheduler says it is due, until stop is set.
+
+   Stations that fall due about together are polled in one cycle, so their
+   records are still written in one go.
+   """
+   min_interval, max_interval = adaptive_interval
+   scheduler = AdaptiveScheduler(STATION_URLS, min_interval, max_interval)
+   print(f"Collector daemon started, polling every {min_interval} to {max_interval} seconds per station.")
+
+   while not stop.wait(max(0., scheduler.next_due() - time.monotonic())):
+      # stations due shortly after are polled along, rather than in a cycle of their own
+      due = scheduler.due(time.monotonic() + 0.1 * min_interval)
+      run_cycle(comment, writer, sessions, history_cursors, calibrated, urls=due, scheduler=scheduler,
+                compressor=compressor)
+      metrics.log_event("schedule", polled=len(due), next_in=round(scheduler.next_due() - time.monotonic(), 1))
+
+
+if __name__ == "__main__":
+
+   parser = argparse.ArgumentParser(description="Collect environmental data from the stations.")
+   parser.add_argument("comment", nargs="?", default="-",
+                       help="additional information stored with each record")
+   parser.add_argument("--daemon", action="store_true",
+                       help="keep running and collect on a fixed schedule")
+   parser.add_argument("--interval", type=float, default=CYCLE_INTERVAL,
+                       help="seconds between cycles in daemon mode (default: %(default)s)")
+   parser.add_argument("--adaptive", type=float, nargs=2, metavar=("MIN", "MAX"), default=ADAPTIVE_INTERVAL,
+                       help="poll each station every MIN to MAX seconds depending on how fast its "
+                            "readings change, instead of every --interval (daemon mode)")
+   parser.add_argument("--compression", choices=METHODS, default=COMPRESSION,
+                       help="write only the records needed to reconstruct the readings within "
+                            "COMPRESSION_BOUNDS (daemon mode, default: %(default)s)")
+   parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                       help="serve Prometheus metrics on this port in daemon mode (default: %(default)s)")
+   parser.add_argument("--proxy-port", type=int, default=PROXY_PORT,
+                       help="serve the stations through the caching proxy on this port in daemon mode "
+                            "(default: %(default)s)")
+   args = parser.parse_args()
+
+   if PROXY_TTL is not None:
+      mc_sensing.PROXY.ttl = PROXY_TTL
 
+   if args.daemon:
+      run_daemon(args.comment, args.interval, args.metrics_port, args.proxy_port, args.adaptive,
+                 args.compression)
+   else:
+      if args.compression:
+         # a single cycle has nothing to compress against
+         print("Compression only applies in daemon mode, writing every record.")
+      with create_writer() as writer:
+         writer.create_table_if_not_exists()
+         run_cycle(args.comment, writer)
@@ -1,13 +1,94 @@
 import requests
+import metrics
+from sample_format import decode_samples
+from station_proxy import StationProxy
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+import math
 import time
 
-def query_environmental_sensors(url):
+REQUEST_TIMEOUT = 5.0      # seconds allowed for a single HTTP request to a station
+STATION_TIMEOUT = 90.0     # seconds allowed for one station's whole averaging run
+MAX_FLEET_WORKERS = 32     # upper bound on stations polled at the same time
+HISTORY_PAGE_SIZE = 60     # samples requested per /sensors/history/bin call
+AVERAGED_KEYS = ("board_temperature", "temperature", "humidity", "pressure")
+
+STATION_REQUEST_SECONDS = metrics.Histogram(
+   "collector_station_request_seconds", "HTTP request latency per station and endpoint")
+STATION_PARSE_SECONDS = metrics.Histogram(
+   "collector_station_parse_seconds", "Time spent decoding station responses per endpoint",
+   buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+STATION_AVERAGING_SECONDS = metrics.Histogram(
+   "collector_station_averaging_seconds", "Duration of a station's whole averaging run")
+STATION_FAILURES = metrics.Counter(
+   "collector_station_failures_total", "Failed station requests by endpoint and reason")
+STATION_RETRIES = metrics.Counter(
+   "collector_station_retries_total", "Station requests repeated, e.g. after a station restart")
+
+
+def station_id_from_url(url):
+   """Identify a station by the host (and port) it is reached at."""
+   return urlsplit(url).netloc or url
+
+
+def _get(url, endpoint, session=None, **kwargs):
+   """GET from a station, recording the request latency per station and endpoint."""
+   # a session keeps the TCP connection to the station alive between requests
+   getter = session.get if session is not None else requests.get
+   with STATION_REQUEST_SECONDS.time(station=station_id_from_url(url), endpoint=endpoint):
+      response = getter(url, **kwargs)
+   response.raise_for_status()
+   return response
+
+
+# Live readings go through this proxy, which the daemon also serves to other
+# consumers; the collector's own polls always reach the station, the others
+# see at most one request per PROXY.ttl seconds besides
+PROXY = StationProxy(fetch=lambda url, endpoint, session, timeout: _get(url, endpoint, session, timeout=timeout))
+
+
+def _count_failure(url, endpoint, error):
+   if isinstance(error, requests.Timeout):
+      reason = "timeout"
+   elif isinstance(error, requests.HTTPError):
+      reason = "http_status"
+   elif isinstance(error, requests.RequestException):
+      reason = "connection"
+   else:
+      reason = "parse"
+   STATION_FAILURES.inc(station=station_id_from_url(url), endpoint=endpoint, reason=reason)
+
+
+def query_station_calibration(url, timeout=REQUEST_TIMEOUT, session=None):
+   """
+   Fetch the BME280 calibration (dig_*) block of a station.
+
+   Args:
+      url: The station URL, the calibration is served under "<url>/calibration"
+      timeout: Seconds allowed for the HTTP request
+      session: Optional requests.Session to reuse
+
+   Returns:
+      dict: dig_* name to value, or None on error
+   """
+   try:
+      response = _get(url.rstrip("/") + "/calibration", "calibration", session, timeout=timeout)
+      with STATION_PARSE_SECONDS.time(endpoint="calibration"):
+         return response.json()
+   except (requests.RequestException, ValueError) as e:
+      _count_failure(url, "calibration", e)
+      print(f"Error querying sensor calibration: {e}")
+      return None
+
+
+def query_environmental_sensors(url, timeout=REQUEST_TIMEOUT, session=None):
    try:
-      response = requests.get(url)
-      response.raise_for_status()
+      # never cached, the averaging needs a reading of its own per poll, however long the ttl
+      response = PROXY.get(url, "current", session, timeout=timeout, allow_stale=False, max_age=0)
 
-      data = response.json()
+      with STATION_PARSE_SECONDS.time(endpoint="current"):
+         data = response.json()
 
       board_temperature = data.get("board_temperature").get("value")
       temperature = data.get("temperature").get("value")
@@ -34,16 +115,151 @@ def query_environmental_sensors(url):
          "pressure": pressure,
          "timestamp": formatted_time
       }
-   except requests.RequestException as e:
+   except (requests.RequestException, ValueError) as e:
+      # the proxy parses with json.loads, whose errors are not RequestExceptions
+      _count_failure(url, "current", e)
       print(f"Error querying sensors: {e}")
       return {}
 
 
-def perform_sensor_data_averaging(url):
+def query_oversampled_sensors(url, samples, interval_ms, session=None):
+   """
+   Ask a station to average several back-to-back readings itself.
+
+   Args:
+      url: The station URL
+      samples: Number of readings the station averages
+      interval_ms: Milliseconds between two readings on the station
+      session: Optional requests.Session to reuse
+
+   Returns:
+      dict: The averaged data (plus "<key>_min", "<key>_max" and "<key>_std"
+      for every averaged key), or None on error
+   """
+   # the station is busy sampling for up to samples * interval_ms before it answers
+   timeout = REQUEST_TIMEOUT + samples * interval_ms / 1000
+   try:
+      response = _get(url, "oversampled", session,
+                      params={"samples": samples, "interval_ms": interval_ms}, timeout=timeout)
+
+      with STATION_PARSE_SECONDS.time(endpoint="oversampled"):
+         data = response.json()
+      averaged_data = {}
+      for key in AVERAGED_KEYS:
+         channel = data.get(key)
+         averaged_data[key] = channel.get("value")
+         averaged_data[f"{key}_min"] = channel.get("min")
+         averaged_data[f"{key}_max"] = channel.get("max")
+         averaged_data[f"{key}_std"] = channel.get("std")
+      # use current time as timestamp (microcontroler time may be off)
+      averaged_data["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+      return averaged_data
+   except (requests.RequestException, ValueError, AttributeError) as e:
+      _count_failure(url, "oversampled", e)
+      print(f"Error querying oversampled sensors: {e}")
+      return None
+
+
+def query_station_history_batch(url, since=None, limit=None, timeout=REQUEST_TIMEOUT, session=None):
+   """
+   Fetch the samples buffered on a station in the compact binary format.
+
+   Args:
+      url: The station URL, the batch is served under "<url>/history/bin"
+      since: First sequence number wanted, None for the newest samples
+      limit: Maximum number of samples, None for whatever the station allows
+      timeout: Seconds allowed for the HTTP request
+      session: Optional requests.Session to reuse
+
+   Returns:
+      SampleBatch: The decoded samples, or None on error
+   """
+   params = {}
+   if since is not None:
+      params["since"] = since
+   if limit is not None:
+      params["limit"] = limit
+   try:
+      response = _get(url.rstrip("/") + "/history/bin", "history_bin", session,
+                      params=params, timeout=timeout)
+      with STATION_PARSE_SECONDS.time(endpoint="history_bin"):
+         return decode_samples(response.content)
+   except (requests.RequestException, ValueError) as e:
+      _count_failure(url, "history_bin", e)
+      print(f"Error querying sensor history: {e}")
+      return None
+
+
+def perform_history_averaging(url, cursors, session=None, on_batch=None):
+   """
+   Average everything a station sampled since the previous call, in as few
+   requests as possible (one, unless the station limits the batch size).
+
+   Args:
+      url: The station URL
+      cursors: Mapping of station URL to the next sequence number to fetch,
+         updated in place. A station missing from it contributes its newest
+         HISTORY_PAGE_SIZE samples
+      session: Optional requests.Session to reuse
+      on_batch: Optional callable(url, batch) handed every SampleBatch
+         received, e.g. to archive the raw words
+
+   Returns:
+      dict: The averaged data, or None if nothing new was collected
+   """
+   batches = []
+   since = cursors.get(url)
+   while True:
+      limit = HISTORY_PAGE_SIZE if since is None else None
+      batch = query_station_history_batch(url, since, limit, session=session)
+      if batch is None:
+         break
+
+      if since is not None and batch.latest_seq < since:
+         # sequence numbers went backwards, the station has rebooted
+         print(f"Station {url} restarted, resynchronising its history.")
+         STATION_RETRIES.inc(station=station_id_from_url(url), reason="restart")
+         since = None
+         continue
+
+      batches.append(batch)
+      if on_batch is not None and batch.count:
+         on_batch(url, batch)
+      since = cursors[url] = batch.next_seq
+      if not batch.count or since >= batch.latest_seq:
+         break
+
+   count = sum(batch.count for batch in batches)
+   print(f"Averaging {count} buffered samples from {url}.")
+   if count == 0:
+      return None
+
+   averaged_data = {
+      key: sum(batch.mean(key) * batch.count for batch in batches if batch.count) / count
+      for key in AVERAGED_KEYS
+   }
+   # use current time as timestamp (microcontroler time may be off)
+   averaged_data["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+   return averaged_data
+
+
+def _sleep_until(seconds, deadline):
+   """Sleep for the given seconds, but never past the deadline (if any)."""
+   if deadline is not None:
+      seconds = min(seconds, deadline - time.monotonic())
+   if seconds > 0:
+      time.sleep(seconds)
+
+
+def _deadline_passed(deadline):
+   return deadline is not None and time.monotonic() >= deadline
+
+
+def perform_sensor_data_averaging(url, deadline=None, session=None):
    print("Starting sensor data averaging...")
 
    # prime the sensors... and discard the first take
-   sensor_data = query_environmental_sensors(url)
+   sensor_data = query_environmental_sensors(url, session=session)
    if not sensor_data:
       return None
    
@@ -65,11 +281,14 @@ def perform_sensor_data_averaging(url):
    }
 
    # Collect data another 5 times with 10 second intervals
-   time.sleep(5) # Initial wait before starting averaging
+   _sleep_until(5, deadline) # Initial wait before starting averaging
    div = 0
    for _ in range(5):
+      if _deadline_passed(deadline):
+         print(f"Station {url} ran out of time, averaging over {div} samples.")
+         break
       print(f"Collecting more data for averaging... {_+1}/5")
-      new_data = query_environmental_sensors(url)
+      new_data = query_environmental_sensors(url, session=session)
       if not new_data:
          continue
       averaged_data["board_temperature"] += new_data["board_temperature"]
@@ -77,7 +296,7 @@ def perform_sensor_data_averaging(url):
       averaged_data["humidity"] += new_data["humidity"]
       averaged_data["pressure"] += new_data["pressure"]
       div += 1
-      time.sleep(10)
+      _sleep_until(10, deadline)
 
    # Compute averages
    if div == 0:
@@ -91,3 +310,103 @@ def perform_sensor_data_averaging(url):
    averaged_data["timestamp"] = timestamp
    return averaged_data
 
+
+def _average_station(url, station_timeout, session, history_cursors, oversample, on_batch):
+   if history_cursors is not None:
+      mode = "history"
+   elif oversample is not None:
+      mode = "oversampled"
+   else:
+      mode = "polling"
+   station = station_id_from_url(url)
+   start = time.perf_counter()
+   data = None
+   try:
+      if mode == "history":
+         data = perform_history_averaging(url, history_cursors, session=session, on_batch=on_batch)
+      elif mode == "oversampled":
+         data = query_oversampled_sensors(url, *oversample, session=session)
+      else:
+         # the deadline starts when a worker picks the station up, not when it is queued
+         data = perform_sensor_data_averaging(
+            url, deadline=time.monotonic() + station_timeout, session=session)
+      return data
+   finally:
+      seconds = time.perf_counter() - start
+      STATION_AVERAGING_SECONDS.observe(seconds, station=station, mode=mode)
+      metrics.log_event("station", station=station, mode=mode, seconds=round(seconds, 4),
+                        ok=bool(data))
+
+
+def perform_fleet_sensor_data_averaging(
+   urls,
+   max_workers=MAX_FLEET_WORKERS,
+   station_timeout=STATION_TIMEOUT,
+   sessions=None,
+   history_cursors=None,
+   oversample=None,
+   on_batch=None
+):
+   """
+   Run the averaging cycle for several stations concurrently.
+
+   Args:
+      urls: The station URLs to poll
+      max_workers: Maximum number of stations polled at the same time
+      station_timeout: Seconds each station is given to complete its averaging
+      sessions: Optional mapping of station URL to a requests.Session to reuse;
+         the session of a station still running when the cycle times out is
+         replaced in place
+      history_cursors: When given, fetch the samples the stations buffered
+         themselves in one request each, instead of polling them repeatedly.
+         Maps station URL to the next sequence number and is updated in place
+      oversample: When given as (samples, interval_ms), let the stations
+         average that many readings themselves in a single request each
+      on_batch: In history mode, optional callable(url, batch) handed every
+         SampleBatch received; called from the worker threads
+
+   Returns:
+      dict: Station URL to averaged data, or None where the station failed or timed out
+   """
+   results = {url: None for url in urls}
+   sessions = sessions or {}
+   if not results:
+      return results
+
+   workers = max(1, min(max_workers, len(results)))
+   # stations beyond the pool size queue up, so allow for as many rounds as needed
+   rounds = math.ceil(len(results) / workers)
+   overall_timeout = rounds * station_timeout + REQUEST_TIMEOUT
+
+   print(f"Polling {len(results)} stations with {workers} workers...")
+   executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="station")
+   try:
+      futures = {
+         executor.submit(
+            _average_station, url, station_timeout, sessions.get(url),
+            history_cursors, oversample, on_batch): url
+         for url in results
+      }
+      done, not_done = wait(futures, timeout=overall_timeout)
+
+      for future in done:
+         url = futures[future]
+         try:
+            results[url] = future.result()
+         except Exception as e:
+            print(f"Error averaging station {url}: {e}")
+
+      for future in not_done:
+         url = futures[future]
+         print(f"Station {url} did not finish in time.")
+         session = sessions.get(url)
+         if session is not None and not future.cancel():
+            # the worker still uses the session and Session is not thread-safe, so the
+            # next cycle gets a new one and the worker closes the old one when it is done
+            sessions[url] = requests.Session()
+            future.add_done_callback(lambda _, session=session: session.close())
+   finally:
+      # do not hold the cycle hostage to a station that is still hanging
+      executor.shutdown(wait=False, cancel_futures=True)
+
+   return results
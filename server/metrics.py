@@ -0,0 +1,162 @@
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+import bisect
+import json
+import threading
+import time
+
+# Seconds, from a fast local request to a whole averaging run
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_registry: List["_Metric"] = []
+_registry_lock = threading.Lock()
+
+
+def _label_key(labels: Dict[str, str]) -> Tuple:
+   return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: Tuple, extra: Tuple = ()) -> str:
+   pairs = key + extra
+   if not pairs:
+      return ""
+   escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+              for _, value in pairs)
+   return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+   kind = ""
+
+   def __init__(self, name: str, documentation: str):
+      self.name = name
+      self.documentation = documentation
+      self._values = {}
+      self._lock = threading.Lock()
+      with _registry_lock:
+         _registry.append(self)
+
+   def render(self) -> List[str]:
+      lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+      with self._lock:
+         items = sorted(self._values.items())
+         lines += self._render_values(items)
+      return lines
+
+   def _render_values(self, items) -> List[str]:
+      return [f"{self.name}{_format_labels(key)} {value}" for key, value in items]
+
+
+class Counter(_Metric):
+   """A value that only goes up, e.g. failures or rows written."""
+   kind = "counter"
+
+   def inc(self, amount: float = 1, **labels) -> None:
+      key = _label_key(labels)
+      with self._lock:
+         self._values[key] = self._values.get(key, 0) + amount
+
+   def value(self, **labels) -> float:
+      with self._lock:
+         return self._values.get(_label_key(labels), 0)
+
+
+class Gauge(_Metric):
+   """A value that is set to whatever it currently is, e.g. a queue length."""
+   kind = "gauge"
+
+   def set(self, value: float, **labels) -> None:
+      with self._lock:
+         self._values[_label_key(labels)] = value
+
+   def value(self, **labels) -> float:
+      with self._lock:
+         return self._values.get(_label_key(labels), 0)
+
+
+class Histogram(_Metric):
+   """Observations counted into cumulative buckets, with their count and sum."""
+   kind = "histogram"
+
+   def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+      super().__init__(name, documentation)
+      self.buckets = tuple(buckets)
+
+   def observe(self, value: float, **labels) -> None:
+      key = _label_key(labels)
+      with self._lock:
+         state = self._values.get(key)
+         if state is None:
+            # per bucket counts (the last one is +Inf), count, sum
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0.]
+         state[0][bisect.bisect_left(self.buckets, value)] += 1
+         state[1] += 1
+         state[2] += value
+
+   @contextmanager
+   def time(self, **labels):
+      """Observe the seconds spent in the with block, whether it raises or not."""
+      start = time.perf_counter()
+      try:
+         yield
+      finally:
+         self.observe(time.perf_counter() - start, **labels)
+
+   def _render_values(self, items) -> List[str]:
+      lines = []
+      for key, (counts, count, total) in items:
+         cumulative = 0
+         for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{_format_labels(key, (('le', bound),))} {cumulative}")
+         lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+         lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+      return lines
+
+
+def render() -> str:
+   """All metrics in the Prometheus text exposition format."""
+   with _registry_lock:
+      metrics = list(_registry)
+   return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+def log_event(event: str, **fields) -> None:
+   """Print one JSON object per line, for log shippers to pick up."""
+   record = {"time": datetime.now().isoformat(timespec="milliseconds"), "event": event}
+   record.update(fields)
+   print(json.dumps(record, default=str), flush=True)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+   def do_GET(self):
+      if self.path.split("?", 1)[0] != "/metrics":
+         self.send_error(404)
+         return
+      body = render().encode()
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def log_message(self, format, *args):
+      # scrapes every few seconds would drown the collector's own output
+      pass
+
+
+def serve(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+   """
+   Serve the metrics at http://<host>:<port>/metrics from a background thread.
+
+   Returns:
+      The server, shut it down with server.shutdown()
+   """
+   server = ThreadingHTTPServer((host, port), _MetricsHandler)
+   server.daemon_threads = True
+   threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+   print(f"Metrics served on {host}:{port}/metrics")
+   return server
@@ -0,0 +1,406 @@
+from secrets import *
+from ttl_cache import TTLCache
+from write_to_database import ROLLUP_METRICS
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import json
+import threading
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+# Spans up to these lengths are served from the readings, the hourly rollup
+# and, beyond, the daily rollup
+RAW_MAX_SPAN = timedelta(days=2)
+HOURLY_MAX_SPAN = timedelta(days=90)
+# Requested ranges are widened to multiples of these steps, so that ranges
+# differing by a few seconds share one cache entry
+RESOLUTIONS = {"raw": timedelta(minutes=1), "hourly": timedelta(hours=1), "daily": timedelta(days=1)}
+DEFAULT_SPAN = timedelta(days=1)
+CURSOR_ITERSIZE = 5000              # rows fetched per round trip from a server-side cursor
+LIVE_TTL = 30.0                     # seconds a response that covers the present stays cached
+HISTORY_TTL = 3600.0                # seconds a response about the past stays cached
+CACHE_ENTRIES = 512
+CACHE_BYTES = 64 * 1024 * 1024
+MAX_CACHED_RESPONSE = 4 * 1024 * 1024   # larger responses are streamed but not cached
+MAX_CONNECTIONS = 8                 # database connections, and so requests handled at a time
+KEEP_ALIVE_TIMEOUT = 10             # seconds an idle client connection may hold a handler thread
+RAW_COLUMNS = ("date_time", "temperature", "humidity", "pressure", "board_temperature")
+ROLLUP_COLUMNS = ("bucket", "samples") + tuple(
+   f"{metric}_{aggregate}" for metric in ROLLUP_METRICS for aggregate in ("mean", "min", "max", "std"))
+_ORIGIN = datetime(2000, 1, 1)      # day aligned, like the rollup buckets
+
+
+def choose_resolution(start: datetime, end: datetime) -> str:
+   """Pick the coarsest data that still gives a useful number of points for the span."""
+   span = end - start
+   if span <= RAW_MAX_SPAN:
+      return "raw"
+   if span <= HOURLY_MAX_SPAN:
+      return "hourly"
+   return "daily"
+
+
+def normalize_range(start: datetime, end: datetime, resolution: str):
+   """Widen a range outwards to whole steps of the resolution."""
+   step = RESOLUTIONS[resolution]
+   start = _ORIGIN + (start - _ORIGIN) // step * step
+   end = _ORIGIN - (_ORIGIN - end) // step * step
+   return start, end
+
+
+def _json_default(value):
+   if isinstance(value, datetime):
+      return value.isoformat()
+   raise TypeError(f"Cannot serialise {type(value).__name__}")
+
+
+def _encode(value) -> bytes:
+   return json.dumps(value, default=_json_default, separators=(",", ":")).encode()
+
+
+def _parse_time(params, name, default):
+   values = params.get(name)
+   if not values:
+      return default
+   try:
+      return datetime.fromisoformat(values[0])
+   except ValueError:
+      raise ValueError(f"'{name}' must be an ISO 8601 date and time")
+
+
+def _station_condition(station_id: str):
+   """
+   The WHERE condition selecting a station in the readings table, and its parameters.
+
+   The rollups know readings without a station as "", the readings table
+   keeps them NULL; station_id is compared as it is, so the index of the
+   (station_id, date_time) key can be used.
+   """
+   if station_id == "":
+      return "(station_id IS NULL OR station_id = '')", ()
+   return "station_id = %s", (station_id,)
+
+
+def _parse_station(params):
+   values = params.get("station")
+   if not values:
+      raise ValueError("'station' is required")
+   return values[0]
+
+
+class ReadService:
+   """
+   Answers the read queries against the readings and rollup tables.
+
+   Responses are cached already encoded, keyed on the normalised query, so
+   dashboards asking the same thing again do not reach the database.
+   """
+
+   def __init__(
+      self,
+      host: str,
+      database: str,
+      user: str,
+      password: str,
+      table_name: str,
+      port: int = 5432,
+      max_connections: int = MAX_CONNECTIONS
+   ):
+      self.table_name = table_name
+      self.max_connections = max_connections
+      self.cache = TTLCache(CACHE_ENTRIES, CACHE_BYTES)
+      self._connection_args = dict(
+         host=host, database=database, user=user, password=password, port=port)
+      self._max_connections = max_connections
+      self._pool = None
+      self._pool_lock = threading.Lock()
+
+   @contextmanager
+   def connection(self):
+      """Borrow a read-only connection from the pool (created on first use)."""
+      with self._pool_lock:
+         if self._pool is None:
+            self._pool = ThreadedConnectionPool(1, self._max_connections, **self._connection_args)
+      connection = self._pool.getconn()
+      try:
+         connection.set_session(readonly=True)
+         yield connection
+      finally:
+         if not connection.closed:
+            connection.rollback()
+         self._pool.putconn(connection, close=bool(connection.closed))
+
+   def close(self):
+      if self._pool is not None:
+         self._pool.closeall()
+         self._pool = None
+
+   def stations(self) -> bytes:
+      """List the stations with the range of days they have data for."""
+      key = ("stations",)
+      body = self.cache.get(key)
+      if body is None:
+         with self.connection() as connection, connection.cursor() as cursor:
+            cursor.execute(
+               f"""SELECT station_id, MIN(bucket), MAX(bucket) + INTERVAL '1 day'
+               FROM {self.table_name}_daily GROUP BY station_id ORDER BY station_id;""")
+            stations = [{"station_id": station_id, "first": first, "last": last}
+                        for station_id, first, last in cursor.fetchall()]
+         body = _encode({"stations": stations})
+         self.cache.put(key, body, LIVE_TTL)
+      return body
+
+   def latest(self, station_id: str) -> bytes | None:
+      """Return the newest reading of a station, None if there is none."""
+      key = ("latest", station_id)
+      body = self.cache.get(key)
+      if body is None:
+         with self.connection() as connection, connection.cursor() as cursor:
+            # the hourly rollup finds the newest hour through its primary key,
+            # so only that hour of readings has to be looked at
+            cursor.execute(
+               f"SELECT MAX(bucket) FROM {self.table_name}_hourly WHERE station_id = %s;",
+               (station_id,))
+            bucket = cursor.fetchone()[0]
+            if bucket is None:
+               return None
+            condition, params = _station_condition(station_id)
+            cursor.execute(
+               f"""SELECT {", ".join(RAW_COLUMNS)} FROM {self.table_name}
+               WHERE {condition} AND date_time >= %s
+               ORDER BY date_time DESC LIMIT 1;""",
+               (*params, bucket))
+            row = cursor.fetchone()
+         if row is None:
+            return None
+         body = _encode({"station_id": station_id, "columns": RAW_COLUMNS, "row": row})
+         self.cache.put(key, body, LIVE_TTL)
+      return body
+
+   def range(self, station_id: str, start: datetime, end: datetime, resolution: str = "auto"):
+      """
+      Return the data of a station between start and end.
+
+      Args:
+         station_id: The station to query
+         start: Start of the range (inclusive)
+         end: End of the range (exclusive)
+         resolution: "raw", "hourly", "daily" or "auto" to pick by the span
+
+      Returns:
+         The encoded response, as bytes when it came from the cache and as an
+         iterator of chunks otherwise
+
+      Raises:
+         ValueError: If the range or resolution is invalid
+      """
+      if end <= start:
+         raise ValueError("'end' must be after 'start'")
+      if resolution == "auto":
+         resolution = choose_resolution(start, end)
+      elif resolution not in RESOLUTIONS:
+         raise ValueError(f"'resolution' must be one of auto, {', '.join(RESOLUTIONS)}")
+      start, end = normalize_range(start, end, resolution)
+
+      key = ("range", station_id, resolution, start, end)
+      body = self.cache.get(key)
+      if body is not None:
+         return body
+      ttl = LIVE_TTL if end > datetime.now() - RESOLUTIONS[resolution] else HISTORY_TTL
+      return self._cache_chunks(key, ttl, self._query_range(station_id, start, end, resolution))
+
+   def _query_range(self, station_id, start, end, resolution):
+      if resolution == "raw":
+         columns = RAW_COLUMNS
+         condition, params = _station_condition(station_id)
+         query = f"""SELECT {", ".join(RAW_COLUMNS)} FROM {self.table_name}
+            WHERE {condition} AND date_time >= %s AND date_time < %s
+            ORDER BY date_time;"""
+      else:
+         columns = ROLLUP_COLUMNS
+         aggregates = []
+         for metric in ROLLUP_METRICS:
+            mean = f"{metric}_sum / NULLIF({metric}_count, 0)"
+            aggregates += [
+               mean, f"{metric}_min", f"{metric}_max",
+               f"SQRT(GREATEST({metric}_sumsq / NULLIF({metric}_count, 0) - ({mean}) ^ 2, 0))"]
+         query = f"""SELECT bucket,
+            GREATEST({", ".join(f"{metric}_count" for metric in ROLLUP_METRICS)}),
+            {", ".join(aggregates)}
+            FROM {self.table_name}_{resolution}
+            WHERE station_id = %s AND bucket >= %s AND bucket < %s
+            ORDER BY bucket;"""
+         params = (station_id,)
+
+      header = {"station_id": station_id, "resolution": resolution,
+                "start": start, "end": end, "columns": columns}
+
+      with self.connection() as connection:
+         # a named cursor keeps the result on the server, so a long range is
+         # fetched and sent in chunks rather than held in memory at once
+         with connection.cursor(name="read_api_range") as cursor:
+            cursor.itersize = CURSOR_ITERSIZE
+            cursor.execute(query, (*params, start, end))
+            # the first chunk is only produced once the first rows are in, so
+            # a failing query surfaces before the response has started
+            chunk = _encode(header)[:-1] + b',"rows":['
+            separator = b""
+            while True:
+               rows = cursor.fetchmany(CURSOR_ITERSIZE)
+               if not rows:
+                  break
+               yield chunk + separator + b",".join(_encode(row) for row in rows)
+               chunk = b""
+               separator = b","
+      yield chunk + b"]}"
+
+   def _cache_chunks(self, key, ttl, chunks):
+      parts = []
+      size = 0
+      for chunk in chunks:
+         if parts is not None:
+            size += len(chunk)
+            if size <= MAX_CACHED_RESPONSE:
+               parts.append(chunk)
+            else:
+               parts = None
+         yield chunk
+      if parts is not None:
+         self.cache.put(key, b"".join(parts), ttl)
+
+
+class ReadRequestHandler(BaseHTTPRequestHandler):
+   """
+   GET /stations
+   GET /latest?station=<id>
+   GET /range?station=<id>&start=<iso>&end=<iso>&resolution=auto|raw|hourly|daily
+   """
+   protocol_version = "HTTP/1.1"
+   # an idle keep-alive connection gives its thread back after this long
+   timeout = KEEP_ALIVE_TIMEOUT
+
+   def do_GET(self):
+      service = self.server.service
+      url = urlsplit(self.path)
+      params = parse_qs(url.query)
+      try:
+         if url.path == "/stations":
+            body = service.stations()
+         elif url.path == "/latest":
+            body = service.latest(_parse_station(params))
+            if body is None:
+               return self._send_error(404, "No data for this station")
+         elif url.path == "/range":
+            station_id = _parse_station(params)
+            end = _parse_time(params, "end", datetime.now())
+            start = _parse_time(params, "start", end - DEFAULT_SPAN)
+            resolution = params.get("resolution", ["auto"])[0]
+            body = service.range(station_id, start, end, resolution)
+         else:
+            return self._send_error(404, "Not found")
+
+         if isinstance(body, bytes):
+            return self._send(200, body)
+         # run the query before anything is sent, so database errors still get a status
+         first = next(body)
+      except ValueError as e:
+         return self._send_error(400, str(e))
+      except psycopg2.Error as e:
+         print(f"Database error: {e}")
+         return self._send_error(503, "Database unavailable")
+
+      try:
+         self._send_chunked(first, body)
+      except psycopg2.Error as e:
+         # too late for an error status, cut the response short instead
+         print(f"Database error: {e}")
+         self.close_connection = True
+      finally:
+         body.close()
+
+   def _send(self, status, body):
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def _send_error(self, status, message):
+      self._send(status, _encode({"error": message}))
+
+   def _send_chunked(self, first, chunks):
+      self.send_response(200)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Transfer-Encoding", "chunked")
+      self.end_headers()
+      self._write_chunk(first)
+      for chunk in chunks:
+         self._write_chunk(chunk)
+      self.wfile.write(b"0\r\n\r\n")
+
+   def _write_chunk(self, chunk):
+      if chunk:
+         self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+
+
+class _BoundedThreadingHTTPServer(ThreadingHTTPServer):
+   """
+   A ThreadingHTTPServer with at most max_threads handler threads; further
+   connections wait in the listen backlog instead of in threads that would
+   find the connection pool empty.
+   """
+
+   def __init__(self, server_address, handler_class, max_threads: int):
+      super().__init__(server_address, handler_class)
+      self._handler_slots = threading.BoundedSemaphore(max_threads)
+
+   def process_request(self, request, client_address):
+      self._handler_slots.acquire()
+      try:
+         super().process_request(request, client_address)
+      except Exception:
+         self._handler_slots.release()
+         raise
+
+   def process_request_thread(self, request, client_address):
+      try:
+         super().process_request_thread(request, client_address)
+      finally:
+         self._handler_slots.release()
+
+
+def serve(host="127.0.0.1", port=8080):
+   service = ReadService(
+      host=HOST,
+      database=DATABASE,
+      user=DBUSER,
+      password=DBUSERPASS,
+      table_name=TABLENAME,
+      port=PORT,
+   )
+   # every handler thread uses at most one pooled connection at a time
+   server = _BoundedThreadingHTTPServer((host, port), ReadRequestHandler, service.max_connections)
+   server.service = service
+   print(f"Read API listening on {host}:{port}")
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      pass
+   finally:
+      server.server_close()
+      service.close()
+
+
+if __name__ == "__main__":
+
+   parser = argparse.ArgumentParser(description="Serve the collected history over HTTP.")
+   parser.add_argument("--host", default="127.0.0.1",
+                       help="address to listen on (default: %(default)s)")
+   parser.add_argument("--port", type=int, default=8080,
+                       help="port to listen on (default: %(default)s)")
+   args = parser.parse_args()
+
+   serve(args.host, args.port)
@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+import struct
+import sys
+
+# Mirrors the sample layout of the firmware (src/sample_ring.py)
+FIELD_NAMES = ("seq", "timestamp", "board_temperature", "temperature", "pressure", "humidity",
+               "raw_temperature", "raw_pressure", "raw_humidity")
+FIELD_SCALES = (1, 1, 100, 100, 25600, 1024, 1, 1, 1)   # divide by these to get C, hPa and %
+FIELDS = len(FIELD_NAMES)
+
+BINARY_MAGIC = b"ESS1"
+BINARY_VERSION = 2
+# magic, version, fields, count, epoch year, oldest_seq, next_seq, latest_seq
+BINARY_HEADER_FORMAT = "<4sBBHHIII"
+BINARY_HEADER_SIZE = struct.calcsize(BINARY_HEADER_FORMAT)
+
+
+class SampleBatch:
+   """
+   A batch of samples in the station's fixed layout, kept as one flat
+   sequence of scaled ints (FIELDS per sample) rather than per-sample dicts.
+   """
+
+   def __init__(self, values, count, epoch_year, oldest_seq, next_seq, latest_seq):
+      self.values = values
+      self.count = count
+      self.reference = datetime(epoch_year, 1, 1)
+      self.oldest_seq = oldest_seq
+      self.next_seq = next_seq
+      self.latest_seq = latest_seq
+
+   def __len__(self):
+      return self.count
+
+   def column(self, name: str):
+      """Return the raw (scaled int) values of one field across the batch."""
+      return self.values[FIELD_NAMES.index(name)::FIELDS]
+
+   def mean(self, name: str) -> float:
+      """Return the mean of one field in its human readable unit."""
+      index = FIELD_NAMES.index(name)
+      return sum(self.values[index::FIELDS]) / self.count / FIELD_SCALES[index]
+
+   def timestamp(self, seconds: int) -> datetime:
+      """Convert a station timestamp to a datetime."""
+      return self.reference + timedelta(seconds=seconds)
+
+
+def decode_samples(payload: bytes) -> SampleBatch:
+   """
+   Decode a binary sample batch as served by the station's /bin endpoints.
+
+   Args:
+      payload: The response body
+
+   Returns:
+      SampleBatch: The decoded batch
+
+   Raises:
+      ValueError: If the payload is not a valid batch
+   """
+   if len(payload) < BINARY_HEADER_SIZE:
+      raise ValueError("Sample batch is shorter than its header")
+
+   magic, version, fields, count, epoch_year, oldest_seq, next_seq, latest_seq = \
+      struct.unpack_from(BINARY_HEADER_FORMAT, payload)
+   if magic != BINARY_MAGIC or version != BINARY_VERSION or fields != FIELDS:
+      raise ValueError(f"Unsupported sample batch {magic!r} v{version} with {fields} fields")
+
+   body = memoryview(payload)[BINARY_HEADER_SIZE:]
+   if len(body) != count * FIELDS * 4:
+      raise ValueError(f"Sample batch holds {len(body)} bytes for {count} samples")
+
+   if sys.byteorder == "little":
+      # the wire format is little-endian int32, so it can be used in place
+      values = body.cast("i")
+   else:
+      values = struct.unpack(f"<{count * FIELDS}i", body)
+
+   return SampleBatch(values, count, epoch_year, oldest_seq, next_seq, latest_seq)
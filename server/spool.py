@@ -0,0 +1,82 @@
+from typing import Dict, List, Tuple
+import json
+import sqlite3
+import threading
+
+
+class Spool:
+   """
+   Append-only, disk-backed queue of records on their way to PostgreSQL.
+
+   Records are kept in an SQLite database in WAL mode, so every append is a
+   cheap sequential write that survives a crash or a restart of the
+   collector. Records leave the spool only once they have been acknowledged,
+   i.e. after the database has committed them, and are handed out strictly
+   in the order they were appended.
+   """
+
+   def __init__(self, path: str):
+      """
+      Args:
+         path: Location of the spool file, ideally on a persistent volume
+      """
+      self.path = path
+      self._lock = threading.Lock()
+      self._db = sqlite3.connect(path, check_same_thread=False)
+      self._db.execute("PRAGMA journal_mode=WAL;")
+      # WAL + NORMAL survives a crash of the process, which is what we care about
+      self._db.execute("PRAGMA synchronous=NORMAL;")
+      with self._db:
+         self._db.execute("""
+            CREATE TABLE IF NOT EXISTS spool (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               record TEXT NOT NULL
+            );
+            """)
+
+   def __len__(self) -> int:
+      with self._lock:
+         return self._db.execute("SELECT COUNT(*) FROM spool;").fetchone()[0]
+
+   def append(self, records: List[Dict]) -> None:
+      """
+      Persist records at the end of the spool in a single transaction.
+
+      Args:
+         records: Column name to value mappings, values must be JSON serialisable
+      """
+      with self._lock:
+         with self._db:
+            self._db.executemany(
+               "INSERT INTO spool (record) VALUES (?);",
+               ((json.dumps(record),) for record in records))
+
+   def pending(self, limit: int) -> List[Tuple[int, Dict]]:
+      """
+      Return the oldest records that have not been acknowledged yet.
+
+      Args:
+         limit: Maximum number of records to return
+
+      Returns:
+         list: (spool id, record) pairs in the order they were appended
+      """
+      with self._lock:
+         rows = self._db.execute(
+            "SELECT id, record FROM spool ORDER BY id LIMIT ?;", (limit,)).fetchall()
+      return [(spool_id, json.loads(record)) for spool_id, record in rows]
+
+   def acknowledge(self, up_to_id: int) -> None:
+      """
+      Drop every record up to and including the given spool id.
+
+      Args:
+         up_to_id: Spool id of the last record that reached the database
+      """
+      with self._lock:
+         with self._db:
+            self._db.execute("DELETE FROM spool WHERE id <= ?;", (up_to_id,))
+
+   def close(self) -> None:
+      with self._lock:
+         self._db.close()
@@ -0,0 +1,242 @@
+from ttl_cache import TTLCache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict
+from urllib.parse import urlsplit
+import json
+import threading
+import time
+import requests
+import metrics
+
+DEFAULT_TTL = 2.0       # seconds a station response is served without asking the station again
+DEFAULT_STALE = 30.0    # further seconds it may be served while a fresh one is fetched
+MAX_ENTRIES = 1024
+UPSTREAM_TIMEOUT = 5.0  # seconds allowed for a request to a station
+
+PROXY_REQUESTS = metrics.Counter(
+   "collector_proxy_requests_total",
+   "Requests for station data by how they were answered (fresh, stale, fetched, coalesced)")
+PROXY_REVALIDATIONS = metrics.Counter(
+   "collector_proxy_revalidations_total", "Background fetches of stale station responses")
+
+
+class ProxiedResponse:
+   """A station response as kept in the cache, with the parts of requests.Response used here."""
+
+   def __init__(self, status_code: int, content_type: str, content: bytes):
+      self.status_code = status_code
+      self.content_type = content_type
+      self.content = content
+      self.fetched_at = time.monotonic()
+
+   def json(self):
+      return json.loads(self.content)
+
+   def age(self) -> float:
+      return time.monotonic() - self.fetched_at
+
+
+class _Flight:
+   """A fetch in progress, which callers asking for the same URL wait for."""
+
+   def __init__(self):
+      self.done = threading.Event()
+      self.response = None
+      self.error = None
+
+
+def _requests_fetch(url, endpoint, session, timeout):
+   getter = session.get if session is not None else requests.get
+   response = getter(url, timeout=timeout)
+   response.raise_for_status()
+   return response
+
+
+class StationProxy:
+   """
+   Caching, single-flight front of the stations.
+
+   A station can only serve one client at a time and every request costs it
+   a measurement, so however many consumers ask for the same URL at once,
+   only one request reaches the station and the others wait for its
+   response. Responses are then served from the cache for ttl seconds, and
+   for stale seconds more while a fresh one is fetched in the background
+   (stale-while-revalidate). Failed fetches are not cached, their error is
+   raised to every caller waiting for them.
+   """
+
+   def __init__(
+      self,
+      ttl: float = DEFAULT_TTL,
+      stale: float = DEFAULT_STALE,
+      max_entries: int = MAX_ENTRIES,
+      fetch: Callable | None = None
+   ):
+      """
+      Args:
+         ttl: Seconds a response is fresh
+         stale: Seconds after that a response may still be served while it is revalidated
+         max_entries: Number of URLs kept in the cache at most
+         fetch: Callable(url, endpoint, session, timeout) returning a
+            requests.Response and raising on errors, e.g. to record metrics
+            (default: a plain requests.get)
+      """
+      self.ttl = ttl
+      self.stale = stale
+      self._fetch = fetch or _requests_fetch
+      self._cache = TTLCache(max_entries=max_entries)
+      self._flights: Dict[str, _Flight] = {}
+      self._lock = threading.Lock()
+
+   def get(self, url: str, endpoint: str = "proxy", session=None, timeout: float = UPSTREAM_TIMEOUT,
+           allow_stale: bool = True, max_age: float | None = None) -> ProxiedResponse:
+      """
+      Return the response of a station for url, from the cache if it is recent enough.
+
+      Args:
+         url: The station URL, including any query string
+         endpoint: Name of the endpoint, passed on to fetch
+         session: Optional requests.Session for the fetch
+         timeout: Seconds allowed for the fetch
+         allow_stale: Whether a stale response may be returned while it is revalidated
+         max_age: Seconds a cached response may be old to be returned (default: the ttl);
+            0 always fetches, though still joining a fetch in progress and
+            leaving the response in the cache for others
+
+      Returns:
+         ProxiedResponse: The response
+
+      Raises:
+         requests.RequestException: If the station could not be fetched
+      """
+      cached = self._cache.get(url) if max_age != 0 else None
+      if cached is not None:
+         if cached.age() < (self.ttl if max_age is None else min(self.ttl, max_age)):
+            PROXY_REQUESTS.inc(result="fresh")
+            return cached
+         if allow_stale:
+            PROXY_REQUESTS.inc(result="stale")
+            self._revalidate(url, endpoint, timeout)
+            return cached
+      return self._fetch_once(url, endpoint, session, timeout)
+
+   def clear(self) -> None:
+      self._cache.clear()
+
+   def _fetch_once(self, url, endpoint, session, timeout) -> ProxiedResponse:
+      with self._lock:
+         flight = self._flights.get(url)
+         leader = flight is None
+         if leader:
+            flight = self._flights[url] = _Flight()
+
+      if not leader:
+         PROXY_REQUESTS.inc(result="coalesced")
+         flight.done.wait()
+         if flight.error is not None:
+            raise flight.error
+         return flight.response
+
+      PROXY_REQUESTS.inc(result="fetched")
+      try:
+         upstream = self._fetch(url, endpoint, session, timeout)
+         flight.response = ProxiedResponse(
+            upstream.status_code, upstream.headers.get("Content-Type", "application/octet-stream"),
+            upstream.content)
+         self._cache.put(url, flight.response, self.ttl + self.stale)
+         return flight.response
+      except Exception as e:
+         flight.error = e
+         raise
+      finally:
+         with self._lock:
+            del self._flights[url]
+         flight.done.set()
+
+   def _revalidate(self, url, endpoint, timeout) -> None:
+      with self._lock:
+         if url in self._flights:
+            return
+
+      def refresh():
+         try:
+            self._fetch_once(url, endpoint, None, timeout)
+         except Exception as e:
+            print(f"Error revalidating {url}: {e}")
+
+      PROXY_REVALIDATIONS.inc()
+      threading.Thread(target=refresh, name="proxy-revalidate", daemon=True).start()
+
+
+def station_base_url(url: str) -> str:
+   """The scheme and address of a station URL, without its path."""
+   parts = urlsplit(url)
+   return f"{parts.scheme}://{parts.netloc}"
+
+
+class _ProxyHandler(BaseHTTPRequestHandler):
+   """Serves GET /<station id>/<path> from the proxy, GET / lists the station ids."""
+
+   def do_GET(self):
+      proxy: StationProxy = self.server.proxy
+      stations: Dict[str, str] = self.server.stations
+      station_id, _, rest = self.path.lstrip("/").partition("/")
+      if not station_id:
+         self._send(200, "application/json", json.dumps(sorted(stations)).encode())
+         return
+      if station_id not in stations:
+         # only the configured stations, this is not an open proxy
+         self._send(404, "text/plain", b"Unknown station")
+         return
+
+      try:
+         response = proxy.get(f"{stations[station_id]}/{rest}")
+      except requests.Timeout:
+         self._send(504, "text/plain", b"Station timed out")
+         return
+      except requests.HTTPError as e:
+         # the station's own error, e.g. 404 for an unknown path
+         self._send(e.response.status_code, e.response.headers.get("Content-Type", "text/plain"),
+                    e.response.content)
+         return
+      except requests.RequestException as e:
+         self._send(502, "text/plain", str(e).encode())
+         return
+      self._send(response.status_code, response.content_type, response.content,
+                 age=int(response.age()))
+
+   def _send(self, status, content_type, body, age=None):
+      self.send_response(status)
+      self.send_header("Content-Type", content_type)
+      self.send_header("Content-Length", str(len(body)))
+      if age is not None:
+         self.send_header("Age", str(age))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def log_message(self, format, *args):
+      pass
+
+
+def serve(proxy: StationProxy, stations: Dict[str, str], port: int,
+          host: str = "0.0.0.0") -> ThreadingHTTPServer:
+   """
+   Serve the stations through the proxy at http://<host>:<port>/<station id>/<path>
+   from a background thread.
+
+   Args:
+      proxy: The StationProxy, shared with the collector so both count against one TTL
+      stations: Station id to station URL
+      port: Port to listen on
+      host: Address to listen on
+
+   Returns:
+      The server, shut it down with server.shutdown()
+   """
+   server = ThreadingHTTPServer((host, port), _ProxyHandler)
+   server.daemon_threads = True
+   server.proxy = proxy
+   server.stations = {station_id: station_base_url(url) for station_id, url in stations.items()}
+   threading.Thread(target=server.serve_forever, name="station-proxy", daemon=True).start()
+   print(f"Station proxy served on {host}:{port}")
+   return server
@@ -0,0 +1,57 @@
+import numpy as np
+from bme280_compensation import CALIBRATION_KEYS, compensate, recompensate_station, to_human_readable
+
+# the calibration of the simulator's BME280
+CALIBRATION = dict(zip(CALIBRATION_KEYS, (27504, 26435, -1000, 36477, -10685, 3024, 2855, 140, -7,
+                                          15500, -14600, 6000, 75, 362, 0, 313, 50, 30)))
+SWAPPED = dict(CALIBRATION, dig_T1=27704, dig_P1=36000)
+RAW = [(519888, 415148, 30000), (520100, 415000, 30100), (520300, 414900, 30200), (520500, 414800, 30300)]
+
+
+class _Connection:
+   """Stands in for a psycopg2 connection, serving calibrations (valid_from, dig_* ...) and raw rows."""
+
+   def __init__(self, calibrations, raw):
+      self.calibrations = calibrations
+      self.raw = raw
+
+   def cursor(self):
+      return self
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *exc):
+      return False
+
+   def execute(self, query, params=None):
+      pass
+
+   def fetchall(self):
+      return self.calibrations
+
+   def copy_expert(self, query, buffer):
+      for row in self.raw:
+         buffer.write(",".join(str(value) for value in row) + "\n")
+
+
+def _expected(calibration, raw):
+   return to_human_readable(*compensate(*zip(*raw), calibration))[0]
+
+
+def test_rows_use_the_calibration_in_effect_when_they_were_archived():
+   calibrations = [(1000, *CALIBRATION.values()), (2000, *SWAPPED.values())]
+   # the first row predates every calibration, the third is archived when the second one starts
+   archived = [500, 1500, 2000, 2500]
+   # station times from a clock that was never set, they play no part
+   raw = [(seq, 60 * seq, at, *words) for seq, (at, words) in enumerate(zip(archived, RAW))]
+
+   _, _, temperature, _, _ = recompensate_station(_Connection(calibrations, raw), "readings", "station")
+
+   np.testing.assert_array_equal(temperature[:2], _expected(CALIBRATION, RAW[:2]))
+   np.testing.assert_array_equal(temperature[2:], _expected(SWAPPED, RAW[2:]))
+   assert not np.array_equal(_expected(CALIBRATION, RAW[2:]), _expected(SWAPPED, RAW[2:]))
+
+
+def test_station_without_calibration():
+   assert recompensate_station(_Connection([], []), "readings", "station") is None
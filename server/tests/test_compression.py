@@ -0,0 +1,37 @@
+import math
+import random
+from datetime import datetime, timedelta
+import pytest
+from compression import Compressor, reconstruct
+
+
+def _record(minutes, **values):
+   moment = datetime(2026, 1, 1) + timedelta(minutes=minutes)
+   return {"timestamp": moment.strftime("%Y-%m-%d %H:%M:%S"), "station_id": "s", **values}
+
+
+def test_record_at_the_time_of_the_held_one_stores_both():
+   compressor = Compressor("swinging-door", {"temperature": 0.1})
+   assert compressor.feed(_record(0, temperature=20)) == [_record(0, temperature=20)]
+   assert compressor.feed(_record(10, temperature=20)) == []
+   stored = compressor.feed(_record(10, temperature=25))
+   assert stored == [_record(10, temperature=20), _record(10, temperature=25)]
+   assert compressor.flush() == []
+
+
+@pytest.mark.parametrize("method", ["deadband", "swinging-door"])
+def test_reconstruction_stays_within_the_bounds(method):
+   generator = random.Random(1)
+   series = [_record(10 * i, temperature=20 + 3 * math.sin(i / 72 * math.pi) + generator.gauss(0, 0.03),
+                     humidity=50 + 10 * math.sin(i / 50) + generator.gauss(0, 0.15))
+             for i in range(1000)]
+   compressor = Compressor(method, {"temperature": 0.1, "humidity": 0.5})
+   stored = [kept for record in series for kept in compressor.feed(dict(record))] + compressor.flush()
+   assert len(stored) < len(series)
+
+   times = [datetime.fromisoformat(record["timestamp"]) for record in stored]
+   for key, bound in compressor.bounds.items():
+      values = [record[key] for record in stored]
+      for record in series:
+         value = reconstruct(times, values, datetime.fromisoformat(record["timestamp"]), method)
+         assert abs(value - record[key]) <= bound + 1e-9
@@ -0,0 +1,106 @@
+import asyncio
+import struct
+import pytest
+from ingest import IngestServer
+from sample_format import BINARY_HEADER_FORMAT, BINARY_MAGIC, BINARY_VERSION, FIELDS
+
+
+class _Writer:
+   """Stands in for PostgresWriter, keeping the first record per station and time like the unique key."""
+
+   def __init__(self):
+      self.rows = {}
+      self.raw = []
+
+   def write(self, record, comment):
+      self.rows.setdefault((record["station_id"], record["timestamp"]), record)
+      return True
+
+   def write_raw_batch(self, station_id, batch):
+      self.raw.append((station_id, batch.count))
+      return True
+
+   def write_compression(self, station_id, method, bounds=None, max_gap=None):
+      return True
+
+
+def _batch(first_seq, count, first_time=3600, epoch_year=2026):
+   values = []
+   for i in range(count):
+      seq = first_seq + i
+      # seq, timestamp (10 s apart), board temp, temp, pressure, humidity, raw words
+      values += [seq, first_time + 10 * seq, 2500, 2000 + i, 1013 * 25600, 40 * 1024, 1, 2, 3]
+   header = struct.pack(BINARY_HEADER_FORMAT, BINARY_MAGIC, BINARY_VERSION, FIELDS, count, epoch_year,
+                        0, first_seq + count, first_seq + count - 1)
+   return header + struct.pack(f"<{len(values)}i", *values)
+
+
+def _ingest(server, payloads):
+   async def push():
+      return [await server.ingest_batch("station", payload) for payload in payloads]
+   try:
+      return asyncio.run(push())
+   finally:
+      server.close()
+
+
+def test_backlog_batches_in_the_same_second_are_all_kept():
+   writer = _Writer()
+   acks = _ingest(IngestServer(writer), [_batch(0, 120), _batch(120, 120), _batch(240, 120)])
+   assert acks == [120, 240, 360]
+   assert len(writer.rows) == 3
+
+
+def test_batch_resent_after_a_restart_maps_to_the_same_row():
+   writer = _Writer()
+   _ingest(IngestServer(writer), [_batch(0, 120)])
+   # a new listener has no acknowledgements yet and stores the batch again
+   _ingest(IngestServer(writer), [_batch(0, 120)])
+   assert len(writer.rows) == 1
+
+
+def test_batch_from_a_clock_that_was_never_set_is_refused():
+   writer = _Writer()
+   server = IngestServer(writer)
+   with pytest.raises(Exception, match="clock"):
+      _ingest(server, [_batch(0, 120, epoch_year=2021)])
+   assert "station" not in server.acknowledged
+   assert not writer.raw
+
+
+def test_batch_whose_raw_words_were_not_archived_is_not_acknowledged():
+   writer = _Writer()
+   writer.write_raw_batch = lambda station_id, batch: False
+   server = IngestServer(writer)
+   with pytest.raises(Exception, match="archive"):
+      _ingest(server, [_batch(0, 120)])
+   assert "station" not in server.acknowledged
+   assert not writer.rows
+
+
+def test_unexpected_error_is_answered_with_500():
+   writer = _Writer()
+
+   def fail(station_id, batch):
+      raise RuntimeError("boom")
+   writer.write_raw_batch = fail
+   server = IngestServer(writer)
+
+   async def post():
+      listener = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+      port = listener.sockets[0].getsockname()[1]
+      async with listener:
+         reader, stream = await asyncio.open_connection("127.0.0.1", port)
+         payload = _batch(0, 10)
+         stream.write(f"POST /ingest?station=s HTTP/1.1\r\nContent-Length: {len(payload)}\r\n\r\n".encode())
+         stream.write(payload)
+         await stream.drain()
+         reply = await reader.read(-1)
+         stream.close()
+         return reply
+   try:
+      reply = asyncio.run(post())
+   finally:
+      server.close()
+   assert reply.startswith(b"HTTP/1.1 500 ")
+   assert "s" not in server.acknowledged
@@ -0,0 +1,46 @@
+import threading
+import requests
+import mc_sensing
+from station_proxy import StationProxy
+
+
+def _respond(body):
+   def fetch(url, endpoint, session, timeout):
+      response = requests.Response()
+      response.status_code = 200
+      response._content = body
+      return response
+   return fetch
+
+
+def test_malformed_reading_is_skipped(monkeypatch):
+   monkeypatch.setattr(mc_sensing, "PROXY", StationProxy(fetch=_respond(b'{"temperature": ')))
+   monkeypatch.setattr(mc_sensing, "print", lambda *args: None, raising=False)
+   before = mc_sensing.STATION_FAILURES.value(station="station", endpoint="current", reason="parse")
+   assert mc_sensing.query_environmental_sensors("http://station/sensors") == {}
+   assert mc_sensing.STATION_FAILURES.value(station="station", endpoint="current", reason="parse") == before + 1
+
+
+def test_station_still_running_after_the_cycle_gets_a_new_session(monkeypatch):
+   release = threading.Event()
+
+   def average(url, station_timeout, session, *args):
+      if url == "http://slow/sensors":
+         release.wait(5)
+      return {"temperature": 20.0}
+   monkeypatch.setattr(mc_sensing, "_average_station", average)
+   monkeypatch.setattr(mc_sensing, "REQUEST_TIMEOUT", 0)
+   monkeypatch.setattr(mc_sensing, "print", lambda *args: None, raising=False)
+   sessions = {url: requests.Session() for url in ("http://fast/sensors", "http://slow/sensors")}
+   fast, slow = sessions["http://fast/sensors"], sessions["http://slow/sensors"]
+   closed = threading.Event()
+   monkeypatch.setattr(slow, "close", closed.set)
+
+   results = mc_sensing.perform_fleet_sensor_data_averaging(list(sessions), station_timeout=0.2, sessions=sessions)
+
+   assert results == {"http://fast/sensors": {"temperature": 20.0}, "http://slow/sensors": None}
+   assert sessions["http://fast/sensors"] is fast
+   assert sessions["http://slow/sensors"] is not slow
+   assert not closed.is_set()
+   release.set()
+   assert closed.wait(5)
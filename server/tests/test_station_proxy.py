@@ -0,0 +1,27 @@
+import requests
+from station_proxy import StationProxy
+
+
+def _fetcher(calls):
+   def fetch(url, endpoint, session, timeout):
+      calls.append(url)
+      response = requests.Response()
+      response.status_code = 200
+      response._content = b'{"reading": %d}' % len(calls)
+      return response
+   return fetch
+
+
+def test_fresh_responses_are_shared():
+   calls = []
+   proxy = StationProxy(ttl=60, fetch=_fetcher(calls))
+   assert proxy.get("http://station/sensors").json() == proxy.get("http://station/sensors").json()
+   assert len(calls) == 1
+
+
+def test_max_age_0_always_reaches_the_station_and_refreshes_the_cache():
+   calls = []
+   proxy = StationProxy(ttl=60, fetch=_fetcher(calls))
+   readings = [proxy.get("http://station/sensors", max_age=0).json()["reading"] for _ in range(5)]
+   assert readings == [1, 2, 3, 4, 5]
+   assert proxy.get("http://station/sensors").json()["reading"] == 5
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from typing import Any, Hashable
+import threading
+import time
+
+_MISSING = object()
+
+
+class TTLCache:
+   """
+   Thread-safe LRU cache whose entries also expire after a time to live.
+
+   Once max_entries is reached the least recently used entry makes room for
+   the new one; expired entries are dropped when they are looked up.
+   """
+
+   def __init__(self, max_entries: int = 256, max_bytes: int | None = None):
+      """
+      Args:
+         max_entries: Number of entries kept at most
+         max_bytes: Total len() of the cached values kept at most, for
+            caches of encoded responses (optional)
+      """
+      self.max_entries = max_entries
+      self.max_bytes = max_bytes
+      self.hits = 0
+      self.misses = 0
+      self._entries = OrderedDict()   # key -> (expires_at, value)
+      self._bytes = 0
+      self._lock = threading.Lock()
+
+   def __len__(self) -> int:
+      with self._lock:
+         return len(self._entries)
+
+   def get(self, key: Hashable, default: Any = None) -> Any:
+      """Return the value cached for key, or default if it is missing or expired."""
+      with self._lock:
+         entry = self._entries.get(key, _MISSING)
+         if entry is _MISSING or entry[0] <= time.monotonic():
+            if entry is not _MISSING:
+               self._remove(key)
+            self.misses += 1
+            return default
+         self._entries.move_to_end(key)
+         self.hits += 1
+         return entry[1]
+
+   def put(self, key: Hashable, value: Any, ttl: float) -> None:
+      """Cache value under key for ttl seconds."""
+      with self._lock:
+         if key in self._entries:
+            self._remove(key)
+         self._entries[key] = (time.monotonic() + ttl, value)
+         if self.max_bytes is not None:
+            self._bytes += len(value)
+         while self._entries and (
+               len(self._entries) > self.max_entries or
+               (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            self._remove(next(iter(self._entries)))
+
+   def clear(self) -> None:
+      with self._lock:
+         self._entries.clear()
+         self._bytes = 0
+
+   def _remove(self, key: Hashable) -> None:
+      # call with _lock held
+      _, value = self._entries.pop(key)
+      if self.max_bytes is not None:
+         self._bytes -= len(value)
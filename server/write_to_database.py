@@ -1,7 +1,461 @@
-from typing import Dict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List
+import csv
+import io
+import re
+import threading
+import time
 # install as psycopg2-binary
 # see https://stackoverflow.com/a/73175055 on the difference between psycopg2 and its *-binary counterpart
 import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+import metrics
+
+COLUMNS = ("date_time", "temperature", "humidity", "pressure", "comment", "board_temperature",
+           "station_id")
+INSERT_COLUMNS = ", ".join(COLUMNS)
+# a reading is identified by its station and time, a raw sample also by its sequence number
+# (the partition key date_time has to be part of any unique key of a partitioned table)
+READINGS_KEY = ("station_id", "date_time")
+RAW_KEY = ("station_id", "seq", "date_time")
+COPY_THRESHOLD = 1000    # batches at least this large are sent with COPY instead of INSERT
+MAX_RETRY_DELAY = 60.0   # upper bound of the wait between automatic flushes after failures
+PARTITION_MONTHS_AHEAD = 3          # monthly partitions are created this far ahead
+PARTITION_CHECK_INTERVAL = 3600.0   # seconds between checks for missing or expired partitions
+# rollup table suffix to the date_trunc unit of its buckets
+ROLLUPS = {"hourly": "hour", "daily": "day"}
+ROLLUP_METRICS = ("temperature", "humidity", "pressure", "board_temperature")
+
+DB_SECONDS = metrics.Histogram(
+   "collector_db_seconds", "Time spent on the database per stage (connect, insert, commit)")
+DB_ROWS_WRITTEN = metrics.Counter("collector_db_rows_written_total", "Records committed to the database")
+DB_ROWS_DUPLICATE = metrics.Counter(
+   "collector_db_rows_duplicate_total", "Records skipped because their station and time were stored already")
+DB_FLUSH_FAILURES = metrics.Counter("collector_db_flush_failures_total", "Flushes that failed")
+DB_FLUSH_RETRIES = metrics.Counter(
+   "collector_db_flush_retries_total", "Flushes attempted while the previous one had failed")
+SPOOLED_ROWS = metrics.Counter("collector_spooled_rows_total", "Records persisted to the spool")
+QUEUED_ROWS = metrics.Gauge(
+   "collector_db_queued_rows", "Records waiting to be written, in memory or in the spool")
+CALIBRATION_KEYS = (
+   "dig_T1", "dig_T2", "dig_T3",
+   "dig_P1", "dig_P2", "dig_P3", "dig_P4", "dig_P5", "dig_P6", "dig_P7", "dig_P8", "dig_P9",
+   "dig_H1", "dig_H2", "dig_H3", "dig_H4", "dig_H5", "dig_H6",
+)
+
+
+def _create_table_query(table_name: str) -> str:
+   # partitioned by month on date_time; a partitioned table cannot have a
+   # primary key without the partition key, and id is not needed as one.
+   # Rows are unique per station and time, so a record sent twice is stored once.
+   return f"""
+      CREATE TABLE IF NOT EXISTS {table_name} (
+         id BIGSERIAL,
+         station_id TEXT,
+         date_time TIMESTAMP NOT NULL,
+         temperature FLOAT,
+         humidity FLOAT,
+         pressure FLOAT,
+         board_temperature FLOAT,
+         comment TEXT,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+         CONSTRAINT {table_name}_key UNIQUE ({", ".join(READINGS_KEY)})
+      ) PARTITION BY RANGE (date_time);
+      """ + _partitioned_table_extras_query(table_name)
+
+
+def _create_raw_tables_query(table_name: str) -> str:
+   # raw BME280 words, to be compensated again later with the calibration in effect
+   # when they were archived (created_at, on the database's clock like the calibrations)
+   return f"""
+      CREATE TABLE IF NOT EXISTS {table_name}_raw (
+         station_id TEXT NOT NULL,
+         seq BIGINT NOT NULL,
+         date_time TIMESTAMP NOT NULL,
+         raw_temperature INTEGER,
+         raw_pressure INTEGER,
+         raw_humidity INTEGER,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+         CONSTRAINT {table_name}_raw_key UNIQUE ({", ".join(RAW_KEY)})
+      ) PARTITION BY RANGE (date_time);
+      """ + _partitioned_table_extras_query(f"{table_name}_raw")
+
+
+def _create_calibration_table_query(table_name: str) -> str:
+   # every calibration a station sent, valid from when it was first received
+   # until the next one (a swapped sensor brings its own); valid_from is on the
+   # database's clock, the station's may not be set
+   return f"""
+      CREATE TABLE IF NOT EXISTS {table_name}_calibration (
+         station_id TEXT NOT NULL,
+         valid_from TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+         {", ".join(f"{key.lower()} INTEGER" for key in CALIBRATION_KEYS)},
+         PRIMARY KEY (station_id, valid_from)
+      );
+      """
+
+
+def _create_compression_table_query(table_name: str) -> str:
+   # how the readings of each station are compressed from "since" on, so
+   # readers know how to reconstruct them (see compression.reconstruct)
+   return f"""
+      CREATE TABLE IF NOT EXISTS {table_name}_compression (
+         station_id TEXT NOT NULL,
+         since TIMESTAMP NOT NULL,
+         method TEXT NOT NULL,
+         {", ".join(f"{metric}_bound FLOAT" for metric in ROLLUP_METRICS)},
+         max_gap FLOAT,
+         PRIMARY KEY (station_id, since)
+      );
+      """
+
+
+def _partitioned_table_extras_query(table_name: str) -> str:
+   # The default partition catches rows outside the monthly partitions (e.g. a
+   # station whose clock was never set), so they never block a batch.
+   # Rows arrive in time order, which is what a BRIN index needs to stay
+   # selective while being a tiny fraction of the size of a B-tree.
+   return f"""
+      CREATE TABLE IF NOT EXISTS {table_name}_default PARTITION OF {table_name} DEFAULT;
+      CREATE INDEX IF NOT EXISTS {table_name}_date_time_brin ON {table_name} USING BRIN (date_time);
+      """
+
+
+def _create_rollup_tables(cursor, table_name: str, refill: bool = False) -> None:
+   """
+   Create the hourly and daily rollup tables, filling a new one (or, with
+   refill, every one) from the readings already stored. From then on they
+   are kept up to date by _update_rollups in the same transaction that
+   inserts the readings.
+
+   Every bucket holds, per metric, the count, sum, min, max and sum of
+   squares of the readings, so means and standard deviations of any
+   combination of buckets can be derived without going back to the readings.
+   The aggregates are over the stored rows, so with compression (see
+   compression.Compressor) the counts are of stored rows, not of readings.
+   """
+   for suffix, unit in ROLLUPS.items():
+      rollup = f"{table_name}_{suffix}"
+      cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (rollup,))
+      exists = cursor.fetchone()[0]
+      cursor.execute(f"""
+         CREATE TABLE IF NOT EXISTS {rollup} (
+            station_id TEXT NOT NULL,
+            bucket TIMESTAMP NOT NULL,
+            {", ".join(
+               f"{metric}_count BIGINT NOT NULL, {metric}_sum FLOAT, {metric}_min FLOAT, "
+               f"{metric}_max FLOAT, {metric}_sumsq FLOAT"
+               for metric in ROLLUP_METRICS)},
+            PRIMARY KEY (station_id, bucket)
+         );
+         """)
+      if exists and refill:
+         cursor.execute(f"DELETE FROM {rollup};")
+      if not exists or refill:
+         cursor.execute(f"""
+            INSERT INTO {rollup}
+            SELECT COALESCE(station_id, ''), date_trunc('{unit}', date_time),
+               {", ".join(
+                  f"COUNT({metric}), SUM({metric}), MIN({metric}), MAX({metric}), "
+                  f"SUM({metric} * {metric})"
+                  for metric in ROLLUP_METRICS)}
+            FROM {table_name} GROUP BY 1, 2;
+            """)
+
+
+def _bucket_start(moment, unit: str) -> datetime:
+   if not isinstance(moment, datetime):
+      moment = datetime.fromisoformat(moment)
+   moment = moment.replace(minute=0, second=0, microsecond=0)
+   if unit == "day":
+      moment = moment.replace(hour=0)
+   return moment
+
+
+def _update_rollups(cursor, table_name: str, rows: List[tuple]) -> None:
+   """Add rows ordered as COLUMNS to the hourly and daily rollups."""
+   if not rows:
+      return
+   indexes = [COLUMNS.index(metric) for metric in ROLLUP_METRICS]
+   station_index = COLUMNS.index("station_id")
+   date_index = COLUMNS.index("date_time")
+
+   for suffix, unit in ROLLUPS.items():
+      buckets = {}
+      for row in rows:
+         key = (row[station_index] or "", _bucket_start(row[date_index], unit))
+         aggregates = buckets.get(key)
+         if aggregates is None:
+            # count, sum, min, max, sum of squares per metric
+            aggregates = buckets[key] = [[0, 0., None, None, 0.] for _ in indexes]
+         for aggregate, index in zip(aggregates, indexes):
+            value = row[index]
+            if value is None:
+               continue
+            aggregate[0] += 1
+            aggregate[1] += value
+            aggregate[2] = value if aggregate[2] is None else min(aggregate[2], value)
+            aggregate[3] = value if aggregate[3] is None else max(aggregate[3], value)
+            aggregate[4] += value * value
+
+      updates = []
+      for metric in ROLLUP_METRICS:
+         updates += [
+            f"{metric}_count = r.{metric}_count + EXCLUDED.{metric}_count",
+            f"{metric}_sum = COALESCE(r.{metric}_sum, 0) + COALESCE(EXCLUDED.{metric}_sum, 0)",
+            f"{metric}_min = LEAST(r.{metric}_min, EXCLUDED.{metric}_min)",
+            f"{metric}_max = GREATEST(r.{metric}_max, EXCLUDED.{metric}_max)",
+            f"{metric}_sumsq = COALESCE(r.{metric}_sumsq, 0) + COALESCE(EXCLUDED.{metric}_sumsq, 0)",
+         ]
+      execute_values(
+         cursor,
+         f"""INSERT INTO {table_name}_{suffix} AS r VALUES %s
+         ON CONFLICT (station_id, bucket) DO UPDATE SET {", ".join(updates)}""",
+         [(station_id, bucket, *(value for aggregate in aggregates for value in aggregate))
+          for (station_id, bucket), aggregates in buckets.items()],
+         page_size=len(buckets))
+
+
+def _add_months(month: datetime, count: int) -> datetime:
+   index = month.year * 12 + month.month - 1 + count
+   return datetime(index // 12, index % 12 + 1, 1)
+
+
+def _partition_name(table_name: str, month: datetime) -> str:
+   return f"{table_name}_y{month.year:04d}m{month.month:02d}"
+
+
+def create_partitions(cursor, table_name: str, first: datetime, last: datetime) -> None:
+   """
+   Create the monthly partitions of a table from first to last (inclusive).
+
+   Rows of a month without a partition land in the default partition (e.g.
+   from a station clock running ahead), and PostgreSQL refuses to create the
+   month's partition while they are there; they are moved into it instead.
+
+   Args:
+      cursor: A cursor of an open connection
+      table_name: The partitioned table
+      first: Any moment in the first month to create
+      last: Any moment in the last month to create
+   """
+   default = f"{table_name}_default"
+   month = datetime(first.year, first.month, 1)
+   while month <= last:
+      following = _add_months(month, 1)
+      partition = _partition_name(table_name, month)
+      create = f"""CREATE TABLE IF NOT EXISTS {partition}
+         PARTITION OF {table_name} FOR VALUES FROM (%s) TO (%s);"""
+      cursor.execute(
+         f"""SELECT to_regclass(%s) IS NULL AND EXISTS (
+            SELECT 1 FROM {default} WHERE date_time >= %s AND date_time < %s);""",
+         (partition, month, following))
+      if cursor.fetchone()[0]:
+         print(f"Moving the rows of '{default}' into the new partition '{partition}'.")
+         cursor.execute(f"ALTER TABLE {table_name} DETACH PARTITION {default};")
+         cursor.execute(create, (month, following))
+         cursor.execute(
+            f"""WITH moved AS (
+               DELETE FROM {default} WHERE date_time >= %s AND date_time < %s RETURNING *)
+            INSERT INTO {table_name} SELECT * FROM moved;""",
+            (month, following))
+         cursor.execute(f"ALTER TABLE {table_name} ATTACH PARTITION {default} DEFAULT;")
+      else:
+         cursor.execute(create, (month, following))
+      month = following
+
+
+def drop_partitions_before(cursor, table_name: str, cutoff: datetime) -> List[str]:
+   """
+   Drop the monthly partitions of a table that only hold rows older than cutoff.
+
+   Dropping a whole partition is instant and leaves nothing behind to vacuum,
+   unlike deleting the same rows one by one.
+
+   Args:
+      cursor: A cursor of an open connection
+      table_name: The partitioned table
+      cutoff: Rows older than this may go; a partition is only dropped if
+         all of its range lies before it
+
+   Returns:
+      list: Names of the dropped partitions
+   """
+   cursor.execute(
+      """SELECT child.relname FROM pg_inherits
+         JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+         WHERE pg_inherits.inhparent = to_regclass(%s);""", (table_name,))
+   dropped = []
+   for (name,) in cursor.fetchall():
+      match = re.search(r"_y(\d{4})m(\d{2})$", name)
+      if match is None:
+         continue
+      month = datetime(int(match.group(1)), int(match.group(2)), 1)
+      if _add_months(month, 1) <= cutoff:
+         cursor.execute(f"DROP TABLE {name};")
+         dropped.append(name)
+   return dropped
+
+
+def _migrate_unpartitioned(cursor, table_name: str, create_query: str) -> None:
+   """
+   Create a partitioned table, moving the rows of an older, unpartitioned
+   table of the same name into it.
+   """
+   cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (table_name,))
+   row = cursor.fetchone()
+   if row is None or row[0] != "r":
+      cursor.execute(create_query)
+      return
+
+   print(f"Moving table '{table_name}' to a partitioned table.")
+   legacy = f"{table_name}_unpartitioned"
+   cursor.execute(f"ALTER TABLE {table_name} RENAME TO {legacy};")
+   cursor.execute(create_query)
+   cursor.execute(f"SELECT MIN(date_time), MAX(date_time) FROM {legacy};")
+   first, last = cursor.fetchone()
+   if first is not None:
+      create_partitions(cursor, table_name, first, last)
+   cursor.execute(
+      """SELECT column_name FROM information_schema.columns
+         WHERE table_schema = current_schema() AND table_name = %s AND column_name <> 'id'
+         ORDER BY ordinal_position;""",
+      (legacy.lower(),))
+   columns = ", ".join(name for (name,) in cursor.fetchall())
+   # duplicates of the legacy table are left behind
+   cursor.execute(f"INSERT INTO {table_name} ({columns}) SELECT {columns} FROM {legacy} ON CONFLICT DO NOTHING;")
+   cursor.execute(f"DROP TABLE {legacy};")
+
+
+def _add_unique_key(cursor, table_name: str, key: tuple) -> int:
+   """
+   Add the unique key to a table created before there was one, deleting the
+   duplicate rows it would reject first (the oldest copy of a row is kept).
+
+   Returns:
+      int: Number of duplicate rows deleted
+   """
+   cursor.execute(
+      "SELECT 1 FROM pg_constraint WHERE conrelid = to_regclass(%s) AND conname = %s;",
+      (table_name, f"{table_name}_key".lower()))
+   if cursor.fetchone() is not None:
+      return 0
+
+   columns = ", ".join(key)
+   cursor.execute(f"""
+      DELETE FROM {table_name} t USING (
+         SELECT tableoid, ctid, row_number() OVER (PARTITION BY {columns} ORDER BY created_at) AS copy
+         FROM {table_name}) d
+      WHERE t.tableoid = d.tableoid AND t.ctid = d.ctid AND d.copy > 1;""")
+   deleted = cursor.rowcount
+   if deleted:
+      print(f"Deleted {deleted} duplicate rows from '{table_name}'.")
+   cursor.execute(f"ALTER TABLE {table_name} ADD CONSTRAINT {table_name}_key UNIQUE ({columns});")
+   return deleted
+
+
+def _lock_schema(cursor, table_name: str) -> None:
+   """
+   Serialise schema changes of a table's family of tables (the collector and
+   ingest services both create and maintain them) until the transaction ends.
+   """
+   cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (f"{table_name} schema",))
+
+
+def _create_tables(cursor, table_name: str) -> None:
+   _lock_schema(cursor, table_name)
+   _migrate_unpartitioned(cursor, table_name, _create_table_query(table_name))
+   _migrate_unpartitioned(cursor, f"{table_name}_raw", _create_raw_tables_query(table_name))
+   deduplicated = _add_unique_key(cursor, table_name, READINGS_KEY)
+   _add_unique_key(cursor, f"{table_name}_raw", RAW_KEY)
+   cursor.execute(_create_calibration_table_query(table_name))
+   # the rollups counted the duplicates too
+   _create_rollup_tables(cursor, table_name, refill=deduplicated > 0)
+   cursor.execute(_create_compression_table_query(table_name))
+   now = datetime.now()
+   for partitioned in (table_name, f"{table_name}_raw"):
+      create_partitions(cursor, partitioned, now, _add_months(now, PARTITION_MONTHS_AHEAD))
+
+
+def _record_to_row(data_records: Dict[str, float], comment: str) -> tuple:
+   # same order as COLUMNS
+   return (data_records["timestamp"],
+           data_records["temperature"],
+           data_records["humidity"],
+           data_records["pressure"],
+           comment,
+           data_records["board_temperature"],
+           data_records.get("station_id"))
+
+
+def _insert_rows(cursor, table_name: str, rows: List[tuple]) -> List[tuple]:
+   """
+   Insert rows ordered as COLUMNS, skipping those whose station and time are
+   stored already, so a batch can be sent again without creating duplicates.
+
+   Large batches are sent with COPY FROM STDIN into a temporary staging
+   table first, and merged from there.
+
+   Returns:
+      list: The rows actually inserted, ordered as COLUMNS
+   """
+   conflict = f"ON CONFLICT ({', '.join(READINGS_KEY)}) DO NOTHING RETURNING {INSERT_COLUMNS}"
+   if len(rows) < COPY_THRESHOLD:
+      return execute_values(
+         cursor,
+         f"INSERT INTO {table_name} ({INSERT_COLUMNS}) VALUES %s {conflict}",
+         rows,
+         page_size=len(rows),
+         fetch=True)
+
+   # one per connection, emptied by every commit or rollback
+   staging = f"{table_name}_staging"
+   cursor.execute(
+      f"""CREATE TEMPORARY TABLE IF NOT EXISTS {staging} ON COMMIT DELETE ROWS AS
+      SELECT {INSERT_COLUMNS} FROM {table_name} WITH NO DATA;""")
+   buffer = io.StringIO()
+   # None is written as an empty unquoted field, which COPY reads as NULL
+   csv.writer(buffer).writerows(rows)
+   buffer.seek(0)
+   cursor.copy_expert(
+      f"COPY {staging} ({INSERT_COLUMNS}) FROM STDIN WITH (FORMAT csv)", buffer)
+   cursor.execute(
+      f"INSERT INTO {table_name} ({INSERT_COLUMNS}) SELECT {INSERT_COLUMNS} FROM {staging} {conflict};")
+   return cursor.fetchall()
+
+
+def connect_to_postgres(
+   host: str,
+   database: str,
+   user: str,
+   password: str,
+   port: int = 5432
+):
+   """
+   Open a connection to the PostgreSQL database.
+
+   The connection can be handed to write_data_to_postgres to keep it warm
+   between writes, e.g. when running as a long-lived daemon.
+
+   Args:
+      host: Database host address
+      database: Database name
+      user: Username for database connection
+      password: Password for database connection
+      port: Database port (default: 5432)
+
+   Returns:
+      The psycopg2 connection
+   """
+   return psycopg2.connect(
+      host=host,
+      database=database,
+      user=user,
+      password=password,
+      port=port
+   )
 
 
 def create_table_if_not_exists(
@@ -42,21 +496,8 @@ def create_table_if_not_exists(
       
       cursor = connection.cursor()
       
-      # Create table if it does not exist
-      create_table_query = f"""
-      CREATE TABLE IF NOT EXISTS {table_name} (
-         id SERIAL PRIMARY KEY,
-         date_time TIMESTAMP NOT NULL,
-         temperature FLOAT,
-         humidity FLOAT,
-         pressure FLOAT,
-         board_temperature FLOAT,
-         comment TEXT,
-         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-      );
-      """
-      
-      cursor.execute(create_table_query)
+      # Create the tables and their partitions if they do not exist
+      _create_tables(cursor, table_name)
       
       # Commit the transaction
       connection.commit()
@@ -92,7 +533,8 @@ def write_data_to_postgres(
    table_name: str,
    data_records: Dict[str, float] | None,
    comment: str,
-   port: int = 5432
+   port: int = 5432,
+   connection=None
 ) -> bool:
    """
    Connect to PostgreSQL database and write data records.
@@ -106,6 +548,7 @@ def write_data_to_postgres(
       data_records: Dictionary of the record to relate columns with the data
       comment: Additional information associated with the record
       port: Database port (default: 5432)
+      connection: An open connection to reuse; it is left open afterwards (optional)
       
    Returns:
       bool: True if successful, False otherwise
@@ -114,34 +557,28 @@ def write_data_to_postgres(
    if data_records is None:
       return True
    
-   connection = None
+   owns_connection = connection is None
    cursor = None
    
    try:
-      # Establish connection
-      connection = psycopg2.connect(
-         host=host,
-         database=database,
-         user=user,
-         password=password,
-         port=port
-      )
+      # Establish connection, unless the caller keeps one warm for us
+      if owns_connection:
+         connection = connect_to_postgres(host, database, user, password, port)
       
       cursor = connection.cursor()
       
       # Insert data records
       insert_query = f"""
-      INSERT INTO {table_name} (date_time, temperature, humidity, pressure, comment, board_temperature)
-      VALUES (%s, %s, %s, %s, %s, %s);
+      INSERT INTO {table_name} ({INSERT_COLUMNS})
+      VALUES (%s, %s, %s, %s, %s, %s, %s)
+      ON CONFLICT ({", ".join(READINGS_KEY)}) DO NOTHING RETURNING id;
       """
       
-      cursor.execute(insert_query, 
-                     (data_records["timestamp"], 
-                        data_records["temperature"],
-                        data_records["humidity"],
-                        data_records["pressure"],
-                        comment,
-                        data_records["board_temperature"]))
+      row = _record_to_row(data_records, comment)
+      cursor.execute(insert_query, row)
+      # a record stored before is not counted twice
+      if cursor.fetchone() is not None:
+         _update_rollups(cursor, table_name, [row])
       
       # Commit the transaction
       connection.commit()
@@ -165,5 +602,464 @@ def write_data_to_postgres(
       # Clean up connections
       if cursor:
          cursor.close()
-      if connection:
+      if connection and owns_connection:
          connection.close()
+
+
+class PostgresWriter:
+   """
+   Buffered writer that keeps a pool of warm connections to the database.
+
+   Records are queued and written in batches once max_batch_size records are
+   pending or the oldest pending record is max_batch_age seconds old,
+   whichever comes first. A background thread takes care of the age
+   threshold, so a trickle of records is not held back.
+
+   Without a spool, records are queued in memory and the ones that fail to be
+   written stay queued (up to max_pending) for the next flush. With a spool,
+   every record is persisted to disk before anything else happens and is
+   dropped from the spool only after the database committed it, so an outage
+   or a restart loses nothing; the backlog is replayed in large COPY batches.
+   """
+
+   def __init__(
+      self,
+      host: str,
+      database: str,
+      user: str,
+      password: str,
+      table_name: str,
+      port: int = 5432,
+      min_connections: int = 1,
+      max_connections: int = 4,
+      max_batch_size: int = 1000,
+      max_batch_age: float = 5.0,
+      max_pending: int = 100000,
+      spool=None,
+      replay_batch_size: int = 50000,
+      retention_months: int | None = None
+   ):
+      """
+      Args:
+         host: Database host address
+         database: Database name
+         user: Username for database connection
+         password: Password for database connection
+         table_name: The name of the table to write data to
+         port: Database port (default: 5432)
+         min_connections: Connections kept open in the pool between flushes
+         max_connections: Upper bound of connections opened at the same time
+         max_batch_size: Number of queued records that triggers a flush
+         max_batch_age: Seconds the oldest queued record may wait before a flush
+         max_pending: Number of queued records kept in memory while the database is failing
+         spool: A spool.Spool that persists records until they are committed (optional)
+         replay_batch_size: Number of spooled records written per transaction
+         retention_months: Months of data to keep, older monthly partitions
+            are dropped (default: keep everything)
+      """
+      self.table_name = table_name
+      self.max_batch_size = max_batch_size
+      self.max_batch_age = max_batch_age
+      self.max_pending = max_pending
+      self.spool = spool
+      self.replay_batch_size = replay_batch_size
+      self.retention_months = retention_months
+
+      self._connection_args = dict(
+         host=host, database=database, user=user, password=password, port=port)
+      self._min_connections = min_connections
+      self._max_connections = max_connections
+      self._pool = None
+      # ThreadedConnectionPool raises PoolError when it runs dry, so callers
+      # beyond max_connections wait for a connection to be returned instead
+      self._connection_slots = threading.BoundedSemaphore(max_connections)
+      self._pool_lock = threading.Lock()
+
+      self._buffer: List[tuple] = []
+      self._queued = 0
+      self._oldest = None
+      self._buffer_lock = threading.Lock()
+      # serialises flushes, so batches reach the database in order
+      self._flush_lock = threading.Lock()
+      # automatic flushes back off while the database keeps failing
+      self._retry_delay = 0.
+      self._retry_at = None
+      self._partitions_checked = None
+
+      if self.spool is not None and len(self.spool) > 0:
+         # left over from a previous run, replay it with the first flush
+         print(f"Found {len(self.spool)} spooled records waiting for the database.")
+         self._queued = len(self.spool)
+         self._oldest = time.monotonic() - self.max_batch_age
+
+      self._closed = threading.Event()
+      self._flusher = threading.Thread(
+         target=self._flush_periodically, name="postgres-writer", daemon=True)
+      self._flusher.start()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      self.close()
+
+   @contextmanager
+   def connection(self):
+      """
+      Borrow a connection from the pool, committing on success.
+
+      The pool is created on first use, so a database that is down while the
+      writer is built does not stop the caller from starting up. Connections
+      that broke while borrowed are discarded instead of returned to the pool.
+      When all max_connections are borrowed, this waits for one to come back.
+      """
+      with DB_SECONDS.time(stage="connect"):
+         self._connection_slots.acquire()
+         try:
+            with self._pool_lock:
+               if self._pool is None:
+                  self._pool = ThreadedConnectionPool(
+                     self._min_connections, self._max_connections, **self._connection_args)
+            pool = self._pool
+            connection = pool.getconn()
+         except Exception:
+            self._connection_slots.release()
+            raise
+      try:
+         yield connection
+         with DB_SECONDS.time(stage="commit"):
+            connection.commit()
+      except Exception:
+         if not connection.closed:
+            connection.rollback()
+         raise
+      finally:
+         pool.putconn(connection, close=bool(connection.closed))
+         self._connection_slots.release()
+
+   def create_table_if_not_exists(self) -> bool:
+      """
+      Create the tables if they do not exist, using a pooled connection.
+
+      Returns:
+         bool: True if successful, False otherwise
+      """
+      try:
+         with self.connection() as connection, connection.cursor() as cursor:
+            _create_tables(cursor, self.table_name)
+         self._partitions_checked = time.monotonic()
+         print(f"Table '{self.table_name}' is ready (created or already exists).")
+         return True
+      except Exception as e:
+         print(f"Database error: {e}")
+         return False
+
+   def maintain_partitions(self) -> bool:
+      """
+      Create the monthly partitions of the coming months and, if a retention
+      is configured, drop the partitions that fell out of it.
+
+      Called by flush about once every PARTITION_CHECK_INTERVAL seconds.
+
+      Returns:
+         bool: True if successful, False otherwise
+      """
+      now = datetime.now()
+      try:
+         with self.connection() as connection, connection.cursor() as cursor:
+            _lock_schema(cursor, self.table_name)
+            for table_name in (self.table_name, f"{self.table_name}_raw"):
+               create_partitions(cursor, table_name, now, _add_months(now, PARTITION_MONTHS_AHEAD))
+               if self.retention_months is not None:
+                  cutoff = _add_months(datetime(now.year, now.month, 1), -self.retention_months)
+                  for name in drop_partitions_before(cursor, table_name, cutoff):
+                     print(f"Dropped partition '{name}' (older than {self.retention_months} months).")
+         self._partitions_checked = time.monotonic()
+         return True
+      except Exception as e:
+         print(f"Database error: {e}")
+         return False
+
+   def write_raw_batch(self, station_id: str, batch) -> bool:
+      """
+      Archive the raw BME280 words of a sample batch right away.
+
+      Args:
+         station_id: The station the batch came from
+         batch: A sample_format.SampleBatch
+
+      Returns:
+         bool: True if successful, False otherwise
+      """
+      rows = [
+         (station_id, seq, batch.timestamp(seconds), raw_temp, raw_press, raw_hum)
+         for seq, seconds, raw_temp, raw_press, raw_hum in zip(
+            batch.column("seq"), batch.column("timestamp"), batch.column("raw_temperature"),
+            batch.column("raw_pressure"), batch.column("raw_humidity"))
+      ]
+      if not rows:
+         return True
+      try:
+         with self.connection() as connection, connection.cursor() as cursor:
+            execute_values(
+               cursor,
+               f"""INSERT INTO {self.table_name}_raw
+               (station_id, seq, date_time, raw_temperature, raw_pressure, raw_humidity) VALUES %s
+               ON CONFLICT ({", ".join(RAW_KEY)}) DO NOTHING""",
+               rows,
+               page_size=len(rows))
+         return True
+      except Exception as e:
+         print(f"Database error: {e}")
+         return False
+
+   def write_calibration(self, station_id: str, calibration: Dict[str, int]) -> bool:
+      """
+      Record the calibration block of a station, valid from now on, unless
+      it is the one recorded last.
+
+      Args:
+         station_id: The station the calibration belongs to
+         calibration: dig_* name to value, as served by the station
+
+      Returns:
+         bool: True if successful, False otherwise
+      """
+      columns = [key.lower() for key in CALIBRATION_KEYS]
+      values = tuple(calibration[key] for key in CALIBRATION_KEYS)
+      try:
+         with self.connection() as connection, connection.cursor() as cursor:
+            cursor.execute(
+               f"""SELECT {", ".join(columns)} FROM {self.table_name}_calibration
+               WHERE station_id = %s ORDER BY valid_from DESC LIMIT 1;""", (station_id,))
+            if cursor.fetchone() == values:
+               return True
+            cursor.execute(
+               f"""INSERT INTO {self.table_name}_calibration (station_id, {", ".join(columns)})
+               VALUES (%s, {", ".join(["%s"] * len(columns))});""",
+               (station_id, *values))
+         return True
+      except Exception as e:
+         print(f"Database error: {e}")
+         return False
+
+   def write_compression(self, station_id: str, method: str, bounds: Dict[str, float] | None = None,
+                         max_gap: float | None = None) -> bool:
+      """
+      Record how the readings of a station are compressed from now on, unless
+      that is what was recorded last.
+
+      Args:
+         station_id: The station
+         method: "deadband", "swinging-door" or "none"
+         bounds: Quantity to its error bound
+         max_gap: Seconds after which a reading is stored regardless
+
+      Returns:
+         bool: True if successful, False otherwise
+      """
+      bounds = bounds or {}
+      settings = (method, *(bounds.get(metric) for metric in ROLLUP_METRICS), max_gap)
+      columns = ["method"] + [f"{metric}_bound" for metric in ROLLUP_METRICS] + ["max_gap"]
+      try:
+         with self.connection() as connection, connection.cursor() as cursor:
+            cursor.execute(
+               f"""SELECT {", ".join(columns)} FROM {self.table_name}_compression
+               WHERE station_id = %s ORDER BY since DESC LIMIT 1;""", (station_id,))
+            latest = cursor.fetchone()
+            # stations without an entry were never compressed
+            if latest == settings or (latest is None and method == "none"):
+               return True
+            cursor.execute(
+               f"""INSERT INTO {self.table_name}_compression (station_id, since, {", ".join(columns)})
+               VALUES (%s, %s, {", ".join(["%s"] * len(columns))});""",
+               (station_id, datetime.now(), *settings))
+         return True
+      except Exception as e:
+         print(f"Database error: {e}")
+         return False
+
+   def write(self, data_records: Dict[str, float] | None, comment: str) -> bool:
+      """
+      Queue a record for writing, flushing if a threshold has been reached.
+
+      Args:
+         data_records: Dictionary of the record to relate columns with the data
+         comment: Additional information associated with the record
+
+      Returns:
+         bool: False if a flush was triggered and failed, True otherwise
+      """
+      if data_records is None:
+         return True
+
+      row = _record_to_row(data_records, comment)
+      with self._buffer_lock:
+         if self.spool is not None:
+            self.spool.append([dict(zip(COLUMNS, row))])
+            SPOOLED_ROWS.inc()
+         else:
+            self._buffer.append(row)
+         if self._oldest is None:
+            self._oldest = time.monotonic()
+         self._queued += 1
+         QUEUED_ROWS.set(self._queued)
+         full = self._queued >= self.max_batch_size and not self._backing_off()
+
+      if full:
+         return self.flush()
+      return True
+
+   def flush_if_due(self) -> bool:
+      """
+      Flush if the oldest queued record has waited longer than max_batch_age.
+
+      Returns:
+         bool: False if a flush was due and failed, True otherwise
+      """
+      with self._buffer_lock:
+         due = self._oldest is not None and not self._backing_off() and \
+            time.monotonic() - self._oldest >= self.max_batch_age
+      if due:
+         return self.flush()
+      return True
+
+   def flush(self) -> bool:
+      """
+      Write all queued records, in as few round trips as possible.
+
+      An explicit flush is always attempted, but after a failure the
+      automatic flushes (by write and the background thread) wait for an
+      exponentially growing delay before trying again.
+
+      Returns:
+         bool: True if successful (or nothing to write), False otherwise
+      """
+      with self._flush_lock:
+         if self._partitions_checked is None or \
+               time.monotonic() - self._partitions_checked >= PARTITION_CHECK_INTERVAL:
+            self.maintain_partitions()
+
+         with self._buffer_lock:
+            queued = self._queued
+            retry = self._retry_at is not None
+         if retry:
+            DB_FLUSH_RETRIES.inc()
+         written = DB_ROWS_WRITTEN.value()
+         start = time.perf_counter()
+
+         if self.spool is not None:
+            success = self._flush_spool()
+         else:
+            success = self._flush_buffer()
+
+         with self._buffer_lock:
+            if success:
+               self._retry_delay = 0.
+               self._retry_at = None
+            else:
+               self._retry_delay = min(
+                  MAX_RETRY_DELAY, max(self.max_batch_age, self._retry_delay * 2))
+               self._retry_at = time.monotonic() + self._retry_delay
+            QUEUED_ROWS.set(self._queued)
+         if not success:
+            DB_FLUSH_FAILURES.inc()
+         if queued or not success:
+            metrics.log_event(
+               "flush", ok=success, queued=queued, written=DB_ROWS_WRITTEN.value() - written,
+               seconds=round(time.perf_counter() - start, 4), retry=retry)
+         return success
+
+   def close(self):
+      """Flush whatever is still queued and close all pooled connections."""
+      if self._closed.is_set():
+         return
+      self._closed.set()
+      self._flusher.join()
+      self.flush()
+      if self._pool is not None:
+         self._pool.closeall()
+         self._pool = None
+
+   def _flush_buffer(self) -> bool:
+      with self._buffer_lock:
+         rows, self._buffer = self._buffer, []
+         oldest, self._oldest = self._oldest, None
+         self._queued = 0
+
+      if not rows:
+         return True
+
+      try:
+         with self.connection() as connection, connection.cursor() as cursor:
+            with DB_SECONDS.time(stage="insert"):
+               inserted = _insert_rows(cursor, self.table_name, rows)
+               _update_rollups(cursor, self.table_name, inserted)
+         self._count_written(len(rows), len(inserted))
+         return True
+
+      except Exception as e:
+         print(f"Database error: {e}")
+         self._requeue(rows, oldest)
+         return False
+
+   def _flush_spool(self) -> bool:
+      with self._buffer_lock:
+         self._queued = 0
+         self._oldest = None
+
+      written = 0
+      try:
+         while True:
+            batch = self.spool.pending(self.replay_batch_size)
+            if not batch:
+               break
+
+            rows = [tuple(record.get(column) for column in COLUMNS) for _, record in batch]
+            with self.connection() as connection, connection.cursor() as cursor:
+               with DB_SECONDS.time(stage="insert"):
+                  inserted = _insert_rows(cursor, self.table_name, rows)
+                  _update_rollups(cursor, self.table_name, inserted)
+            # a crash right here replays the batch once more on the next start,
+            # where its rows are skipped as duplicates
+            self.spool.acknowledge(batch[-1][0])
+            self._count_written(len(rows), len(inserted))
+            written += len(rows)
+         return True
+
+      except Exception as e:
+         print(f"Database error: {e}")
+         if written:
+            print(f"Inserted {written} records before the error, the rest stay spooled.")
+         with self._buffer_lock:
+            self._queued = len(self.spool)
+            if self._oldest is None:
+               self._oldest = time.monotonic()
+         return False
+
+   def _count_written(self, sent: int, inserted: int) -> None:
+      DB_ROWS_WRITTEN.inc(inserted)
+      DB_ROWS_DUPLICATE.inc(sent - inserted)
+      if sent > inserted:
+         print(f"Successfully inserted {inserted} records into the database, "
+               f"{sent - inserted} were stored already.")
+      else:
+         print(f"Successfully inserted {inserted} records into the database.")
+
+   def _backing_off(self) -> bool:
+      # call with _buffer_lock held
+      return self._retry_at is not None and time.monotonic() < self._retry_at
+
+   def _requeue(self, rows: List[tuple], oldest):
+      with self._buffer_lock:
+         self._buffer = rows + self._buffer
+         self._oldest = oldest
+         overflow = len(self._buffer) - self.max_pending
+         if overflow > 0:
+            print(f"Write queue is full, dropping the {overflow} oldest records.")
+            del self._buffer[:overflow]
+         self._queued = len(self._buffer)
+
+   def _flush_periodically(self):
+      while not self._closed.wait(self.max_batch_age / 2):
+         self.flush_if_due()
@@ -0,0 +1,185 @@
+"""
+Stand-ins for the MicroPython modules and the hardware the firmware in src/
+talks to, so that the firmware code itself can run under CPython.
+
+install() must be called before anything from src/ is imported.
+"""
+import asyncio
+import math
+import os
+import random
+import struct
+import sys
+import time
+import types
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+
+# Calibration of a real BME280 (the datasheet's compensation example uses the
+# same temperature and pressure coefficients)
+BME280_CALIBRATION = {
+    "dig_T1": 27504, "dig_T2": 26435, "dig_T3": -1000,
+    "dig_P1": 36477, "dig_P2": -10685, "dig_P3": 3024, "dig_P4": 2855, "dig_P5": 140,
+    "dig_P6": -7, "dig_P7": 15500, "dig_P8": -14600, "dig_P9": 6000,
+    "dig_H1": 75, "dig_H2": 362, "dig_H3": 0, "dig_H4": 313, "dig_H5": 50, "dig_H6": 30,
+}
+# Raw ADC words that compensate to about 25 C, 1000 hPa and 45 % with the calibration above
+RAW_TEMPERATURE = 519888
+RAW_PRESSURE = 415148
+RAW_HUMIDITY = 27000
+BME280_CHIP_ID = 0x60
+
+
+class FakeBME280Bus:
+    """
+    An I2C bus with a single BME280 on it, emulated at the register level.
+
+    Every read of the data registers produces a new conversion: the raw
+    words follow a slow daily cycle plus a little noise, offset per sensor,
+    so that the real driver compensates them to plausible, changing values.
+    """
+
+    def __init__(self, address=0x77, calibration=None, seed=None):
+        self.address = address
+        self.calibration = dict(BME280_CALIBRATION if calibration is None else calibration)
+        self.reads = 0
+        self.writes = 0
+        self._random = random.Random(seed)
+        self._offsets = (self._random.randint(-20000, 20000),
+                         self._random.randint(-3000, 3000),
+                         self._random.randint(-4000, 4000))
+        self._registers = bytearray(256)
+        self._registers[0xD0] = BME280_CHIP_ID
+        self._load_calibration()
+
+    def _load_calibration(self):
+        c = self.calibration
+        self._registers[0x88:0xA2] = struct.pack(
+            "<HhhHhhhhhhhhBB", c["dig_T1"], c["dig_T2"], c["dig_T3"],
+            c["dig_P1"], c["dig_P2"], c["dig_P3"], c["dig_P4"], c["dig_P5"],
+            c["dig_P6"], c["dig_P7"], c["dig_P8"], c["dig_P9"], 0, c["dig_H1"])
+        h4, h5 = c["dig_H4"], c["dig_H5"]
+        self._registers[0xE1:0xE8] = struct.pack(
+            "<hBBBBb", c["dig_H2"], c["dig_H3"], (h4 >> 4) & 0xFF,
+            (h4 & 0xF) | ((h5 & 0xF) << 4), (h5 >> 4) & 0xFF, c["dig_H6"])
+
+    def _convert(self):
+        day = math.sin(2 * math.pi * (time.time() % 86400) / 86400)
+        noise = self._random.gauss
+        raw_temp = int(RAW_TEMPERATURE + self._offsets[0] + 15000 * day + noise(0, 200))
+        raw_press = int(RAW_PRESSURE + self._offsets[1] - 500 * day + noise(0, 30))
+        raw_hum = int(RAW_HUMIDITY + self._offsets[2] - 2000 * day + noise(0, 50))
+        self._registers[0xF7:0xFF] = bytes((
+            (raw_press >> 12) & 0xFF, (raw_press >> 4) & 0xFF, (raw_press << 4) & 0xF0,
+            (raw_temp >> 12) & 0xFF, (raw_temp >> 4) & 0xFF, (raw_temp << 4) & 0xF0,
+            (raw_hum >> 8) & 0xFF, raw_hum & 0xFF))
+
+    def _check(self, address):
+        if address != self.address:
+            raise OSError(19)   # ENODEV, as MicroPython reports a missing device
+
+    def readfrom_mem(self, address, register, count):
+        self._check(address)
+        self.reads += 1
+        if register <= 0xF7 < register + count:
+            self._convert()
+        return bytes(self._registers[register:register + count])
+
+    def readfrom_mem_into(self, address, register, buffer):
+        self._check(address)
+        self.reads += 1
+        if register <= 0xF7 < register + len(buffer):
+            self._convert()
+        buffer[:] = self._registers[register:register + len(buffer)]
+
+    def writeto_mem(self, address, register, data):
+        self._check(address)
+        self.writes += 1
+        self._registers[register:register + len(data)] = data
+
+    def scan(self):
+        return [self.address]
+
+
+class FakeADC:
+    """ADC channel 4 reads the RP2040/RP2350 temperature sensor at about 27 C."""
+
+    def __init__(self, channel, seed=None):
+        self.channel = channel
+        self._random = random.Random(seed)
+
+    def read_u16(self):
+        # 0.706 V at 27 C, -1.721 mV per degree
+        volts = 0.706 - 0.001721 * self._random.gauss(0, 0.5)
+        return int(volts / 3.3 * 65535)
+
+
+class FakePin:
+    OUT = 1
+    IN = 0
+
+    def __init__(self, *args, **kwargs):
+        self._value = 0
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def toggle(self):
+        self._value ^= 1
+
+
+class FakeWDT:
+
+    def __init__(self, timeout=8000):
+        self.timeout = timeout
+        self.fed = 0
+
+    def feed(self):
+        self.fed += 1
+
+
+def _fake_i2c(*args, **kwargs):
+    return FakeBME280Bus()
+
+
+def _ticks_ms():
+    return int(time.monotonic() * 1000)
+
+
+def _ticks_us():
+    return int(time.monotonic() * 1000000)
+
+
+def install():
+    """
+    Make the firmware importable under CPython: put src/ on the path, alias
+    ustruct, provide a machine module and add the MicroPython time and
+    asyncio functions.
+    """
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+    sys.modules.setdefault("ustruct", struct)
+
+    machine = types.ModuleType("machine")
+    machine.ADC = FakeADC
+    machine.I2C = _fake_i2c
+    machine.Pin = FakePin
+    machine.WDT = FakeWDT
+    machine.reset = lambda: sys.exit("machine.reset()")
+    sys.modules.setdefault("machine", machine)
+
+    time.ticks_ms = _ticks_ms
+    time.ticks_us = _ticks_us
+    time.ticks_diff = lambda end, start: end - start
+    time.ticks_add = lambda ticks, delta: ticks + delta
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    time.sleep_us = lambda us: time.sleep(us / 1000000)
+    asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
@@ -0,0 +1,207 @@
+"""
+Run a fleet of simulated stations on localhost, without any hardware.
+
+Every station runs the real firmware code from src/ (serve_client,
+handle_request, read_sensors, SampleRing and the BME280 driver) against a
+fake I2C bus and ADC, each on its own port. Latency, failures and timeouts
+can be injected to see how the collector copes with a misbehaving fleet.
+
+    python3 simulator/station_simulator.py --stations 200 --base-port 9000 \
+        --latency 0.05 0.5 --failure-rate 0.02 --timeout-rate 0.01
+
+With --push the stations also push their samples to an ingest listener
+(server/ingest.py), as the firmware does with PUSH_HOST set.
+"""
+import fake_hardware
+fake_hardware.install()
+
+import argparse
+import asyncio
+import random
+import signal
+
+import http_stuff
+from bme280 import BME280, BME280_MODE_NORMAL, BME280_STANDBY_62_5
+from board_temp_sensor import BoardTempSensor
+from push import Pusher
+from sample_ring import SampleRing
+
+
+class SimulatedStation:
+    """One station: its own sensors, ring buffer and listening port."""
+
+    def __init__(self, port, seed=None, ring_capacity=360, interval_ms=10000):
+        self.port = port
+        self.bus = fake_hardware.FakeBME280Bus(seed=seed)
+        self.bme = BME280(i2c=self.bus, address=self.bus.address,
+                          power_mode=BME280_MODE_NORMAL, standby=BME280_STANDBY_62_5)
+        self.board = BoardTempSensor()
+        self.board.sensor_temp = fake_hardware.FakeADC(4, seed=seed)
+        self.ring = SampleRing(capacity=ring_capacity, interval_ms=interval_ms)
+        self.requests = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.server = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/sensors".format(self.port)
+
+
+class FaultInjector:
+    """
+    Decides how each request is answered.
+
+    Args:
+        latency: (min, max) seconds added before a request is handled
+        failure_rate: share of connections closed without a response
+        timeout_rate: share of connections left hanging for hang seconds
+        hang: seconds a hanging connection is kept open
+    """
+
+    def __init__(self, latency=(0.0, 0.0), failure_rate=0.0, timeout_rate=0.0, hang=30.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self._random = random.Random(seed)
+
+    async def serve(self, station, reader, writer, client_timeout=3):
+        station.requests += 1
+        roll = self._random.random()
+        if roll < self.timeout_rate:
+            # accept the connection but never answer, like a station stuck in a long I2C read
+            station.timeouts += 1
+            await asyncio.sleep(self.hang)
+            writer.close()
+            return
+        if roll < self.timeout_rate + self.failure_rate:
+            # drop the connection, like a station that reset mid-request
+            station.failures += 1
+            writer.close()
+            return
+        low, high = self.latency
+        if high > 0:
+            await asyncio.sleep(self._random.uniform(low, high))
+        await http_stuff.serve_client(reader, writer, station.bme, station.board,
+                                      ring=station.ring, timeout=client_timeout)
+
+
+async def sample_stations(stations, period_ms=100):
+    """Fill every station's ring buffer on its own schedule, as the firmware does."""
+    while True:
+        for station in stations:
+            station.ring.sample_if_due(station.bme, station.board)
+        await asyncio.sleep(period_ms / 1000)
+
+
+async def report(stations, period):
+    while True:
+        await asyncio.sleep(period)
+        print("requests: {}, failures: {}, timeouts: {}".format(
+            sum(s.requests for s in stations), sum(s.failures for s in stations),
+            sum(s.timeouts for s in stations)))
+
+
+async def push_staggered(pusher, delay):
+    """Run a station's pusher, offset so the fleet does not push all at once."""
+    await asyncio.sleep(delay)
+    await pusher.run()
+
+
+async def run_fleet(count, base_port=9000, host="127.0.0.1", faults=None, interval_ms=10000,
+                    report_every=60, started=None, push=None, push_period_ms=600000):
+    """
+    Start count stations on consecutive ports and serve them until cancelled.
+
+    Args:
+        count: Number of stations
+        base_port: Port of the first station
+        host: Address to listen on
+        faults: A FaultInjector, None for well-behaved stations
+        interval_ms: Sampling interval of the ring buffers
+        report_every: Seconds between request statistics printouts, 0 for none
+        started: Optional callback receiving the list of stations once they listen
+        push: Optional (host, port) of an ingest listener the stations push to
+        push_period_ms: Time between two pushes of a station
+    """
+    faults = faults or FaultInjector()
+    stations = [SimulatedStation(base_port + i, seed=base_port + i, interval_ms=interval_ms)
+                for i in range(count)]
+    for station in stations:
+        def on_client(reader, writer, station=station):
+            return faults.serve(station, reader, writer)
+        station.server = await asyncio.start_server(on_client, host, station.port, backlog=16)
+    print("{} stations listening on {}:{}-{}".format(count, host, base_port, base_port + count - 1))
+    if started is not None:
+        started(stations)
+
+    tasks = [asyncio.create_task(sample_stations(stations))]
+    if push is not None:
+        for i, station in enumerate(stations):
+            pusher = Pusher(station.ring, station.bme, push[0], push[1],
+                            station_id="sim-{}".format(station.port), period_ms=push_period_ms)
+            tasks.append(asyncio.create_task(push_staggered(pusher, push_period_ms / 1000 * i / count)))
+    if report_every:
+        tasks.append(asyncio.create_task(report(stations, report_every)))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        for station in stations:
+            station.server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of stations on localhost.")
+    parser.add_argument("--stations", type=int, default=100, help="number of stations (default: %(default)s)")
+    parser.add_argument("--base-port", type=int, default=9000, help="port of the first station (default: %(default)s)")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    parser.add_argument("--latency", type=float, nargs=2, default=(0.0, 0.0), metavar=("MIN", "MAX"),
+                        help="seconds of latency added to every request (default: none)")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="share of requests dropped without a response (default: %(default)s)")
+    parser.add_argument("--timeout-rate", type=float, default=0.0,
+                        help="share of requests never answered (default: %(default)s)")
+    parser.add_argument("--hang", type=float, default=30.0,
+                        help="seconds an unanswered request is kept open (default: %(default)s)")
+    parser.add_argument("--interval-ms", type=int, default=10000,
+                        help="sampling interval of the history ring (default: %(default)s)")
+    parser.add_argument("--push", metavar="HOST:PORT",
+                        help="also push the samples to the ingest listener at HOST:PORT")
+    parser.add_argument("--push-period-ms", type=int, default=600000,
+                        help="time between two pushes of a station (default: %(default)s)")
+    parser.add_argument("--print-urls", action="store_true",
+                        help="print a URLS list for secrets.py once the stations listen")
+    parser.add_argument("--verbose", action="store_true", help="keep the firmware's per-request output")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        # the firmware prints a line per request, which drowns everything at fleet scale
+        http_stuff.print = lambda *args, **kwargs: None
+
+    def print_urls(stations):
+        if args.print_urls:
+            print("URLS = [\n{}\n]".format(",\n".join('    "{}"'.format(s.url) for s in stations)))
+
+    faults = FaultInjector(tuple(args.latency), args.failure_rate, args.timeout_rate, args.hang)
+    push = None
+    if args.push:
+        push_host, _, push_port = args.push.rpartition(":")
+        push = (push_host, int(push_port))
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(run_fleet(args.stations, args.base_port, args.host, faults,
+                                      args.interval_ms, started=print_urls, push=push,
+                                      push_period_ms=args.push_period_ms))
+    loop.add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        loop.run_until_complete(task)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
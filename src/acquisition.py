@@ -0,0 +1,137 @@
+import _thread
+import time
+from array import array
+import counters
+from bme280 import BME280
+from sample_ring import FIELDS, SEQ, TIMESTAMP, BOARD_TEMP, TEMPERATURE, PRESSURE, HUMIDITY, \
+    RAW_TEMPERATURE, RAW_PRESSURE, RAW_HUMIDITY
+
+
+class Acquisition:
+    """
+    Read the sensors on the second core, at a fixed cadence.
+
+    Every reading is written into the back one of two sample buffers (laid
+    out like a ring buffer sample), which is then swapped with the front one
+    under a lock. Readers copy the front buffer under the same lock, so they
+    always get a whole reading and never wait for the I2C bus or a conversion.
+
+    The stand-ins in .bme and .board answer like the sensors themselves, from
+    the latest reading, so the request handlers and the ring buffer can use
+    them unchanged.
+    """
+
+    def __init__(self, bme_sensor, board_sensor, period_ms=100):
+        """
+        Args:
+            bme_sensor: the BME280, only read from the second core once started
+            board_sensor: the BoardTempSensor, likewise
+            period_ms: time between two readings, at most the BME280's
+                measurement period to serve every conversion
+        """
+        self.bme_sensor = bme_sensor
+        self.board_sensor = board_sensor
+        self.period_ms = period_ms
+        self.readings = 0
+        self._buffers = (array("i", [0] * FIELDS), array("i", [0] * FIELDS))
+        self._front = 0     # only changed by the second core, under the lock
+        self._lock = _thread.allocate_lock()
+        self._reading = array("i", [0, 0, 0])
+        self._raw = array("i", [0, 0, 0])
+        self._running = False
+        self.bme = SnapshotBME280(self)
+        self.board = SnapshotBoardTemp(self)
+
+    def start(self):
+        """Take a first reading here, then keep reading on the second core"""
+        self._acquire()
+        self._running = True
+        _thread.start_new_thread(self._run, ())
+
+    def stop(self):
+        self._running = False
+
+    def read(self, sample):
+        """Copy the latest reading into sample (FIELDS ints) and return it"""
+        with self._lock:
+            front = self._buffers[self._front]
+            for i in range(FIELDS):
+                sample[i] = front[i]
+        return sample
+
+    def _acquire(self):
+        self.bme_sensor.read_compensated_data(self._reading, self._raw)
+        board_temperature = self.board_sensor.temperatureC()
+        back = self._buffers[1 - self._front]
+        back[SEQ] = self.readings
+        back[TIMESTAMP] = int(time.time())
+        back[BOARD_TEMP] = int(board_temperature * 100)
+        back[TEMPERATURE] = self._reading[0]
+        back[PRESSURE] = self._reading[1]
+        back[HUMIDITY] = self._reading[2]
+        back[RAW_TEMPERATURE] = self._raw[0]
+        back[RAW_PRESSURE] = self._raw[1]
+        back[RAW_HUMIDITY] = self._raw[2]
+        with self._lock:
+            self._front = 1 - self._front
+        self.readings += 1
+
+    def _run(self):
+        while self._running:
+            started = time.ticks_ms()
+            try:
+                self._acquire()
+            except Exception as e:
+                counters.count(counters.ACQUISITION_ERRORS)
+                print('Acquisition error:', e)
+            elapsed = time.ticks_diff(time.ticks_ms(), started)
+            if elapsed < self.period_ms:
+                time.sleep_ms(self.period_ms - elapsed)
+
+
+class SnapshotBME280:
+    """Answers like the BME280 driver, from the latest reading of an Acquisition"""
+
+    def __init__(self, acquisition):
+        self._acquisition = acquisition
+        self._sample = array("i", [0] * FIELDS)
+        self._shared = array("i", [0, 0, 0])
+
+    @property
+    def period_ms(self):
+        """readings only change this often"""
+        return self._acquisition.period_ms
+
+    def read_compensated_data(self, result=None, raw=None):
+        sample = self._acquisition.read(self._sample)
+        if result is None:
+            result = array("i", [0, 0, 0])
+        result[0] = sample[TEMPERATURE]
+        result[1] = sample[PRESSURE]
+        result[2] = sample[HUMIDITY]
+        if raw is not None:
+            raw[0] = sample[RAW_TEMPERATURE]
+            raw[1] = sample[RAW_PRESSURE]
+            raw[2] = sample[RAW_HUMIDITY]
+        return result
+
+    def read_shared_data(self):
+        return self.read_compensated_data(self._shared)
+
+    # the conversion to human readable values is the driver's own
+    environmental_parameters = BME280.environmental_parameters
+
+    def calibration(self):
+        # read once in the driver's constructor, no I2C involved
+        return self._acquisition.bme_sensor.calibration()
+
+
+class SnapshotBoardTemp:
+    """Answers like BoardTempSensor, from the latest reading of an Acquisition"""
+
+    def __init__(self, acquisition):
+        self._acquisition = acquisition
+        self._sample = array("i", [0] * FIELDS)
+
+    def temperatureC(self):
+        return self._acquisition.read(self._sample)[BOARD_TEMP] / 100
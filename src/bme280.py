@@ -47,8 +47,35 @@ BME280_OSAMPLE_4 = 3
 BME280_OSAMPLE_8 = 4
 BME280_OSAMPLE_16 = 5
 
+# Power modes
+BME280_MODE_SLEEP = 0
+BME280_MODE_FORCED = 1
+BME280_MODE_NORMAL = 3
+
+# Standby time between measurements in normal mode
+BME280_STANDBY_0_5 = 0
+BME280_STANDBY_62_5 = 1
+BME280_STANDBY_125 = 2
+BME280_STANDBY_250 = 3
+BME280_STANDBY_500 = 4
+BME280_STANDBY_1000 = 5
+BME280_STANDBY_10 = 6
+BME280_STANDBY_20 = 7
+_STANDBY_MS = (0.5, 62.5, 125, 250, 500, 1000, 10, 20)
+
+# IIR filter coefficients
+BME280_FILTER_OFF = 0
+BME280_FILTER_2 = 1
+BME280_FILTER_4 = 2
+BME280_FILTER_8 = 3
+BME280_FILTER_16 = 4
+
 BME280_REGISTER_CONTROL_HUM = 0xF2
 BME280_REGISTER_CONTROL = 0xF4
+BME280_REGISTER_CONFIG = 0xF5
+
+_OSAMPLE_MODES = (BME280_OSAMPLE_1, BME280_OSAMPLE_2, BME280_OSAMPLE_4,
+                  BME280_OSAMPLE_8, BME280_OSAMPLE_16)
 
 
 class BME280:
@@ -57,15 +84,51 @@ class BME280:
                  mode=BME280_OSAMPLE_1,
                  address=BME280_I2CADDR,
                  i2c=None,
+                 power_mode=BME280_MODE_FORCED,
+                 temperature_oversample=None,
+                 pressure_oversample=None,
+                 humidity_oversample=None,
+                 standby=BME280_STANDBY_0_5,
+                 iir_filter=BME280_FILTER_OFF,
+                 shared_read_ms=None,
                  **kwargs):
+        """
+            Args:
+                mode: oversampling of all channels, unless set per channel
+                power_mode: BME280_MODE_FORCED to trigger a conversion on every
+                read, or BME280_MODE_NORMAL to let the sensor convert
+                continuously and only read out the latest result
+                temperature_oversample, pressure_oversample,
+                humidity_oversample: per channel oversampling (default: mode)
+                standby: one of BME280_STANDBY_*, the pause between two
+                conversions in normal mode
+                iir_filter: one of BME280_FILTER_*
+                shared_read_ms: how long one reading is shared by the
+                properties, default is the measurement period in normal mode
+                and 100 ms in forced mode
+        """
         # Check that mode is valid.
-        if mode not in [BME280_OSAMPLE_1, BME280_OSAMPLE_2, BME280_OSAMPLE_4,
-                        BME280_OSAMPLE_8, BME280_OSAMPLE_16]:
+        if mode not in _OSAMPLE_MODES:
             raise ValueError(
                 'Unexpected mode value {0}. Set mode to one of '
                 'BME280_ULTRALOWPOWER, BME280_STANDARD, BME280_HIGHRES, or '
                 'BME280_ULTRAHIGHRES'.format(mode))
         self._mode = mode
+        self._osrs_t = mode if temperature_oversample is None else temperature_oversample
+        self._osrs_p = mode if pressure_oversample is None else pressure_oversample
+        self._osrs_h = mode if humidity_oversample is None else humidity_oversample
+        for osrs in (self._osrs_t, self._osrs_p, self._osrs_h):
+            if osrs not in _OSAMPLE_MODES:
+                raise ValueError('Unexpected oversampling value {0}'.format(osrs))
+        if power_mode not in (BME280_MODE_FORCED, BME280_MODE_NORMAL):
+            raise ValueError('Unexpected power mode {0}'.format(power_mode))
+        if standby not in range(8):
+            raise ValueError('Unexpected standby value {0}'.format(standby))
+        if iir_filter not in range(5):
+            raise ValueError('Unexpected filter value {0}'.format(iir_filter))
+        self._power_mode = power_mode
+        self._standby = standby
+        self._iir_filter = iir_filter
         self.address = address
         if i2c is None:
             raise ValueError('An I2C object is required.')
@@ -79,7 +142,7 @@ class BME280:
             self.dig_P6, self.dig_P7, self.dig_P8, self.dig_P9, \
             _, self.dig_H1 = unpack("<HhhHhhhhhhhhBB", dig_88_a1)
 
-        self.dig_H2, self.dig_H3 = unpack("<hB", dig_e1_e7)
+        self.dig_H2, self.dig_H3 = unpack_from("<hB", dig_e1_e7)
         e4_sign = unpack_from("<b", dig_e1_e7, 3)[0]
         self.dig_H4 = (e4_sign << 4) | (dig_e1_e7[4] & 0xF)
 
@@ -88,8 +151,6 @@ class BME280:
 
         self.dig_H6 = unpack_from("<b", dig_e1_e7, 6)[0]
 
-        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL,
-                             bytearray([0x3F]))
         self.t_fine = 0
 
         # temporary data holders which stay allocated
@@ -97,6 +158,57 @@ class BME280:
         self._l8_barray = bytearray(8)
         self._l3_resultarray = array("i", [0, 0, 0])
 
+        # the last compensated reading, shared by the properties
+        self._shared = array("i", [0, 0, 0])
+        self._shared_at = None
+        if shared_read_ms is None:
+            shared_read_ms = self.measurement_period_ms() if power_mode == BME280_MODE_NORMAL else 100
+        self._shared_read_ms = shared_read_ms
+
+        # called with the readout and compensation time of every reading in
+        # microseconds, e.g. to keep statistics of the I2C timing
+        self.read_observer = None
+
+        self.configure()
+
+    def configure(self):
+        """ Writes the oversampling, standby, filter and power mode settings.
+
+            The config register is only writable in sleep mode, so the sensor
+            is put to sleep first. In normal mode the sensor then starts
+            converting continuously on its own.
+        """
+        self._l1_barray[0] = BME280_MODE_SLEEP
+        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL,
+                             self._l1_barray)
+        self._l1_barray[0] = self._standby << 5 | self._iir_filter << 2
+        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONFIG,
+                             self._l1_barray)
+        # ctrl_hum only takes effect after a write to ctrl_meas
+        self._l1_barray[0] = self._osrs_h
+        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL_HUM,
+                             self._l1_barray)
+        if self._power_mode == BME280_MODE_NORMAL:
+            self._l1_barray[0] = self._ctrl_meas(BME280_MODE_NORMAL)
+            self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL,
+                                 self._l1_barray)
+        self._shared_at = None
+
+    def _ctrl_meas(self, power_mode):
+        return self._osrs_t << 5 | self._osrs_p << 2 | power_mode
+
+    def measurement_time_us(self):
+        """ Returns the time one conversion takes with the current
+            oversampling, in microseconds. """
+        return (1250 + 2300 * (1 << self._osrs_t)
+                + 2300 * (1 << self._osrs_p) + 575
+                + 2300 * (1 << self._osrs_h) + 575)
+
+    def measurement_period_ms(self):
+        """ Returns how often new data is available in normal mode, in
+            milliseconds. """
+        return int(self.measurement_time_us() / 1000 + _STANDBY_MS[self._standby]) + 1
+
     def read_raw_data(self, result):
         """ Reads the raw (uncompensated) data from the sensor.
 
@@ -107,17 +219,15 @@ class BME280:
                 None
         """
 
-        self._l1_barray[0] = self._mode
-        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL_HUM,
-                             self._l1_barray)
-        self._l1_barray[0] = self._mode << 5 | self._mode << 2 | 1
-        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL,
-                             self._l1_barray)
-
-        sleep_time = 1250 + 2300 * (1 << self._mode)
-        sleep_time = sleep_time + 2300 * (1 << self._mode) + 575
-        sleep_time = sleep_time + 2300 * (1 << self._mode) + 575
-        time.sleep_us(sleep_time)  # Wait the required time
+        if self._power_mode == BME280_MODE_FORCED:
+            self._l1_barray[0] = self._osrs_h
+            self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL_HUM,
+                                 self._l1_barray)
+            self._l1_barray[0] = self._ctrl_meas(BME280_MODE_FORCED)
+            self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL,
+                                 self._l1_barray)
+            time.sleep_us(self.measurement_time_us())  # Wait the required time
+        # in normal mode the latest conversion is already in the data registers
 
         # burst readout from 0xF7 to 0xFE, recommended by datasheet
         self.i2c.readfrom_mem_into(self.address, 0xF7, self._l8_barray)
@@ -133,20 +243,31 @@ class BME280:
         result[1] = raw_press
         result[2] = raw_hum
 
-    def read_compensated_data(self, result=None):
+    def read_compensated_data(self, result=None, raw=None):
         """ Reads the data from the sensor and returns the compensated data.
 
             Args:
                 result: array of length 3 or alike where the result will be
                 stored, in temperature, pressure, humidity order. You may use
                 this to read out the sensor without allocating heap memory
+                raw: array of length 3 or alike where the raw (uncompensated)
+                words of the same reading will be stored, in the same order
 
             Returns:
                 array with temperature, pressure, humidity. Will be the one from
                 the result parameter if not None
         """
+        observer = self.read_observer
+        if observer is not None:
+            start = time.ticks_us()
         self.read_raw_data(self._l3_resultarray)
+        if observer is not None:
+            read_at = time.ticks_us()
         raw_temp, raw_press, raw_hum = self._l3_resultarray
+        if raw is not None:
+            raw[0] = raw_temp
+            raw[1] = raw_press
+            raw[2] = raw_hum
         # temperature
         var1 = ((raw_temp >> 3) - (self.dig_T1 << 1)) * (self.dig_T2 >> 11)
         var2 = (((((raw_temp >> 4) - self.dig_T1) *
@@ -187,16 +308,46 @@ class BME280:
             result[0] = temp
             result[1] = pressure
             result[2] = humidity
-            return result
+        else:
+            result = array("i", (temp, pressure, humidity))
 
-        return array("i", (temp, pressure, humidity))
+        if observer is not None:
+            observer(time.ticks_diff(read_at, start), time.ticks_diff(time.ticks_us(), read_at))
+        return result
     
+    def calibration(self):
+        """ Returns the factory calibration (dig_*) block of the sensor as a
+            dictionary, e.g. to compensate raw readings elsewhere. """
+        return {
+            "dig_T1": self.dig_T1, "dig_T2": self.dig_T2, "dig_T3": self.dig_T3,
+            "dig_P1": self.dig_P1, "dig_P2": self.dig_P2, "dig_P3": self.dig_P3,
+            "dig_P4": self.dig_P4, "dig_P5": self.dig_P5, "dig_P6": self.dig_P6,
+            "dig_P7": self.dig_P7, "dig_P8": self.dig_P8, "dig_P9": self.dig_P9,
+            "dig_H1": self.dig_H1, "dig_H2": self.dig_H2, "dig_H3": self.dig_H3,
+            "dig_H4": self.dig_H4, "dig_H5": self.dig_H5, "dig_H6": self.dig_H6,
+        }
+
+    def read_shared_data(self):
+        """ Returns the compensated data, reading the sensor only if the last
+            reading is older than shared_read_ms. This lets several
+            properties accessed together share a single read.
+
+            Returns:
+                array with temperature, pressure, humidity, owned by the driver
+        """
+        now = time.ticks_ms()
+        if self._shared_at is None or \
+                time.ticks_diff(now, self._shared_at) >= self._shared_read_ms:
+            self.read_compensated_data(self._shared)
+            self._shared_at = now
+        return self._shared
+
     def environmental_parameters(self):
         """
         Returns the human readable values as an array of
         [temperature (C), pressure (hPa), humidity (%)]
         """
-        t, p, h = self.read_compensated_data()
+        t, p, h = self.read_shared_data()
 
         p = p // 256
         pi = p // 100
@@ -210,7 +361,7 @@ class BME280:
     def values(self):
         """ human readable values """
 
-        t, p, h = self.read_compensated_data()
+        t, p, h = self.read_shared_data()
 
         p = p // 256
         pi = p // 100
@@ -223,19 +374,19 @@ class BME280:
     
     @property
     def temperature(self):
-        t, _, _ = self.read_compensated_data()
+        t, _, _ = self.read_shared_data()
         return t / 100
     
     @property
     def humidity(self):
-        _, _, h = self.read_compensated_data()
+        _, _, h = self.read_shared_data()
         hi = h // 1024
         hd = h * 100 // 1024 - hi * 100
         return hi + hd / 100
     
     @property
     def pressure(self):
-        _, p, _ = self.read_compensated_data()
+        _, p, _ = self.read_shared_data()
         p = p // 256
         pi = p // 100
         pd = p - pi * 100
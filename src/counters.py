@@ -0,0 +1,193 @@
+"""
+On-device counters, served as Prometheus text from /metrics.
+
+All storage is allocated once, at import. Recording a value only updates an
+array slot, and render() writes the text into a fixed buffer in place, so
+neither touches the heap on the request path. Counters wrap at 2**30, which
+Prometheus' rate() treats like a reset.
+"""
+import gc
+import time
+from array import array
+
+# Timings, each kept as count, whole seconds, remaining microseconds and the largest one seen
+REQUEST = 0             # accept to the last byte handed to the network stack
+BME280_READ = 1         # I2C readout, including the wait for a forced conversion
+BME280_COMPENSATE = 2   # integer compensation of one reading
+PUSH = 3                # one batch pushed to the ingest listener, until its acknowledgement
+_TIMING_NAMES = ("http_request", "bme280_read", "bme280_compensate", "push")
+_timings = array("i", [0] * (4 * len(_TIMING_NAMES)))
+
+# Counters
+BYTES_SENT = 0
+TIMEOUTS = 1            # clients that timed out, including ETIMEDOUT from the stack
+ERRORS = 2              # other connection and request errors
+GC_COLLECTIONS = 3      # collections seen as a drop of the allocated heap between two samples
+WATCHDOG_FEEDS = 4
+PUSH_FAILURES = 5
+ACQUISITION_ERRORS = 6  # failed readings of the acquisition loop on the second core
+_COUNTER_NAMES = ("http_bytes_sent_total", "http_timeouts_total", "http_errors_total",
+                  "gc_collections_total", "watchdog_feeds_total", "push_failures_total",
+                  "acquisition_errors_total")
+_counters = array("i", [0] * len(_COUNTER_NAMES))
+
+# Gauges
+HEAP_ALLOC = 0
+HEAP_FREE = 1
+HEAP_ALLOC_MAX = 2      # high-water mark of the allocated heap
+HEAP_FREE_MIN = 3       # low-water mark of the free heap
+WATCHDOG_TIMEOUT = 4
+WATCHDOG_GAP_MAX = 5    # longest time between two watchdog feeds
+WATCHDOG_MARGIN = 6     # how close that came to a reset
+UPTIME = 7
+_GAUGE_NAMES = ("heap_alloc_bytes", "heap_free_bytes", "heap_alloc_max_bytes", "heap_free_min_bytes",
+                "watchdog_timeout_ms", "watchdog_gap_max_ms", "watchdog_margin_ms", "uptime_seconds")
+_gauges = array("i", [0] * len(_GAUGE_NAMES))
+
+_WRAP = 0x3FFFFFFF
+_started = time.time()
+_last_alloc = -1
+_last_feed = -1
+
+# gc.mem_alloc and gc.mem_free only exist on MicroPython
+_mem_alloc = getattr(gc, "mem_alloc", None)
+_mem_free = getattr(gc, "mem_free", None)
+
+
+# The constant parts of the text, built once
+def _timing_text(name):
+    metric = "pico_" + name + "_seconds"
+    return (("# TYPE {0} summary\n{0}_count ".format(metric)).encode(),
+            "\n{}_sum ".format(metric).encode(),
+            "\n# TYPE pico_{0}_max_seconds gauge\npico_{0}_max_seconds ".format(name).encode())
+
+def _line_text(name, kind):
+    return "# TYPE pico_{0} {1}\npico_{0} ".format(name, kind).encode()
+
+_TIMING_TEXT = tuple(_timing_text(name) for name in _TIMING_NAMES)
+_COUNTER_TEXT = tuple(_line_text(name, "counter") for name in _COUNTER_NAMES)
+_GAUGE_TEXT = tuple(_line_text(name, "gauge") for name in _GAUGE_NAMES)
+
+_text = bytearray(sum(len(part) + 24 for parts in _TIMING_TEXT for part in parts)
+                  + sum(len(line) + 12 for line in _COUNTER_TEXT + _GAUGE_TEXT))
+_text_view = memoryview(_text)
+
+
+def observe(timing, elapsed_us):
+    """Add one duration, in microseconds, to a timing."""
+    base = timing * 4
+    _timings[base] = (_timings[base] + 1) & _WRAP
+    micros = _timings[base + 2] + elapsed_us
+    if micros >= 1000000:
+        _timings[base + 1] += micros // 1000000
+        micros %= 1000000
+    _timings[base + 2] = micros
+    if elapsed_us > _timings[base + 3]:
+        _timings[base + 3] = elapsed_us
+
+
+def observe_bme280(read_us, compensate_us):
+    """Read observer for the BME280 driver."""
+    observe(BME280_READ, read_us)
+    observe(BME280_COMPENSATE, compensate_us)
+
+
+def count(counter, amount=1):
+    _counters[counter] = (_counters[counter] + amount) & _WRAP
+
+
+def sample_heap():
+    """Update the heap gauges and their high-water marks."""
+    global _last_alloc
+    if _mem_alloc is None:
+        return
+    allocated = _mem_alloc()
+    free = _mem_free()
+    if allocated < _last_alloc:
+        count(GC_COLLECTIONS)
+    _last_alloc = allocated
+    _gauges[HEAP_ALLOC] = allocated
+    _gauges[HEAP_FREE] = free
+    if allocated > _gauges[HEAP_ALLOC_MAX]:
+        _gauges[HEAP_ALLOC_MAX] = allocated
+    if free < _gauges[HEAP_FREE_MIN] or not _gauges[HEAP_FREE_MIN]:
+        _gauges[HEAP_FREE_MIN] = free
+
+
+def set_watchdog_timeout(timeout_ms):
+    _gauges[WATCHDOG_TIMEOUT] = timeout_ms
+
+
+def feed_watchdog(wdt):
+    """Feed the watchdog, keeping track of the longest gap between two feeds."""
+    global _last_feed
+    wdt.feed()
+    now = time.ticks_ms()
+    if _last_feed >= 0:
+        gap = time.ticks_diff(now, _last_feed)
+        if gap > _gauges[WATCHDOG_GAP_MAX]:
+            _gauges[WATCHDOG_GAP_MAX] = gap
+    _last_feed = now
+    count(WATCHDOG_FEEDS)
+
+
+def _put(n, data):
+    end = n + len(data)
+    _text[n:end] = data
+    return end
+
+
+def _put_int(n, value):
+    """Write the decimal digits of an int in place."""
+    if value < 0:
+        _text[n] = 45   # '-'
+        n += 1
+        value = -value
+    digits = 1
+    rest = value
+    while rest >= 10:
+        rest //= 10
+        digits += 1
+    for i in range(n + digits - 1, n - 1, -1):
+        _text[i] = 48 + value % 10
+        value //= 10
+    return n + digits
+
+
+def _put_seconds(n, seconds, micros):
+    n = _put_int(n, seconds)
+    _text[n] = 46   # '.'
+    for i in range(n + 6, n, -1):
+        _text[i] = 48 + micros % 10
+        micros //= 10
+    return n + 7
+
+
+def render():
+    """Return a view of the metrics text, valid until the next call."""
+    sample_heap()
+    _gauges[WATCHDOG_MARGIN] = _gauges[WATCHDOG_TIMEOUT] - _gauges[WATCHDOG_GAP_MAX]
+    _gauges[UPTIME] = int(time.time() - _started)
+    n = 0
+    for timing in range(len(_TIMING_TEXT)):
+        base = timing * 4
+        count_text, sum_text, max_text = _TIMING_TEXT[timing]
+        n = _put(n, count_text)
+        n = _put_int(n, _timings[base])
+        n = _put(n, sum_text)
+        n = _put_seconds(n, _timings[base + 1], _timings[base + 2])
+        n = _put(n, max_text)
+        n = _put_seconds(n, _timings[base + 3] // 1000000, _timings[base + 3] % 1000000)
+        _text[n] = 10   # '\n'
+        n += 1
+    for counter in range(len(_COUNTER_TEXT)):
+        n = _put(n, _COUNTER_TEXT[counter])
+        n = _put_int(n, _counters[counter])
+        _text[n] = 10
+        n += 1
+    for gauge in range(len(_GAUGE_TEXT)):
+        n = _put(n, _GAUGE_TEXT[gauge])
+        n = _put_int(n, _gauges[gauge])
+        _text[n] = 10
+        n += 1
+    return _text_view[:n]
@@ -1,6 +1,65 @@
+import asyncio
+import gc
 import json
+import math
 import time
+from array import array
+import counters
 from utilities import celsius_to_farenheit
+from sample_ring import FIELDS, FIELD_NAMES, FIELD_SCALES, SEQ, TIMESTAMP, BOARD_TEMP, TEMPERATURE, PRESSURE, HUMIDITY, \
+    RAW_TEMPERATURE, RAW_PRESSURE, RAW_HUMIDITY
+
+MAX_HISTORY_SAMPLES = 60    # upper bound of samples in one history response
+MAX_OVERSAMPLES = 64        # upper bound of samples in one oversampled reading
+MAX_OVERSAMPLE_MS = 4000    # upper bound of the time spent on one oversampled reading
+
+# Oversampled statistics, allocated once and reused by every request.
+# Per channel (board temperature, temperature, pressure, humidity): mean, M2, min, max
+OVERSAMPLE_CHANNELS = ("board_temperature", "temperature", "pressure", "humidity")
+OVERSAMPLE_UNITS = ("C", "C", "hPa", "%")
+_stats = array("f", [0.0] * 16)
+_reading = array("i", [0, 0, 0])
+_raw = array("i", [0, 0, 0])
+# the buffers above are shared, so only one oversampled reading runs at a time
+_oversample_lock = asyncio.Lock()
+
+# Scratch sample for /sensors/bin, laid out like a ring buffer sample
+_sample = array("i", [0] * FIELDS)
+
+# Responses that never change are built once, as bytes
+def _static_response(status, content_type, body):
+    return ("HTTP/1.1 {}\r\n"
+            "Content-Type: {}\r\n"
+            "Content-Length: {}\r\n"
+            "Connection: close\r\n\r\n{}").format(status, content_type, len(body), body).encode('utf-8')
+
+_INDEX = (_static_response("200 OK", "text/html", """<html><body>
+<h1>Pico 2 W Sensor Server</h1>
+<p><a href="/sensors">Get Sensor Data (JSON)</a></p>
+<p><a href="/sensors/history">Get Buffered Sensor History (JSON)</a></p>
+<p><a href="/sensors/history/bin">Get Buffered Sensor History (binary)</a></p>
+<p><a href="/sensors/calibration">Get Sensor Calibration (JSON)</a></p>
+<p><a href="/metrics">Get Station Metrics (Prometheus text)</a></p>
+</body></html>"""),)
+_BAD_REQUEST = (_static_response("400 Bad Request", "text/plain", "Bad Request"),)
+_NOT_FOUND = (_static_response("404 Not Found", "text/plain", "Not Found"),)
+
+# Dynamic responses share a preallocated header, only Content-Length changes
+_JSON_HEADER = b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\nContent-Length: "
+_BINARY_HEADER = b"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\nConnection: close\r\nContent-Length: "
+_TEXT_HEADER = b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nConnection: close\r\nContent-Length: "
+_header = bytearray(max(len(_JSON_HEADER), len(_BINARY_HEADER), len(_TEXT_HEADER)) + 16)
+_header_view = memoryview(_header)
+# The response buffers are filled and handed to the writer without yielding
+# to the event loop in between, so concurrent clients can share them
+_chunks = [None, None, None, None]
+
+# Requests are read into a small pool of reusable buffers
+REQUEST_BUFFER_SIZE = 1024
+_request_buffers = [bytearray(REQUEST_BUFFER_SIZE) for _ in range(4)]
+
+# Trace gc.mem_alloc() deltas per request, to check what the hot path allocates
+TRACE_ALLOCATIONS = False
 
 def read_sensors(bme_sensor, board_sensor):
     """Read your sensor data and return as dictionary"""
@@ -33,46 +92,351 @@ def read_sensors(bme_sensor, board_sensor):
     return sensor_data
 
 
+def _accumulate(channel, n, value):
+    """Welford update of one channel, which keeps the variance stable in single precision"""
+    base = channel * 4
+    if n == 1:
+        _stats[base] = value
+        _stats[base + 1] = 0.0
+        _stats[base + 2] = value
+        _stats[base + 3] = value
+        return
+    delta = value - _stats[base]
+    _stats[base] += delta / n
+    _stats[base + 1] += delta * (value - _stats[base])
+    if value < _stats[base + 2]:
+        _stats[base + 2] = value
+    if value > _stats[base + 3]:
+        _stats[base + 3] = value
+
+
+async def read_oversampled(bme_sensor, board_sensor, samples, interval_ms, wdt=None):
+    """Take several back-to-back readings and return their mean, min, max and standard deviation"""
+    samples = max(1, min(samples, MAX_OVERSAMPLES))
+    # readings served from an acquisition snapshot only change once per period
+    interval_ms = max(0, interval_ms, getattr(bme_sensor, "period_ms", 0))
+    if samples > 1:
+        # keep the whole reading well inside the watchdog and client timeouts
+        interval_ms = min(interval_ms, MAX_OVERSAMPLE_MS // (samples - 1))
+
+    async with _oversample_lock:
+        for n in range(1, samples + 1):
+            if n > 1 and interval_ms:
+                # let other clients be served in between readings
+                await asyncio.sleep(interval_ms / 1000)
+            bme_sensor.read_compensated_data(_reading)
+            _accumulate(0, n, board_sensor.temperatureC())
+            _accumulate(1, n, _reading[0] / 100)
+            _accumulate(2, n, _reading[1] / 25600)
+            _accumulate(3, n, _reading[2] / 1024)
+            if wdt:
+                counters.feed_watchdog(wdt)
+        return _oversampled_data(samples, interval_ms)
+
+
+def _oversampled_data(samples, interval_ms):
+    sensor_data = {
+        "timestamp": {
+            "value": time.time(),
+            "unit": "seconds",
+            "reference": time.gmtime(0)
+        },
+        "samples": samples,
+        "interval_ms": interval_ms,
+        "status": "ok"
+    }
+    for channel, name in enumerate(OVERSAMPLE_CHANNELS):
+        base = channel * 4
+        sensor_data[name] = {
+            "value": _stats[base],
+            "min": _stats[base + 2],
+            "max": _stats[base + 3],
+            "std": math.sqrt(_stats[base + 1] / (samples - 1)) if samples > 1 else 0.0,
+            "unit": OVERSAMPLE_UNITS[channel]
+        }
+    return sensor_data
+
+
+def _write_header(prefix, length):
+    """Fill the shared header buffer and return a view of the filled part"""
+    n = len(prefix)
+    _header[:n] = prefix
+    # Content-Length digits, written in place
+    digits = 1
+    value = length
+    while value >= 10:
+        value //= 10
+        digits += 1
+    value = length
+    for i in range(n + digits - 1, n - 1, -1):
+        _header[i] = 48 + value % 10
+        value //= 10
+    n += digits
+    _header[n:n + 4] = b"\r\n\r\n"
+    return _header_view[:n + 4]
+
+
+# MicroPython's bytearray has no find/startswith, so requests are scanned by hand
+
+def _starts_with(request, length, start, prefix):
+    """Check whether request[start:length] starts with prefix"""
+    n = len(prefix)
+    if start + n > length:
+        return False
+    i = 0
+    while i < n:
+        if request[start + i] != prefix[i]:
+            return False
+        i += 1
+    return True
+
+
+def _find_byte(request, value, start, end):
+    """Return the index of the first byte equal to value in request[start:end], or -1"""
+    while start < end:
+        if request[start] == value:
+            return start
+        start += 1
+    return -1
+
+
+def _matches(request, length, route):
+    """Check whether the request line starts with the route, up to its end"""
+    if not _starts_with(request, length, 0, route):
+        return False
+    n = len(route)
+    if n == length:
+        return True
+    # the route must end with the path, or continue with the query string;
+    # compared one by one, MicroPython's bytes do not test ints for membership
+    c = request[n]
+    return c == 32 or c == 63 or c == 13 or c == 10     # space, ?, \r, \n
+
+
+def _query_int(request, length, name, default=None):
+    """
+    Return an integer query parameter of the request line without allocating.
+
+    Raises:
+        ValueError: if the parameter is present but not a number
+    """
+    line_end = _find_byte(request, 10, 0, length)   # '\n'
+    if line_end < 0:
+        line_end = length
+    path_end = _find_byte(request, 32, _find_byte(request, 32, 0, line_end) + 1, line_end)  # ' '
+    if path_end < 0:
+        path_end = line_end
+
+    start = _find_byte(request, 63, 0, path_end)    # '?'
+    while start >= 0:
+        start += 1
+        if _starts_with(request, path_end, start, name) and \
+                start + len(name) < path_end and request[start + len(name)] == 61:  # '='
+            break
+        start = _find_byte(request, 38, start, path_end)    # '&'
+    if start < 0:
+        return default
+
+    i = start + len(name) + 1
+    negative = i < path_end and request[i] == 45    # '-'
+    if negative:
+        i += 1
+    value = 0
+    digits = 0
+    while i < path_end and 48 <= request[i] <= 57:
+        value = value * 10 + request[i] - 48
+        digits += 1
+        i += 1
+    if digits == 0 or (i < path_end and request[i] != 38):
+        raise ValueError(name)
+    return -value if negative else value
+
+
+def read_history(ring, since=None, limit=MAX_HISTORY_SAMPLES):
+    """Return the buffered samples from the sequence number since onwards"""
+    first, end = ring.window(since, min(limit, MAX_HISTORY_SAMPLES))
+    samples = [[ring.get(seq, field) for field in range(FIELDS)] for seq in range(first, end)]
+
+    return {
+        "reference": time.gmtime(0),
+        "fields": FIELD_NAMES,
+        "scales": FIELD_SCALES,
+        "oldest_seq": ring.oldest_seq,
+        "next_seq": end,
+        "latest_seq": ring.next_seq,
+        "samples": samples,
+        "status": "ok"
+    }
+
+
+def create_binary_response(ring, chunks, first, end):
+    """Create HTTP response with a binary sample batch, as a list of buffers to send in turn"""
+    header = ring.binary_header(first, end)
+    length = len(header) + (end - first) * FIELDS * 4
+    _chunks[0] = _write_header(_BINARY_HEADER, length)
+    _chunks[1] = header
+    _chunks[2] = chunks[0] if len(chunks) > 0 else b""
+    _chunks[3] = chunks[1] if len(chunks) > 1 else b""
+    return _chunks
+
+
+def read_binary_sample(bme_sensor, board_sensor, ring):
+    """Read the sensors into the scratch sample and return the response for it"""
+    bme_sensor.read_compensated_data(_reading, _raw)
+    _sample[SEQ] = -1       # not part of the ring's sequence
+    _sample[TIMESTAMP] = int(time.time())
+    _sample[BOARD_TEMP] = int(board_sensor.temperatureC() * 100)
+    _sample[TEMPERATURE] = _reading[0]
+    _sample[PRESSURE] = _reading[1]
+    _sample[HUMIDITY] = _reading[2]
+    _sample[RAW_TEMPERATURE] = _raw[0]
+    _sample[RAW_PRESSURE] = _raw[1]
+    _sample[RAW_HUMIDITY] = _raw[2]
+    return create_binary_response(ring, (memoryview(_sample),), 0, 1)
+
+
+def create_metrics_response():
+    """Create HTTP response with the station's counters, without allocating"""
+    text = counters.render()
+    _chunks[0] = _write_header(_TEXT_HEADER, len(text))
+    _chunks[1] = text
+    _chunks[2] = b""
+    _chunks[3] = b""
+    return _chunks
+
+
 def create_http_response(data):
-    """Create HTTP response with JSON data"""
-    json_data = json.dumps(data)
-    
-    response = f"""HTTP/1.1 200 OK
-        Content-Type: application/json
-        Content-Length: {len(json_data)}
-        Connection: close
+    """Create HTTP response with JSON data, as a list of buffers to send in turn"""
+    json_data = json.dumps(data).encode('utf-8')
+    _chunks[0] = _write_header(_JSON_HEADER, len(json_data))
+    _chunks[1] = json_data
+    _chunks[2] = b""
+    _chunks[3] = b""
+    return _chunks
 
-        {json_data}"""
-    return response
 
+async def handle_request(request, bme_sensor, board_sensor, wdt=None, ring=None, length=None):
+    """
+    Parse request and determine response.
 
-def handle_request(request, bme_sensor, board_sensor, wdt=None):
-    """Parse request and determine response"""
-    lines = request.split('\n')
-    if len(lines) > 0:
-        method_line = lines[0]
-        if 'GET /sensors' in method_line:
-            sensor_data = read_sensors(bme_sensor, board_sensor)
+    Args:
+        request: the raw request (bytes-like), only its request line is used
+        length: number of valid bytes in request, all of them if None
 
-            if wdt:
-                wdt.feed()
-            return create_http_response(sensor_data)
-        elif 'GET /' in method_line:
+    Returns:
+        sequence of bytes-like buffers making up the response
+    """
+    if length is None:
+        length = len(request)
+    try:
+        if ring is not None and _matches(request, length, b"GET /sensors/history/bin"):
+            first, end = ring.window(_query_int(request, length, b"since"),
+                                     _query_int(request, length, b"limit", ring.capacity))
+            response = create_binary_response(ring, ring.views(first, end), first, end)
+        elif ring is not None and _matches(request, length, b"GET /sensors/bin"):
+            response = read_binary_sample(bme_sensor, board_sensor, ring)
+        elif ring is not None and _matches(request, length, b"GET /sensors/history"):
+            history = read_history(ring, _query_int(request, length, b"since"),
+                                   _query_int(request, length, b"limit", MAX_HISTORY_SAMPLES))
+            response = create_http_response(history)
+        elif _matches(request, length, b"GET /metrics"):
+            response = create_metrics_response()
+        elif _matches(request, length, b"GET /sensors/calibration"):
+            response = create_http_response(bme_sensor.calibration())
+        elif _matches(request, length, b"GET /sensors"):
+            samples = _query_int(request, length, b"samples")
+            if samples is not None:
+                interval_ms = _query_int(request, length, b"interval_ms", 0)
+                sensor_data = await read_oversampled(bme_sensor, board_sensor, samples, interval_ms, wdt=wdt)
+            else:
+                sensor_data = read_sensors(bme_sensor, board_sensor)
+            response = create_http_response(sensor_data)
+        elif _matches(request, length, b"GET /"):
             # Simple index page
-            html = """HTTP/1.1 200 OK
-                Content-Type: text/html
-
-                <html><body>
-                <h1>Pico 2 W Sensor Server</h1>
-                <p><a href="/sensors">Get Sensor Data (JSON)</a></p>
-                </body></html>"""
-            
-            if wdt:
-                wdt.feed()
-            return html
-    
-    # 404 response
-    return """HTTP/1.1 404 Not Found
-        Content-Type: text/plain
+            response = _INDEX
+        else:
+            return _NOT_FOUND
+    except ValueError:
+        return _BAD_REQUEST
+
+    if wdt:
+        counters.feed_watchdog(wdt)
+    return response
+
+
+def _headers_end(buf, start, end):
+    """Check whether buf[start:end] holds the blank line that ends the headers"""
+    i = _find_byte(buf, 10, start, end)
+    while i >= 0:
+        if (i + 1 < end and buf[i + 1] == 10) or (i + 2 < end and buf[i + 1] == 13 and buf[i + 2] == 10):
+            return True
+        i = _find_byte(buf, 10, i + 1, end)
+    return False
+
+
+async def read_request(reader, buf):
+    """Read the request into buf until the end of its headers, returning its length"""
+    view = memoryview(buf)
+    n = 0
+    while n < len(buf):
+        if hasattr(reader, 'readinto'):
+            count = await reader.readinto(view[n:])
+        else:
+            # CPython streams have no readinto
+            data = await reader.read(len(buf) - n)
+            count = len(data)
+            buf[n:n + count] = data
+        if not count:
+            break
+        # the blank line may straddle two reads
+        scan_from = max(0, n - 2)
+        n += count
+        if _headers_end(buf, scan_from, n):
+            break
+    return n
+
+
+async def serve_client(reader, writer, bme_sensor, board_sensor, wdt=None, ring=None, timeout=3):
+    """Serve one HTTP request on an asyncio stream pair, then close the connection"""
+    accepted = time.ticks_us()
+    remote_address = writer.get_extra_info('peername')
+    if TRACE_ALLOCATIONS:
+        allocated = gc.mem_alloc()
+    buf = _request_buffers.pop() if _request_buffers else bytearray(REQUEST_BUFFER_SIZE)
+    try:
+        n = await asyncio.wait_for(read_request(reader, buf), timeout)
+        response = await handle_request(buf, bme_sensor, board_sensor, wdt=wdt, ring=ring, length=n)
+
+        # written straight from the response buffers, before anything else can reuse them
+        sent = 0
+        for chunk in response:
+            if chunk:
+                writer.write(chunk)
+                sent += len(chunk)
+        await asyncio.wait_for(writer.drain(), timeout)
+        counters.observe(counters.REQUEST, time.ticks_diff(time.ticks_us(), accepted))
+        counters.count(counters.BYTES_SENT, sent)
+        print('Response sent to', remote_address)
 
-        Not Found"""
+    except asyncio.TimeoutError:
+        counters.count(counters.TIMEOUTS)
+        print('Client timed out:', remote_address)
+    except OSError as e:
+        if e.args[0] == 110:  # 110 is ETIMEDOUT, which is expected
+            counters.count(counters.TIMEOUTS)
+        else:
+            counters.count(counters.ERRORS)
+            print('Connection error:', e)
+    except Exception as e:
+        counters.count(counters.ERRORS)
+        print('Unexpected error:', e)
+    finally:
+        _request_buffers.append(buf)
+        counters.sample_heap()
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except:
+            pass
+        if TRACE_ALLOCATIONS:
+            print('Allocated during request:', gc.mem_alloc() - allocated, 'bytes')
@@ -1,11 +1,15 @@
 # Import libraries
 from wifi_connector import WiFiConnector
 from board_temp_sensor import BoardTempSensor
-from http_stuff import handle_request
+from http_stuff import serve_client
+from sample_ring import SampleRing
+from push import Pusher
+from acquisition import Acquisition
 from machine import Pin, I2C, WDT
-from bme280 import BME280
+from bme280 import BME280, BME280_MODE_NORMAL, BME280_STANDBY_62_5
+import counters
+import asyncio
 import time
-import gc
 
 # Set up the sensors
 # This is the on-board temperature sensor
@@ -15,56 +19,80 @@ board_temp = BoardTempSensor()
 i2c = I2C(0, sda=Pin(0), scl=Pin(1), freq=400000) 
 
 # Initialize the BME280 sensor
-bme = BME280(i2c=i2c, address=0x77)   # by default, the address should have been 0x76, however, my sensor is using the alternate
+bme = BME280(i2c=i2c, address=0x77,   # by default, the address should have been 0x76, however, my sensor is using the alternate
+             power_mode=BME280_MODE_NORMAL, standby=BME280_STANDBY_62_5)   # convert continuously, reads never wait
+bme.read_observer = counters.observe_bme280     # readout timing, served at /metrics
 
+# Samples taken on the board's own schedule, served in batches from /sensors/history
+ring = SampleRing(capacity=360, interval_ms=10000)  # one hour of samples
 
-def run_server(sock, wdt=None):
-    """Run the HTTP server to serve sensor data"""
+WATCHDOG_TIMEOUT_MS = 8000
 
-    while True:
-        # Feed watchdog if provided
-        if wdt:
-            wdt.feed()
-        client = None
+# Read the sensors on the second core, so requests are answered from the
+# latest reading without waiting for the I2C bus
+ACQUIRE_ON_SECOND_CORE = True
 
-        try:
-            client, remote_address = sock.accept()
-            client.settimeout(3.0)  # Timeout for client operations
-            print('Client connected from', remote_address)
+# Push mode: set PUSH_HOST to the collector running server/ingest.py, and the
+# samples are sent there instead of waiting to be polled
+PUSH_HOST = None
+PUSH_PORT = 8090
+PUSH_PERIOD_MS = 600000     # same as the collector's cycle
+STATION_ID = None           # name on the server, the station's IP address if None
 
-            if wdt:
-                wdt.feed()
 
-            request = client.recv(1024).decode('utf-8')
-            request = str(request)
-            # print('Request:', request.split('\n')[0])  # Print first line
-        
-            response = handle_request(request, bme, board_temp, wdt=wdt)
-            
-            if wdt:
-                wdt.feed()
-        
-            client.send(response.encode('utf-8'))
-            print('Response sent to', remote_address)
-            client.close()
-            print('Client connection closed')
-
-        except OSError as e:
-            if e.args[0] != 110:  # 110 is ETIMEDOUT, which is expected
-                print('Connection error:', e)
+def set_clock():
+    """Set the clock from NTP, pushed samples are stored by their time on it"""
+    import ntptime
+    ntptime.settime()
+
+
+async def feed_watchdog(wdt, period_ms=1000):
+    """Feed the watchdog for as long as the event loop keeps turning"""
+    while True:
+        counters.feed_watchdog(wdt)
+        await asyncio.sleep_ms(period_ms)
+
+
+async def sample_periodically(bme_sensor, board_sensor, period_ms=100):
+    """Fill the ring buffer on its own schedule, independently of the pollers"""
+    while True:
+        try:
+            ring.sample_if_due(bme_sensor, board_sensor)
         except Exception as e:
-            print('Unexpected error:', e)
-        finally:
-            # Always close client if it was created
-            if client:
-                try:
-                    client.close()
-                except:
-                    pass
-            
-            # # Run garbage collection to free memory
-            # print("\nAllocated memory: {} KB\nFree memory: {} KB".format(gc.mem_alloc() / 1024, gc.mem_free() / 1024))
-            # gc.collect()
+            print('Sampling error:', e)
+        # often enough to see most collections as a drop of the allocated heap
+        counters.sample_heap()
+        await asyncio.sleep_ms(period_ms)
+
+
+async def run_server(wdt=None, port=80, backlog=4, client_timeout=3, clock_set=False):
+    """Run the HTTP server to serve sensor data, several clients at a time"""
+    bme_sensor, board_sensor = bme, board_temp
+    if ACQUIRE_ON_SECOND_CORE:
+        # one reading per conversion of the sensor in normal mode
+        acquisition = Acquisition(bme, board_temp, period_ms=bme.measurement_period_ms())
+        acquisition.start()
+        bme_sensor, board_sensor = acquisition.bme, acquisition.board
+
+    def on_client(reader, writer):
+        return serve_client(reader, writer, bme_sensor, board_sensor, wdt=wdt, ring=ring, timeout=client_timeout)
+
+    await asyncio.start_server(on_client, '0.0.0.0', port, backlog=backlog)
+    print('Server listening on port', port)
+
+    if wdt:
+        # a blocked event loop stops the feeding, and the watchdog resets the board
+        asyncio.create_task(feed_watchdog(wdt))
+    asyncio.create_task(sample_periodically(bme_sensor, board_sensor))
+    if PUSH_HOST:
+        # if the clock could not be set at boot, the pusher tries again before pushing
+        pusher = Pusher(ring, bme_sensor, PUSH_HOST, PUSH_PORT, station_id=STATION_ID, period_ms=PUSH_PERIOD_MS,
+                        set_clock=None if clock_set else set_clock)
+        asyncio.create_task(pusher.run())
+
+    while True:
+        await asyncio.sleep(60)
+        # heap usage, GC and watchdog margin are served at /metrics, see counters.py
 
 
 if __name__ == "__main__":
@@ -79,7 +107,8 @@ if __name__ == "__main__":
         raise
     
     # Initialize watchdog (8 seconds timeout)
-    wdt = WDT(timeout=8000)
+    wdt = WDT(timeout=WATCHDOG_TIMEOUT_MS)
+    counters.set_watchdog_timeout(WATCHDOG_TIMEOUT_MS)
 
     try:
 
@@ -92,18 +121,24 @@ if __name__ == "__main__":
         if wdt is not None:
             wdt.feed()
 
+        clock_set = False
         if wificonnector.connected:
             # Small delay to ensure connection is stable
             time.sleep(2)
             if wdt is not None:
                 wdt.feed()
+            if PUSH_HOST:
+                try:
+                    set_clock()
+                    clock_set = True
+                except Exception as e:
+                    print(f"Could not set the clock: {e}")
+                if wdt is not None:
+                    wdt.feed()
 
-        sock = wificonnector.open_socket()
-        sock.settimeout(2.0)
-        
         # Start the server
         try:
-            run_server(sock=sock, wdt=wdt)
+            asyncio.run(run_server(wdt=wdt, clock_set=clock_set))
         except Exception as e:
             print(f"Server error: {e}")
     except Exception as e:
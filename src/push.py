@@ -0,0 +1,121 @@
+import asyncio
+import json
+import time
+import counters
+from sample_ring import FIELDS
+
+MAX_PUSH_SAMPLES = 120      # samples per batch, a backlog is sent in several batches in a row
+
+
+class Pusher:
+    """
+    Push the samples of the ring buffer to the collector's ingest listener.
+
+    Every push sends the samples from the sequence number the server
+    acknowledged last, in the same binary format as /sensors/history/bin, so a
+    push that fails is simply repeated by the next one. The sensor calibration
+    is sent once, and again whenever the server reports it does not have it.
+
+    The server stores the samples by their time on the station's clock, so
+    with set_clock nothing is pushed until the clock has been set, and the
+    samples taken before are moved to the new time.
+    """
+
+    def __init__(self, ring, bme_sensor, host, port=8090, station_id=None, period_ms=600000, timeout=10,
+                 set_clock=None):
+        """
+        Args:
+            ring: the SampleRing to push
+            host, port: address of the ingest listener
+            station_id: name of the station on the server, its IP address if None
+            period_ms: time between two pushes
+            timeout: seconds allowed for each step of a request
+            set_clock: callable setting the clock (e.g. ntptime.settime), None if it is set already
+        """
+        self.ring = ring
+        self.bme_sensor = bme_sensor
+        self.host = host
+        self.port = port
+        self.period_ms = period_ms
+        self.timeout = timeout
+        # first sequence number the server has not acknowledged yet, the oldest sample still in
+        # the ring to begin with, so a backlog from before the first push goes out in full
+        self.next_seq = 0
+        self.calibrated = False
+        self.set_clock = set_clock
+        query = "?station=" + station_id if station_id else ""
+        self._batch_path = "/ingest" + query
+        self._calibration_path = "/ingest/calibration" + query
+
+    def _request_header(self, path, content_type, length):
+        return ("POST {} HTTP/1.1\r\n"
+                "Host: {}\r\n"
+                "Content-Type: {}\r\n"
+                "Content-Length: {}\r\n"
+                "Connection: close\r\n\r\n").format(path, self.host, content_type, length).encode()
+
+    async def _read_reply(self, reader):
+        status = await asyncio.wait_for(reader.readline(), self.timeout)
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        body = await asyncio.wait_for(reader.read(-1), self.timeout)
+        if status.split()[1] != b"200":
+            raise OSError("ingest replied " + status.decode().strip())
+        return json.loads(body)
+
+    async def _post(self, path, first=None, end=None, body=None):
+        """POST a JSON body, or the ring's samples first to end (exclusive), and return the reply"""
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        try:
+            if body is not None:
+                writer.write(self._request_header(path, "application/json", len(body)))
+                writer.write(body)
+            else:
+                # the header buffer of the ring is shared with the HTTP server,
+                # so it is handed to the writer before yielding to the event loop
+                header = self.ring.binary_header(first, end)
+                length = len(header) + (end - first) * FIELDS * 4
+                writer.write(self._request_header(path, "application/octet-stream", length))
+                writer.write(header)
+                for view in self.ring.views(first, end):
+                    writer.write(view)
+            await asyncio.wait_for(writer.drain(), self.timeout)
+            return await self._read_reply(reader)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    async def push(self):
+        """Send everything the server has not acknowledged yet, in batches"""
+        if self.set_clock is not None:
+            before = int(time.time())
+            self.set_clock()
+            self.ring.shift_times(int(time.time()) - before)
+            self.set_clock = None
+        if not self.calibrated:
+            await self._post(self._calibration_path, body=json.dumps(self.bme_sensor.calibration()).encode())
+            self.calibrated = True
+        while True:
+            first, end = self.ring.window(self.next_seq, MAX_PUSH_SAMPLES)
+            if first >= end:
+                return
+            started = time.ticks_us()
+            reply = await self._post(self._batch_path, first, end)
+            counters.observe(counters.PUSH, time.ticks_diff(time.ticks_us(), started))
+            self.next_seq = reply["ack"]
+            if not reply.get("calibrated", True):
+                self.calibrated = False
+            if end >= self.ring.next_seq:
+                return
+
+    async def run(self):
+        """Push periodically, for as long as the event loop runs"""
+        while True:
+            await asyncio.sleep_ms(self.period_ms)
+            try:
+                await self.push()
+            except Exception as e:
+                counters.count(counters.PUSH_FAILURES)
+                print('Push error:', e)
@@ -0,0 +1,140 @@
+import struct
+import time
+from array import array
+
+# Layout of one sample in the ring buffer, all values are ints
+SEQ = 0             # sequence number, increases by one for every sample
+TIMESTAMP = 1       # seconds since the reference time.gmtime(0) of the board
+BOARD_TEMP = 2      # board temperature in hundredths of a degree C
+TEMPERATURE = 3     # hundredths of a degree C, as read_compensated_data returns it
+PRESSURE = 4        # Pa * 256, as read_compensated_data returns it
+HUMIDITY = 5        # % * 1024, as read_compensated_data returns it
+RAW_TEMPERATURE = 6 # raw ADC words of the same reading, for compensation elsewhere
+RAW_PRESSURE = 7
+RAW_HUMIDITY = 8
+FIELDS = 9
+
+FIELD_NAMES = ("seq", "timestamp", "board_temperature", "temperature", "pressure", "humidity",
+               "raw_temperature", "raw_pressure", "raw_humidity")
+# divide a stored value by its scale to get C, hPa and %
+FIELD_SCALES = (1, 1, 100, 100, 25600, 1024, 1, 1, 1)
+
+# Binary batch format: a little-endian header followed by count samples of
+# FIELDS int32 each, in the same layout as the ring itself
+BINARY_MAGIC = b"ESS1"
+BINARY_VERSION = 2
+# magic, version, fields, count, epoch year, oldest_seq, next_seq, latest_seq
+BINARY_HEADER_FORMAT = "<4sBBHHIII"
+BINARY_HEADER_SIZE = struct.calcsize(BINARY_HEADER_FORMAT)
+
+
+class SampleRing:
+    """
+    Fixed-size ring buffer of sensor samples, sampled on its own schedule.
+
+    All storage is allocated once, up front, in a flat array of ints so that
+    taking a sample does not touch the heap. When the ring is full the oldest
+    sample is overwritten.
+    """
+
+    def __init__(self, capacity=360, interval_ms=10000):
+        self.capacity = capacity
+        self.interval_ms = interval_ms
+        self.next_seq = 0       # sequence number the next sample will get
+
+        self._data = array("i", (0 for _ in range(capacity * FIELDS)))
+        self._view = memoryview(self._data)
+        self._reading = array("i", [0, 0, 0])
+        self._raw = array("i", [0, 0, 0])
+        self._header = bytearray(BINARY_HEADER_SIZE)
+        self._epoch_year = time.gmtime(0)[0]
+        self._next_due = time.ticks_ms()
+
+    @property
+    def oldest_seq(self):
+        return max(0, self.next_seq - self.capacity)
+
+    def __len__(self):
+        return self.next_seq - self.oldest_seq
+
+    def sample(self, bme_sensor, board_sensor):
+        """Read the sensors into the next slot of the ring."""
+        bme_sensor.read_compensated_data(self._reading, self._raw)
+        offset = (self.next_seq % self.capacity) * FIELDS
+        data = self._data
+        data[offset + SEQ] = self.next_seq
+        data[offset + TIMESTAMP] = int(time.time())
+        data[offset + BOARD_TEMP] = int(board_sensor.temperatureC() * 100)
+        data[offset + TEMPERATURE] = self._reading[0]
+        data[offset + PRESSURE] = self._reading[1]
+        data[offset + HUMIDITY] = self._reading[2]
+        data[offset + RAW_TEMPERATURE] = self._raw[0]
+        data[offset + RAW_PRESSURE] = self._raw[1]
+        data[offset + RAW_HUMIDITY] = self._raw[2]
+        self.next_seq += 1
+
+    def sample_if_due(self, bme_sensor, board_sensor):
+        """Take a sample if the sampling interval has elapsed since the last one."""
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self._next_due) < 0:
+            return False
+        self.sample(bme_sensor, board_sensor)
+        self._next_due = time.ticks_add(self._next_due, self.interval_ms)
+        if time.ticks_diff(now, self._next_due) >= 0:
+            # we fell behind (e.g. a long request), do not try to catch up in a burst
+            self._next_due = time.ticks_add(now, self.interval_ms)
+        return True
+
+    def window(self, since=None, limit=60):
+        """
+        Return the range of sequence numbers to serve for a history request.
+
+        Args:
+            since: first sequence number wanted, None for the newest samples
+            limit: maximum number of samples to return
+
+        Returns:
+            (first, end) sequence numbers, end being exclusive
+
+        Raises:
+            ValueError: if limit is negative
+        """
+        if limit < 0:
+            raise ValueError("limit")
+        if since is None:
+            first = max(self.oldest_seq, self.next_seq - limit)
+        else:
+            first = min(max(self.oldest_seq, since), self.next_seq)
+        return first, min(first + limit, self.next_seq)
+
+    def shift_times(self, seconds):
+        """Move the timestamps of the stored samples, e.g. once the clock has been set."""
+        data = self._data
+        for seq in range(self.oldest_seq, self.next_seq):
+            data[(seq % self.capacity) * FIELDS + TIMESTAMP] += seconds
+
+    def get(self, seq, field):
+        """Return one field of the sample with the given sequence number."""
+        return self._data[(seq % self.capacity) * FIELDS + field]
+
+    def views(self, first, end):
+        """
+        Return the stored samples first to end (exclusive) without copying them.
+
+        Returns:
+            tuple of memoryviews over the ring storage, two when the range wraps around
+        """
+        count = end - first
+        if count <= 0:
+            return ()
+        start = (first % self.capacity) * FIELDS
+        stop = start + count * FIELDS
+        if stop <= len(self._data):
+            return (self._view[start:stop],)
+        return (self._view[start:], self._view[:stop - len(self._data)])
+
+    def binary_header(self, first, end):
+        """Pack the binary batch header for the samples first to end (exclusive)"""
+        struct.pack_into(BINARY_HEADER_FORMAT, self._header, 0, BINARY_MAGIC, BINARY_VERSION,
+                         FIELDS, end - first, self._epoch_year, self.oldest_seq, end, self.next_seq)
+        return self._header